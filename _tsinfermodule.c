@@ -24,6 +24,12 @@ typedef struct {
     ancestor_builder_t *builder;
 } AncestorBuilder;
 
+typedef struct {
+    PyObject_HEAD
+    ancestor_builder_workspace_t *workspace;
+    AncestorBuilder *ancestor_builder;
+} AncestorBuilderWorkspace;
+
 typedef struct {
     PyObject_HEAD
     tree_sequence_builder_t *tree_sequence_builder;
@@ -78,15 +84,19 @@ AncestorBuilder_init(AncestorBuilder *self, PyObject *args, PyObject *kwds)
 {
     int ret = -1;
     int err;
-    static char *kwlist[] = {"num_samples", "num_sites", NULL};
+    static char *kwlist[] = {"num_samples", "num_sites", "bitpack_genotypes", NULL};
     int num_samples, num_sites;
+    int bitpack_genotypes = 0;
     int flags = 0;
 
     self->builder = NULL;
-    if (!PyArg_ParseTupleAndKeywords(args, kwds, "ii", kwlist,
-                &num_samples, &num_sites)) {
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "ii|i", kwlist,
+                &num_samples, &num_sites, &bitpack_genotypes)) {
         goto out;
     }
+    if (bitpack_genotypes) {
+        flags = TSI_BITPACK_GENOTYPES;
+    }
     self->builder = PyMem_Malloc(sizeof(ancestor_builder_t));
     if (self->builder == NULL) {
         PyErr_NoMemory();
@@ -149,27 +159,132 @@ out:
     return Py_BuildValue("");
 }
 
+static PyObject *
+AncestorBuilder_add_sites(AncestorBuilder *self, PyObject *args, PyObject *kwds)
+{
+    int err;
+    static char *kwlist[] = {"site_ids", "genotypes", NULL};
+    PyObject *ret = NULL;
+    PyObject *site_ids = NULL;
+    PyArrayObject *site_ids_array = NULL;
+    PyObject *genotypes = NULL;
+    PyArrayObject *genotypes_array = NULL;
+    npy_intp *shape;
+    size_t j, num_sites;
+    site_id_t *site_ids_data;
+
+    if (AncestorBuilder_check_state(self) != 0) {
+        goto out;
+    }
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "OO", kwlist,
+            &site_ids, &genotypes)) {
+        goto out;
+    }
+    site_ids_array = (PyArrayObject *) PyArray_FROM_OTF(site_ids, NPY_INT32,
+            NPY_ARRAY_IN_ARRAY);
+    if (site_ids_array == NULL) {
+        goto out;
+    }
+    if (PyArray_NDIM(site_ids_array) != 1) {
+        PyErr_SetString(PyExc_ValueError, "Dim != 1");
+        goto out;
+    }
+    shape = PyArray_DIMS(site_ids_array);
+    num_sites = (size_t) shape[0];
+    site_ids_data = (site_id_t *) PyArray_DATA(site_ids_array);
+    for (j = 0; j < num_sites; j++) {
+        if (site_ids_data[j] < 0
+                || site_ids_data[j] >= (site_id_t) self->builder->num_sites) {
+            PyErr_SetString(PyExc_ValueError, "site ID out of bounds");
+            goto out;
+        }
+    }
+    genotypes_array = (PyArrayObject *) PyArray_FROM_OTF(genotypes, NPY_UINT8,
+            NPY_ARRAY_IN_ARRAY);
+    if (genotypes_array == NULL) {
+        goto out;
+    }
+    if (PyArray_NDIM(genotypes_array) != 2) {
+        PyErr_SetString(PyExc_ValueError, "Dim != 2");
+        goto out;
+    }
+    shape = PyArray_DIMS(genotypes_array);
+    if (shape[0] != (npy_intp) num_sites
+            || shape[1] != (npy_intp) self->builder->num_samples) {
+        PyErr_SetString(PyExc_ValueError,
+                "genotypes must have shape (len(site_ids), num_samples)");
+        goto out;
+    }
+    Py_BEGIN_ALLOW_THREADS
+    err = ancestor_builder_add_sites(self->builder, num_sites, site_ids_data,
+        (allele_t *) PyArray_DATA(genotypes_array));
+    Py_END_ALLOW_THREADS
+    if (err != 0) {
+        handle_library_error(err);
+        goto out;
+    }
+    ret = Py_BuildValue("");
+out:
+    Py_XDECREF(site_ids_array);
+    Py_XDECREF(genotypes_array);
+    return ret;
+}
+
+static PyTypeObject AncestorBuilderWorkspaceType;
+
 static PyObject *
 AncestorBuilder_make_ancestor(AncestorBuilder *self, PyObject *args, PyObject *kwds)
 {
     int err;
-    static char *kwlist[] = {"focal_sites", "ancestor", NULL};
+    static char *kwlist[] = {"focal_sites", "ancestor", "workspace", NULL};
     PyObject *ancestor = NULL;
     PyArrayObject *ancestor_array = NULL;
     PyObject *focal_sites = NULL;
     PyArrayObject *focal_sites_array = NULL;
+    AncestorBuilderWorkspace *py_workspace = NULL;
+    ancestor_builder_workspace_t tmp_workspace;
+    ancestor_builder_workspace_t *workspace = NULL;
     size_t num_focal_sites;
     size_t num_sites;
     site_id_t start, end;
     npy_intp *shape;
 
+    memset(&tmp_workspace, 0, sizeof(tmp_workspace));
     if (AncestorBuilder_check_state(self) != 0) {
         goto fail;
     }
-    if (!PyArg_ParseTupleAndKeywords(args, kwds, "OO!", kwlist,
-            &focal_sites, &PyArray_Type, &ancestor)) {
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "OO!|O", kwlist,
+            &focal_sites, &PyArray_Type, &ancestor, &py_workspace)) {
         goto fail;
     }
+    if (py_workspace == NULL || (PyObject *) py_workspace == Py_None) {
+        /* Without a workspace we must allocate the scratch memory for
+         * this call. */
+        err = ancestor_builder_workspace_alloc(&tmp_workspace,
+                self->builder->num_samples);
+        if (err != 0) {
+            handle_library_error(err);
+            goto fail;
+        }
+        workspace = &tmp_workspace;
+    } else {
+        if (!PyObject_TypeCheck(py_workspace, &AncestorBuilderWorkspaceType)) {
+            PyErr_SetString(PyExc_TypeError,
+                    "workspace must be an AncestorBuilderWorkspace");
+            goto fail;
+        }
+        if (py_workspace->workspace == NULL) {
+            PyErr_SetString(PyExc_SystemError,
+                    "AncestorBuilderWorkspace not initialised");
+            goto fail;
+        }
+        if (py_workspace->ancestor_builder != self) {
+            PyErr_SetString(PyExc_ValueError,
+                    "workspace belongs to a different AncestorBuilder");
+            goto fail;
+        }
+        workspace = py_workspace->workspace;
+    }
     num_sites = self->builder->num_sites;
     focal_sites_array = (PyArrayObject *) PyArray_FROM_OTF(focal_sites, NPY_INT32,
             NPY_ARRAY_IN_ARRAY);
@@ -201,7 +316,7 @@ AncestorBuilder_make_ancestor(AncestorBuilder *self, PyObject *args, PyObject *k
         goto fail;
     }
     Py_BEGIN_ALLOW_THREADS
-    err = ancestor_builder_make_ancestor(self->builder, num_focal_sites,
+    err = ancestor_builder_make_ancestor(self->builder, workspace, num_focal_sites,
         (int32_t *) PyArray_DATA(focal_sites_array),
         &start, &end, (int8_t *) PyArray_DATA(ancestor_array));
     Py_END_ALLOW_THREADS
@@ -209,10 +324,12 @@ AncestorBuilder_make_ancestor(AncestorBuilder *self, PyObject *args, PyObject *k
         handle_library_error(err);
         goto fail;
     }
+    ancestor_builder_workspace_free(&tmp_workspace);
     Py_DECREF(focal_sites_array);
     Py_DECREF(ancestor_array);
     return Py_BuildValue("ii", start, end);
 fail:
+    ancestor_builder_workspace_free(&tmp_workspace);
     Py_XDECREF(focal_sites_array);
     PyArray_XDECREF_ERR(ancestor_array);
     return NULL;
@@ -222,77 +339,61 @@ static PyObject *
 AncestorBuilder_ancestor_descriptors(AncestorBuilder *self)
 {
     PyObject *ret = NULL;
-    PyObject *descriptors = NULL;
-    PyObject *py_descriptor = NULL;
-    PyArrayObject *site_array = NULL;
+    PyArrayObject *frequency = NULL;
+    PyArrayObject *focal_sites_offset = NULL;
+    PyArrayObject *focal_sites = NULL;
     ancestor_descriptor_t *descriptor;
-    size_t j;
-    npy_intp dims;
+    uint32_t *frequency_data;
+    uint64_t *offset_data;
+    site_id_t *focal_sites_data;
+    size_t j, num_ancestors, offset;
+    npy_intp shape;
     int err;
 
     if (AncestorBuilder_check_state(self) != 0) {
         goto out;
     }
-
     err = ancestor_builder_finalise(self->builder);
     if (err != 0) {
         handle_library_error(err);
         goto out;
     }
-    descriptors = PyTuple_New(self->builder->num_ancestors);
-    if (descriptors == NULL) {
-        goto out;
-    }
-    for (j = 0; j < self->builder->num_ancestors; j++) {
+    /* The descriptors are returned in columnar form: the focal sites for
+     * ancestor j are focal_sites[focal_sites_offset[j]: focal_sites_offset[j + 1]].
+     * It's not great that we're breaking encapsulation here and looking
+     * directly into the builder's data structures, but it's simple. */
+    num_ancestors = self->builder->num_ancestors;
+    offset = 0;
+    for (j = 0; j < num_ancestors; j++) {
+        offset += self->builder->descriptors[j].num_focal_sites;
+    }
+    shape = (npy_intp) num_ancestors;
+    frequency = (PyArrayObject *) PyArray_SimpleNew(1, &shape, NPY_UINT32);
+    shape = (npy_intp) num_ancestors + 1;
+    focal_sites_offset = (PyArrayObject *) PyArray_SimpleNew(1, &shape, NPY_UINT64);
+    shape = (npy_intp) offset;
+    focal_sites = (PyArrayObject *) PyArray_SimpleNew(1, &shape, NPY_INT32);
+    if (frequency == NULL || focal_sites_offset == NULL || focal_sites == NULL) {
+        goto out;
+    }
+    frequency_data = (uint32_t *) PyArray_DATA(frequency);
+    offset_data = (uint64_t *) PyArray_DATA(focal_sites_offset);
+    focal_sites_data = (site_id_t *) PyArray_DATA(focal_sites);
+    offset = 0;
+    for (j = 0; j < num_ancestors; j++) {
         descriptor = &self->builder->descriptors[j];
-        dims = descriptor->num_focal_sites;
-        site_array = (PyArrayObject *) PyArray_SimpleNew(1, &dims, NPY_INT32);
-
-        if (site_array == NULL) {
-            goto out;
-        }
-        memcpy(PyArray_DATA(site_array), descriptor->focal_sites,
+        frequency_data[j] = (uint32_t) descriptor->frequency;
+        offset_data[j] = (uint64_t) offset;
+        memcpy(focal_sites_data + offset, descriptor->focal_sites,
                 descriptor->num_focal_sites * sizeof(site_id_t));
-        py_descriptor = Py_BuildValue("kO",
-                (unsigned long) descriptor->frequency, site_array);
-        if (py_descriptor == NULL) {
-            Py_DECREF(site_array);
-            goto out;
-        }
-        PyTuple_SET_ITEM(descriptors, j, py_descriptor);
-    }
-    /* j = 0; */
-    /* /1* It's not great that we're breaking encapsulation here and looking */
-    /*  * directly in to the builder's data structures. However, it's quite an */
-    /*  * awkward set of data to communicate, so it seems OK. *1/ */
-    /* for (f = self->builder->num_samples; f > 0; f--) { */
-    /*     for (a = self->builder->frequency_map[f].head; a != NULL; a = a->next) { */
-    /*         map_elem = (pattern_map_t *) a->item; */
-    /*         dims = map_elem->num_sites; */
-    /*         site_array = (PyArrayObject *) PyArray_SimpleNew(1, &dims, NPY_INT32); */
-    /*         if (site_array == NULL) { */
-    /*             goto out; */
-    /*         } */
-    /*         site_array_data = (int32_t *) PyArray_DATA(site_array); */
-    /*         /1* The elements are listed backwards, so reverse them *1/ */
-    /*         k = map_elem->num_sites - 1; */
-    /*         for (s = map_elem->sites; s != NULL; s = s->next) { */
-    /*             site_array_data[k] = (int32_t) s->site; */
-    /*             k--; */
-    /*         } */
-    /*         descriptor = Py_BuildValue("kO", (unsigned long) f, site_array); */
-    /*         if (descriptor == NULL) { */
-    /*             Py_DECREF(site_array); */
-    /*             goto out; */
-    /*         } */
-    /*         PyTuple_SET_ITEM(descriptors, j, descriptor); */
-    /*         j++; */
-    /*     } */
-    /* } */
-    ret = descriptors;
-    descriptors = NULL;
+        offset += descriptor->num_focal_sites;
+    }
+    offset_data[num_ancestors] = (uint64_t) offset;
+    ret = Py_BuildValue("OOO", frequency, focal_sites_offset, focal_sites);
 out:
-    Py_XDECREF(descriptors);
+    Py_XDECREF(frequency);
+    Py_XDECREF(focal_sites_offset);
+    Py_XDECREF(focal_sites);
     return ret;
 }
 
@@ -336,12 +437,15 @@ static PyMethodDef AncestorBuilder_methods[] = {
     {"add_site", (PyCFunction) AncestorBuilder_add_site,
         METH_VARARGS|METH_KEYWORDS,
         "Adds the specified site to this ancestor builder."},
+    {"add_sites", (PyCFunction) AncestorBuilder_add_sites,
+        METH_VARARGS|METH_KEYWORDS,
+        "Adds the sites with the specified IDs and (sites x samples) genotypes."},
     {"make_ancestor", (PyCFunction) AncestorBuilder_make_ancestor,
         METH_VARARGS|METH_KEYWORDS,
         "Makes the specified ancestor."},
     {"ancestor_descriptors", (PyCFunction) AncestorBuilder_ancestor_descriptors,
         METH_NOARGS,
-        "Returns a list of ancestor (frequency, focal_sites) tuples."},
+        "Returns the ancestor (frequency, focal_sites_offset, focal_sites) arrays."},
     {NULL}  /* Sentinel */
 };
 
@@ -384,6 +488,136 @@ static PyTypeObject AncestorBuilderType = {
     (initproc)AncestorBuilder_init,      /* tp_init */
 };
 
+/*===================================================================
+ * AncestorBuilderWorkspace
+ *===================================================================
+ */
+
+static int
+AncestorBuilderWorkspace_check_state(AncestorBuilderWorkspace *self)
+{
+    int ret = 0;
+    if (self->workspace == NULL) {
+        PyErr_SetString(PyExc_SystemError, "AncestorBuilderWorkspace not initialised");
+        ret = -1;
+    }
+    return ret;
+}
+
+static void
+AncestorBuilderWorkspace_dealloc(AncestorBuilderWorkspace* self)
+{
+    if (self->workspace != NULL) {
+        ancestor_builder_workspace_free(self->workspace);
+        PyMem_Free(self->workspace);
+        self->workspace = NULL;
+    }
+    Py_XDECREF(self->ancestor_builder);
+    Py_TYPE(self)->tp_free((PyObject*)self);
+}
+
+static int
+AncestorBuilderWorkspace_init(AncestorBuilderWorkspace *self, PyObject *args,
+        PyObject *kwds)
+{
+    int ret = -1;
+    int err;
+    static char *kwlist[] = {"ancestor_builder", NULL};
+    AncestorBuilder *ancestor_builder = NULL;
+
+    self->workspace = NULL;
+    self->ancestor_builder = NULL;
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O!", kwlist,
+                &AncestorBuilderType, &ancestor_builder)) {
+        goto out;
+    }
+    self->ancestor_builder = ancestor_builder;
+    Py_INCREF(self->ancestor_builder);
+    if (AncestorBuilder_check_state(self->ancestor_builder) != 0) {
+        goto out;
+    }
+    self->workspace = PyMem_Malloc(sizeof(ancestor_builder_workspace_t));
+    if (self->workspace == NULL) {
+        PyErr_NoMemory();
+        goto out;
+    }
+    err = ancestor_builder_workspace_alloc(self->workspace,
+            self->ancestor_builder->builder->num_samples);
+    if (err != 0) {
+        handle_library_error(err);
+        goto out;
+    }
+    ret = 0;
+out:
+    return ret;
+}
+
+static PyObject *
+AncestorBuilderWorkspace_get_num_samples(AncestorBuilderWorkspace *self, void *closure)
+{
+    PyObject *ret = NULL;
+
+    if (AncestorBuilderWorkspace_check_state(self) != 0) {
+        goto out;
+    }
+    ret = Py_BuildValue("k", (unsigned long) self->workspace->num_samples);
+out:
+    return ret;
+}
+
+static PyMemberDef AncestorBuilderWorkspace_members[] = {
+    {NULL}  /* Sentinel */
+};
+
+static PyGetSetDef AncestorBuilderWorkspace_getsetters[] = {
+    {"num_samples", (getter) AncestorBuilderWorkspace_get_num_samples, NULL,
+        "The number of samples."},
+    {NULL}  /* Sentinel */
+};
+
+static PyMethodDef AncestorBuilderWorkspace_methods[] = {
+    {NULL}  /* Sentinel */
+};
+
+static PyTypeObject AncestorBuilderWorkspaceType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "_tsinfer.AncestorBuilderWorkspace",             /* tp_name */
+    sizeof(AncestorBuilderWorkspace),             /* tp_basicsize */
+    0,                         /* tp_itemsize */
+    (destructor)AncestorBuilderWorkspace_dealloc, /* tp_dealloc */
+    0,                         /* tp_print */
+    0,                         /* tp_getattr */
+    0,                         /* tp_setattr */
+    0,                         /* tp_reserved */
+    0,                         /* tp_repr */
+    0,                         /* tp_as_number */
+    0,                         /* tp_as_sequence */
+    0,                         /* tp_as_mapping */
+    0,                         /* tp_hash  */
+    0,                         /* tp_call */
+    0,                         /* tp_str */
+    0,                         /* tp_getattro */
+    0,                         /* tp_setattro */
+    0,                         /* tp_as_buffer */
+    Py_TPFLAGS_DEFAULT,        /* tp_flags */
+    "AncestorBuilderWorkspace objects",           /* tp_doc */
+    0,                     /* tp_traverse */
+    0,                     /* tp_clear */
+    0,                     /* tp_richcompare */
+    0,                     /* tp_weaklistoffset */
+    0,                     /* tp_iter */
+    0,                     /* tp_iternext */
+    AncestorBuilderWorkspace_methods,             /* tp_methods */
+    AncestorBuilderWorkspace_members,             /* tp_members */
+    AncestorBuilderWorkspace_getsetters,          /* tp_getset */
+    0,                         /* tp_base */
+    0,                         /* tp_dict */
+    0,                         /* tp_descr_get */
+    0,                         /* tp_descr_set */
+    0,                         /* tp_dictoffset */
+    (initproc)AncestorBuilderWorkspace_init,      /* tp_init */
+};
+
 /*===================================================================
  * TreeSequenceBuilder
  *===================================================================
@@ -419,14 +653,19 @@ TreeSequenceBuilder_init(TreeSequenceBuilder *self, PyObject *args, PyObject *kw
     unsigned long num_sites;
     unsigned long max_nodes;
     unsigned long max_edges;
-    static char *kwlist[] = {"num_sites", "max_nodes", "max_edges", NULL};
+    int sorted_run_path_index = 0;
+    static char *kwlist[] = {"num_sites", "max_nodes", "max_edges",
+        "sorted_run_path_index", NULL};
     int flags = 0;
 
     self->tree_sequence_builder = NULL;
-    if (!PyArg_ParseTupleAndKeywords(args, kwds, "kkk", kwlist,
-                &num_sites, &max_nodes, &max_edges)) {
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "kkk|i", kwlist,
+                &num_sites, &max_nodes, &max_edges, &sorted_run_path_index)) {
         goto out;
     }
+    if (sorted_run_path_index) {
+        flags |= TSI_SORTED_RUN_PATH_INDEX;
+    }
     self->tree_sequence_builder = PyMem_Malloc(sizeof(tree_sequence_builder_t));
     if (self->tree_sequence_builder == NULL) {
         PyErr_NoMemory();
@@ -574,6 +813,126 @@ out:
     return ret;
 }
 
+/* Adds the paths for many children in a single call. The path for child_ids[j]
+ * is given by left/right/parent[offset[j]: offset[j + 1]]. */
+static PyObject *
+TreeSequenceBuilder_add_paths(TreeSequenceBuilder *self, PyObject *args, PyObject *kwds)
+{
+    int err = 0;
+    PyObject *ret = NULL;
+    int flags = 0;
+    PyObject *child_ids = NULL;
+    PyArrayObject *child_ids_array = NULL;
+    PyObject *offset = NULL;
+    PyArrayObject *offset_array = NULL;
+    PyObject *left = NULL;
+    PyArrayObject *left_array = NULL;
+    PyObject *right = NULL;
+    PyArrayObject *right_array = NULL;
+    PyObject *parent = NULL;
+    PyArrayObject *parent_array = NULL;
+    size_t j, num_paths, num_edges;
+    node_id_t *child_data;
+    uint64_t *offset_data;
+    site_id_t *left_data, *right_data;
+    node_id_t *parent_data;
+    int compress = 1;
+    int extended_checks = 0;
+
+    static char *kwlist[] = {"child_ids", "offset", "left", "right", "parent",
+        "compress", "extended_checks", NULL};
+
+    if (TreeSequenceBuilder_check_state(self) != 0) {
+        goto out;
+    }
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "OOOOO|ii", kwlist,
+            &child_ids, &offset, &left, &right, &parent, &compress,
+            &extended_checks)) {
+        goto out;
+    }
+    if (compress) {
+        flags = TSI_COMPRESS_PATH;
+    }
+    if (extended_checks) {
+        flags |= TSI_EXTENDED_CHECKS;
+    }
+
+    child_ids_array = (PyArrayObject *) PyArray_FROM_OTF(child_ids, NPY_INT32,
+            NPY_ARRAY_IN_ARRAY);
+    offset_array = (PyArrayObject *) PyArray_FROM_OTF(offset, NPY_UINT64,
+            NPY_ARRAY_IN_ARRAY);
+    left_array = (PyArrayObject *) PyArray_FROM_OTF(left, NPY_UINT32,
+            NPY_ARRAY_IN_ARRAY);
+    right_array = (PyArrayObject *) PyArray_FROM_OTF(right, NPY_UINT32,
+            NPY_ARRAY_IN_ARRAY);
+    parent_array = (PyArrayObject *) PyArray_FROM_OTF(parent, NPY_INT32,
+            NPY_ARRAY_IN_ARRAY);
+    if (child_ids_array == NULL || offset_array == NULL || left_array == NULL
+            || right_array == NULL || parent_array == NULL) {
+        goto out;
+    }
+    if (PyArray_NDIM(child_ids_array) != 1 || PyArray_NDIM(offset_array) != 1
+            || PyArray_NDIM(left_array) != 1 || PyArray_NDIM(right_array) != 1
+            || PyArray_NDIM(parent_array) != 1) {
+        PyErr_SetString(PyExc_ValueError, "Dim != 1");
+        goto out;
+    }
+    num_paths = (size_t) PyArray_DIMS(child_ids_array)[0];
+    num_edges = (size_t) PyArray_DIMS(left_array)[0];
+    if ((size_t) PyArray_DIMS(offset_array)[0] != num_paths + 1) {
+        PyErr_SetString(PyExc_ValueError, "offset must have num_paths + 1 values");
+        goto out;
+    }
+    if ((size_t) PyArray_DIMS(right_array)[0] != num_edges) {
+        PyErr_SetString(PyExc_ValueError, "right wrong size");
+        goto out;
+    }
+    if ((size_t) PyArray_DIMS(parent_array)[0] != num_edges) {
+        PyErr_SetString(PyExc_ValueError, "parent wrong size");
+        goto out;
+    }
+    child_data = (node_id_t *) PyArray_DATA(child_ids_array);
+    offset_data = (uint64_t *) PyArray_DATA(offset_array);
+    left_data = (site_id_t *) PyArray_DATA(left_array);
+    right_data = (site_id_t *) PyArray_DATA(right_array);
+    parent_data = (node_id_t *) PyArray_DATA(parent_array);
+    if (offset_data[0] != 0 || offset_data[num_paths] != num_edges) {
+        PyErr_SetString(PyExc_ValueError, "Bad offset array");
+        goto out;
+    }
+    for (j = 0; j < num_paths; j++) {
+        if (offset_data[j] > offset_data[j + 1]) {
+            PyErr_SetString(PyExc_ValueError, "offset must be nondecreasing");
+            goto out;
+        }
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    for (j = 0; j < num_paths; j++) {
+        err = tree_sequence_builder_add_path(self->tree_sequence_builder,
+                child_data[j], (size_t) (offset_data[j + 1] - offset_data[j]),
+                left_data + offset_data[j], right_data + offset_data[j],
+                parent_data + offset_data[j], flags);
+        if (err < 0) {
+            break;
+        }
+    }
+    Py_END_ALLOW_THREADS
+
+    if (err < 0) {
+        handle_library_error(err);
+        goto out;
+    }
+    ret = Py_BuildValue("");
+out:
+    Py_XDECREF(child_ids_array);
+    Py_XDECREF(offset_array);
+    Py_XDECREF(left_array);
+    Py_XDECREF(right_array);
+    Py_XDECREF(parent_array);
+    return ret;
+}
+
 static PyObject *
 TreeSequenceBuilder_add_mutations(TreeSequenceBuilder *self, PyObject *args, PyObject *kwds)
 {
@@ -647,6 +1006,119 @@ out:
 }
 
 
+/* Adds the mutations for many nodes in a single call. The mutations for
+ * nodes[j] are given by site/derived_state[offset[j]: offset[j + 1]]. */
+static PyObject *
+TreeSequenceBuilder_add_mutations_bulk(TreeSequenceBuilder *self, PyObject *args,
+        PyObject *kwds)
+{
+    int err = 0;
+    PyObject *ret = NULL;
+    PyObject *nodes = NULL;
+    PyArrayObject *nodes_array = NULL;
+    PyObject *offset = NULL;
+    PyArrayObject *offset_array = NULL;
+    PyObject *site = NULL;
+    PyArrayObject *site_array = NULL;
+    PyObject *derived_state = NULL;
+    PyArrayObject *derived_state_array = NULL;
+    size_t j, num_nodes, num_mutations;
+    node_id_t *node_data;
+    uint64_t *offset_data;
+    site_id_t *site_data;
+    allele_t *derived_state_data;
+
+    static char *kwlist[] = {"nodes", "offset", "site", "derived_state", NULL};
+
+    if (TreeSequenceBuilder_check_state(self) != 0) {
+        goto out;
+    }
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "OOOO", kwlist,
+            &nodes, &offset, &site, &derived_state)) {
+        goto out;
+    }
+    nodes_array = (PyArrayObject *) PyArray_FROM_OTF(nodes, NPY_INT32,
+            NPY_ARRAY_IN_ARRAY);
+    offset_array = (PyArrayObject *) PyArray_FROM_OTF(offset, NPY_UINT64,
+            NPY_ARRAY_IN_ARRAY);
+    site_array = (PyArrayObject *) PyArray_FROM_OTF(site, NPY_INT32,
+            NPY_ARRAY_IN_ARRAY);
+    derived_state_array = (PyArrayObject *) PyArray_FROM_OTF(derived_state, NPY_UINT8,
+            NPY_ARRAY_IN_ARRAY);
+    if (nodes_array == NULL || offset_array == NULL || site_array == NULL
+            || derived_state_array == NULL) {
+        goto out;
+    }
+    if (PyArray_NDIM(nodes_array) != 1 || PyArray_NDIM(offset_array) != 1
+            || PyArray_NDIM(site_array) != 1 || PyArray_NDIM(derived_state_array) != 1) {
+        PyErr_SetString(PyExc_ValueError, "Dim != 1");
+        goto out;
+    }
+    num_nodes = (size_t) PyArray_DIMS(nodes_array)[0];
+    num_mutations = (size_t) PyArray_DIMS(site_array)[0];
+    if ((size_t) PyArray_DIMS(offset_array)[0] != num_nodes + 1) {
+        PyErr_SetString(PyExc_ValueError, "offset must have num_nodes + 1 values");
+        goto out;
+    }
+    if ((size_t) PyArray_DIMS(derived_state_array)[0] != num_mutations) {
+        PyErr_SetString(PyExc_ValueError, "derived_state wrong size");
+        goto out;
+    }
+    node_data = (node_id_t *) PyArray_DATA(nodes_array);
+    offset_data = (uint64_t *) PyArray_DATA(offset_array);
+    site_data = (site_id_t *) PyArray_DATA(site_array);
+    derived_state_data = (allele_t *) PyArray_DATA(derived_state_array);
+    if (offset_data[0] != 0 || offset_data[num_nodes] != num_mutations) {
+        PyErr_SetString(PyExc_ValueError, "Bad offset array");
+        goto out;
+    }
+    for (j = 0; j < num_nodes; j++) {
+        if (offset_data[j] > offset_data[j + 1]) {
+            PyErr_SetString(PyExc_ValueError, "offset must be nondecreasing");
+            goto out;
+        }
+        if (node_data[j] < 0
+                || node_data[j] >= (node_id_t) self->tree_sequence_builder->num_nodes) {
+            PyErr_SetString(PyExc_ValueError, "node out of bounds");
+            goto out;
+        }
+    }
+    for (j = 0; j < num_mutations; j++) {
+        if (site_data[j] < 0
+                || site_data[j] >= (site_id_t) self->tree_sequence_builder->num_sites) {
+            PyErr_SetString(PyExc_ValueError, "site out of bounds");
+            goto out;
+        }
+        if (derived_state_data[j] > 1) {
+            PyErr_SetString(PyExc_ValueError, "derived_state must be 0 or 1");
+            goto out;
+        }
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    for (j = 0; j < num_nodes; j++) {
+        err = tree_sequence_builder_add_mutations(self->tree_sequence_builder,
+                node_data[j], (size_t) (offset_data[j + 1] - offset_data[j]),
+                site_data + offset_data[j], derived_state_data + offset_data[j]);
+        if (err < 0) {
+            break;
+        }
+    }
+    Py_END_ALLOW_THREADS
+
+    if (err < 0) {
+        handle_library_error(err);
+        goto out;
+    }
+    ret = Py_BuildValue("");
+out:
+    Py_XDECREF(nodes_array);
+    Py_XDECREF(offset_array);
+    Py_XDECREF(site_array);
+    Py_XDECREF(derived_state_array);
+    return ret;
+}
+
 static PyObject *
 TreeSequenceBuilder_restore_nodes(TreeSequenceBuilder *self, PyObject *args, PyObject *kwds)
 {
@@ -1098,6 +1570,36 @@ out:
     return ret;
 }
 
+static PyObject *
+TreeSequenceBuilder_get_num_pending_added_edges(TreeSequenceBuilder *self,
+        void *closure)
+{
+    PyObject *ret = NULL;
+
+    if (TreeSequenceBuilder_check_state(self) != 0) {
+        goto out;
+    }
+    ret = Py_BuildValue("k", (unsigned long)
+            self->tree_sequence_builder->pending.num_added);
+out:
+    return ret;
+}
+
+static PyObject *
+TreeSequenceBuilder_get_num_pending_removed_edges(TreeSequenceBuilder *self,
+        void *closure)
+{
+    PyObject *ret = NULL;
+
+    if (TreeSequenceBuilder_check_state(self) != 0) {
+        goto out;
+    }
+    ret = Py_BuildValue("k", (unsigned long)
+            self->tree_sequence_builder->pending.num_removed);
+out:
+    return ret;
+}
+
 static PyObject *
 TreeSequenceBuilder_get_num_sites(TreeSequenceBuilder *self, void *closure)
 {
@@ -1134,6 +1636,12 @@ static PyGetSetDef TreeSequenceBuilder_getsetters[] = {
         "The number of nodes."},
     {"num_edges", (getter) TreeSequenceBuilder_get_num_edges, NULL,
         "The number of edgess."},
+    {"num_pending_added_edges",
+        (getter) TreeSequenceBuilder_get_num_pending_added_edges, NULL,
+        "The number of edges added since the indexes were last frozen."},
+    {"num_pending_removed_edges",
+        (getter) TreeSequenceBuilder_get_num_pending_removed_edges, NULL,
+        "The number of edges removed since the indexes were last frozen."},
     {"num_sites", (getter) TreeSequenceBuilder_get_num_sites, NULL,
         "The total number of sites."},
     {"num_mutations", (getter) TreeSequenceBuilder_get_num_mutations, NULL,
@@ -1148,9 +1656,15 @@ static PyMethodDef TreeSequenceBuilder_methods[] = {
     {"add_path", (PyCFunction) TreeSequenceBuilder_add_path,
         METH_VARARGS|METH_KEYWORDS,
         "Updates the builder with the specified copy results for a given child."},
+    {"add_paths", (PyCFunction) TreeSequenceBuilder_add_paths,
+        METH_VARARGS|METH_KEYWORDS,
+        "Updates the builder with the copy results for many children at once."},
     {"add_mutations", (PyCFunction) TreeSequenceBuilder_add_mutations,
         METH_VARARGS|METH_KEYWORDS,
         "Updates the builder with mutations for a given node."},
+    {"add_mutations_bulk", (PyCFunction) TreeSequenceBuilder_add_mutations_bulk,
+        METH_VARARGS|METH_KEYWORDS,
+        "Updates the builder with the mutations for many nodes at once."},
     {"restore_nodes", (PyCFunction) TreeSequenceBuilder_restore_nodes,
         METH_VARARGS|METH_KEYWORDS,
         "Restores the nodes in this tree sequence builder."},
@@ -1245,15 +1759,18 @@ AncestorMatcher_init(AncestorMatcher *self, PyObject *args, PyObject *kwds)
     int ret = -1;
     int err;
     int extended_checks = 0;
-    static char *kwlist[] = {"tree_sequence_builder", "extended_checks", NULL};
+    int interval_labels = 0;
+    unsigned long traceback_block_size = TSI_DEFAULT_TRACEBACK_BLOCK_SIZE;
+    static char *kwlist[] = {"tree_sequence_builder", "extended_checks",
+        "traceback_block_size", "interval_labels", NULL};
     TreeSequenceBuilder *tree_sequence_builder = NULL;
     int flags = 0;
 
     self->ancestor_matcher = NULL;
     self->tree_sequence_builder = NULL;
-    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O!i", kwlist,
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O!i|ki", kwlist,
                 &TreeSequenceBuilderType, &tree_sequence_builder,
-                &extended_checks)) {
+                &extended_checks, &traceback_block_size, &interval_labels)) {
         goto out;
     }
     self->tree_sequence_builder = tree_sequence_builder;
@@ -1261,6 +1778,10 @@ AncestorMatcher_init(AncestorMatcher *self, PyObject *args, PyObject *kwds)
     if (TreeSequenceBuilder_check_state(self->tree_sequence_builder) != 0) {
         goto out;
     }
+    if (traceback_block_size == 0) {
+        PyErr_SetString(PyExc_ValueError, "traceback_block_size must be > 0");
+        goto out;
+    }
     self->ancestor_matcher = PyMem_Malloc(sizeof(ancestor_matcher_t));
     if (self->ancestor_matcher == NULL) {
         PyErr_NoMemory();
@@ -1269,8 +1790,12 @@ AncestorMatcher_init(AncestorMatcher *self, PyObject *args, PyObject *kwds)
     if (extended_checks) {
         flags = TSI_EXTENDED_CHECKS;
     }
+    if (interval_labels) {
+        flags |= TSI_INTERVAL_LABELS;
+    }
     err = ancestor_matcher_alloc(self->ancestor_matcher,
-            self->tree_sequence_builder->tree_sequence_builder, flags);
+            self->tree_sequence_builder->tree_sequence_builder,
+            (size_t) traceback_block_size, flags);
     if (err != 0) {
         handle_library_error(err);
         goto out;
@@ -1373,6 +1898,173 @@ out:
     return ret;
 }
 
+/* Matches each row of the specified haplotypes matrix over the corresponding
+ * [start, end) interval, and returns the paths in CSR form: the edges for
+ * row j are left/right/parent[offset[j]: offset[j + 1]]. All matches are
+ * performed in a single call without the GIL. */
+static PyObject *
+AncestorMatcher_find_paths(AncestorMatcher *self, PyObject *args, PyObject *kwds)
+{
+    int err = 0;
+    PyObject *ret = NULL;
+    static char *kwlist[] = {"haplotypes", "starts", "ends", NULL};
+    PyObject *haplotypes = NULL;
+    PyObject *starts = NULL;
+    PyObject *ends = NULL;
+    PyArrayObject *haplotypes_array = NULL;
+    PyArrayObject *starts_array = NULL;
+    PyArrayObject *ends_array = NULL;
+    PyArrayObject *match = NULL;
+    PyArrayObject *offset = NULL;
+    PyArrayObject *left = NULL;
+    PyArrayObject *right = NULL;
+    PyArrayObject *parent = NULL;
+    npy_intp *shape;
+    npy_intp dims[2];
+    size_t j, num_haplotypes, num_sites, num_edges, total_edges, max_edges;
+    site_id_t *start_data, *end_data;
+    site_id_t *ret_left, *ret_right;
+    node_id_t *ret_parent;
+    site_id_t *left_buffer = NULL;
+    site_id_t *right_buffer = NULL;
+    node_id_t *parent_buffer = NULL;
+    void *p;
+    allele_t *haplotype_data, *match_data;
+    uint64_t *offset_data;
+
+    if (AncestorMatcher_check_state(self) != 0) {
+        goto out;
+    }
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "OOO", kwlist,
+                &haplotypes, &starts, &ends)) {
+        goto out;
+    }
+    num_sites = self->ancestor_matcher->num_sites;
+    haplotypes_array = (PyArrayObject *) PyArray_FROM_OTF(haplotypes, NPY_UINT8,
+            NPY_ARRAY_IN_ARRAY);
+    if (haplotypes_array == NULL) {
+        goto out;
+    }
+    if (PyArray_NDIM(haplotypes_array) != 2) {
+        PyErr_SetString(PyExc_ValueError, "Dim != 2");
+        goto out;
+    }
+    shape = PyArray_DIMS(haplotypes_array);
+    if (shape[1] != (npy_intp) num_sites) {
+        PyErr_SetString(PyExc_ValueError, "Incorrect size for input haplotypes.");
+        goto out;
+    }
+    num_haplotypes = (size_t) shape[0];
+    starts_array = (PyArrayObject *) PyArray_FROM_OTF(starts, NPY_INT32,
+            NPY_ARRAY_IN_ARRAY);
+    ends_array = (PyArrayObject *) PyArray_FROM_OTF(ends, NPY_INT32,
+            NPY_ARRAY_IN_ARRAY);
+    if (starts_array == NULL || ends_array == NULL) {
+        goto out;
+    }
+    if (PyArray_NDIM(starts_array) != 1 || PyArray_NDIM(ends_array) != 1) {
+        PyErr_SetString(PyExc_ValueError, "Dim != 1");
+        goto out;
+    }
+    if (PyArray_DIMS(starts_array)[0] != (npy_intp) num_haplotypes
+            || PyArray_DIMS(ends_array)[0] != (npy_intp) num_haplotypes) {
+        PyErr_SetString(PyExc_ValueError,
+                "starts and ends must have one value per haplotype");
+        goto out;
+    }
+    start_data = (site_id_t *) PyArray_DATA(starts_array);
+    end_data = (site_id_t *) PyArray_DATA(ends_array);
+    for (j = 0; j < num_haplotypes; j++) {
+        if (start_data[j] < 0 || start_data[j] >= end_data[j]
+                || end_data[j] > (site_id_t) num_sites) {
+            PyErr_SetString(PyExc_ValueError, "Bad start/end interval");
+            goto out;
+        }
+    }
+    dims[0] = (npy_intp) num_haplotypes;
+    dims[1] = (npy_intp) num_sites;
+    match = (PyArrayObject *) PyArray_ZEROS(2, dims, NPY_UINT8, 0);
+    dims[0] = (npy_intp) num_haplotypes + 1;
+    offset = (PyArrayObject *) PyArray_SimpleNew(1, dims, NPY_UINT64);
+    if (match == NULL || offset == NULL) {
+        goto out;
+    }
+    haplotype_data = (allele_t *) PyArray_DATA(haplotypes_array);
+    match_data = (allele_t *) PyArray_DATA(match);
+    offset_data = (uint64_t *) PyArray_DATA(offset);
+
+    Py_BEGIN_ALLOW_THREADS
+    total_edges = 0;
+    max_edges = 0;
+    offset_data[0] = 0;
+    for (j = 0; j < num_haplotypes; j++) {
+        err = ancestor_matcher_find_path(self->ancestor_matcher,
+                start_data[j], end_data[j], haplotype_data + j * num_sites,
+                match_data + j * num_sites,
+                &num_edges, &ret_left, &ret_right, &ret_parent);
+        if (err != 0) {
+            break;
+        }
+        if (total_edges + num_edges > max_edges) {
+            max_edges = TSI_MAX(2 * max_edges, total_edges + num_edges);
+            err = TSI_ERR_NO_MEMORY;
+            p = realloc(left_buffer, max_edges * sizeof(*left_buffer));
+            if (p == NULL) {
+                break;
+            }
+            left_buffer = p;
+            p = realloc(right_buffer, max_edges * sizeof(*right_buffer));
+            if (p == NULL) {
+                break;
+            }
+            right_buffer = p;
+            p = realloc(parent_buffer, max_edges * sizeof(*parent_buffer));
+            if (p == NULL) {
+                break;
+            }
+            parent_buffer = p;
+            err = 0;
+        }
+        memcpy(left_buffer + total_edges, ret_left, num_edges * sizeof(*ret_left));
+        memcpy(right_buffer + total_edges, ret_right, num_edges * sizeof(*ret_right));
+        memcpy(parent_buffer + total_edges, ret_parent, num_edges * sizeof(*ret_parent));
+        total_edges += num_edges;
+        offset_data[j + 1] = (uint64_t) total_edges;
+    }
+    Py_END_ALLOW_THREADS
+    if (err != 0) {
+        handle_library_error(err);
+        goto out;
+    }
+    dims[0] = (npy_intp) total_edges;
+    left = (PyArrayObject *) PyArray_SimpleNew(1, dims, NPY_UINT32);
+    right = (PyArrayObject *) PyArray_SimpleNew(1, dims, NPY_UINT32);
+    parent = (PyArrayObject *) PyArray_SimpleNew(1, dims, NPY_INT32);
+    if (left == NULL || right == NULL || parent == NULL) {
+        goto out;
+    }
+    if (total_edges > 0) {
+        memcpy(PyArray_DATA(left), left_buffer, total_edges * sizeof(*left_buffer));
+        memcpy(PyArray_DATA(right), right_buffer, total_edges * sizeof(*right_buffer));
+        memcpy(PyArray_DATA(parent), parent_buffer,
+                total_edges * sizeof(*parent_buffer));
+    }
+    ret = Py_BuildValue("(OOOOO)", left, right, parent, offset, match);
+out:
+    tsi_safe_free(left_buffer);
+    tsi_safe_free(right_buffer);
+    tsi_safe_free(parent_buffer);
+    Py_XDECREF(haplotypes_array);
+    Py_XDECREF(starts_array);
+    Py_XDECREF(ends_array);
+    Py_XDECREF(match);
+    Py_XDECREF(offset);
+    Py_XDECREF(left);
+    Py_XDECREF(right);
+    Py_XDECREF(parent);
+    return ret;
+}
+
 static PyObject *
 AncestorMatcher_get_traceback(AncestorMatcher *self, PyObject *args)
 {
@@ -1468,6 +2160,10 @@ static PyMethodDef AncestorMatcher_methods[] = {
     {"find_path", (PyCFunction) AncestorMatcher_find_path,
         METH_VARARGS|METH_KEYWORDS,
         "Returns a best match path for the specified haplotype through the ancestors."},
+    {"find_paths", (PyCFunction) AncestorMatcher_find_paths,
+        METH_VARARGS|METH_KEYWORDS,
+        "Returns the best match paths for the rows of the specified haplotype "
+        "matrix in CSR form, along with the matched haplotypes."},
     {"get_traceback", (PyCFunction) AncestorMatcher_get_traceback,
         METH_VARARGS, "Returns the traceback likelihood dictionary at the specified site."},
     {NULL}  /* Sentinel */
@@ -1568,6 +2264,14 @@ init_tsinfer(void)
     }
     Py_INCREF(&AncestorBuilderType);
     PyModule_AddObject(module, "AncestorBuilder", (PyObject *) &AncestorBuilderType);
+    /* AncestorBuilderWorkspace type */
+    AncestorBuilderWorkspaceType.tp_new = PyType_GenericNew;
+    if (PyType_Ready(&AncestorBuilderWorkspaceType) < 0) {
+        INITERROR;
+    }
+    Py_INCREF(&AncestorBuilderWorkspaceType);
+    PyModule_AddObject(module, "AncestorBuilderWorkspace",
+            (PyObject *) &AncestorBuilderWorkspaceType);
     /* AncestorMatcher type */
     AncestorMatcherType.tp_new = PyType_GenericNew;
     if (PyType_Ready(&AncestorMatcherType) < 0) {
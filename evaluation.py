@@ -25,6 +25,7 @@ import colorama
 import msprime
 import tsinfer
 import tsinfer.cli as cli
+import _tsinfer
 
 
 # Set by the CLI.
@@ -1355,6 +1356,166 @@ def run_perfect_inference(args):
             assert np.any(ts.tables.nodes.time != inferred_ts.tables.nodes.time)
 
 
+def run_matcher_overhead(args):
+    """
+    Measures the per-sample time taken to match haplotypes over a short window
+    of sites as the number of nodes in the ancestors tree sequence increases.
+    Since the work done in each match is roughly constant, this measures the
+    fixed overhead per call to find_path.
+    """
+    MB = 10**6
+    num_points = 5
+    rng = random.Random()
+    if args.random_seed is not None:
+        rng.seed(args.random_seed)
+    results = []
+    for n in np.linspace(0, args.sample_size, num_points + 1)[1:].astype(int):
+        smc_ts = msprime.simulate(
+            sample_size=max(2, n), length=args.length * MB,
+            recombination_rate=args.recombination_rate,
+            mutation_rate=args.mutation_rate, Ne=10**4, model="smc_prime",
+            random_seed=rng.randint(1, 2**30))
+        sample_data = tsinfer.SampleData.from_tree_sequence(smc_ts)
+        ancestor_data = tsinfer.generate_ancestors(sample_data, engine=args.engine)
+        ancestors_ts = tsinfer.match_ancestors(
+            sample_data, ancestor_data, engine=args.engine)
+        sample_matcher = tsinfer.SampleMatcher(
+            sample_data, ancestors_ts, engine=args.engine)
+        matcher = sample_matcher.matcher[0]
+        match = sample_matcher.match[0]
+        num_sites = sample_matcher.num_sites
+        if num_sites == 0:
+            warnings.warn("Dropping simulation with no inference sites")
+            continue
+        window = min(args.window, num_sites)
+        haplotypes = [h for _, h in sample_data.haplotypes(inference_sites=True)]
+        num_matches = 0
+        before = time.perf_counter()
+        for _ in range(args.num_replicates):
+            for h in haplotypes:
+                start = rng.randint(0, num_sites - window)
+                matcher.find_path(h, start, start + window, match)
+                num_matches += 1
+        duration = time.perf_counter() - before
+        results.append({
+            "sample_size": n,
+            "num_nodes": ancestors_ts.num_nodes,
+            "num_edges": ancestors_ts.num_edges,
+            "num_sites": num_sites,
+            "window": window,
+            "time_per_match": duration / num_matches})
+        logging.info("n={} num_nodes={} time_per_match={}".format(
+            n, ancestors_ts.num_nodes, duration / num_matches))
+
+    df = pd.DataFrame(results)
+    print(df)
+    name_format = os.path.join(
+        args.destination_dir, "matcher-overhead_n={}_L={}_w={}_{{}}".format(
+            args.sample_size, args.length, args.window))
+    plt.plot(df.num_nodes, df.time_per_match * 10**6, marker="o")
+    plt.title("window = {} sites, reps={}".format(args.window, args.num_replicates))
+    plt.ylabel("Time per match (microseconds)")
+    plt.xlabel("Num nodes")
+    save_figure(name_format.format("time"))
+
+
+def run_add_sites_performance(args):
+    """
+    Measures the per-site time taken to add sites to the C AncestorBuilder
+    when all sites have the same frequency, as the number of distinct genotype
+    patterns increases. This is the worst case for finding duplicate patterns,
+    since every site must be checked against all patterns in its frequency class.
+    """
+    num_points = 5
+    rng = np.random.RandomState(args.random_seed)
+    n = args.sample_size
+    frequency = n // 2
+    results = []
+    for num_patterns in np.geomspace(1, args.num_sites, num_points).astype(int):
+        patterns = np.zeros((num_patterns, n), dtype=np.uint8)
+        for j in range(num_patterns):
+            patterns[j, rng.choice(n, frequency, replace=False)] = 1
+        G = patterns[rng.randint(0, num_patterns, args.num_sites)]
+        times = []
+        for _ in range(args.num_replicates):
+            builder = _tsinfer.AncestorBuilder(n, args.num_sites)
+            before = time.perf_counter()
+            for j in range(args.num_sites):
+                builder.add_site(j, frequency, G[j])
+            builder.ancestor_descriptors()
+            times.append(time.perf_counter() - before)
+        duration = min(times)
+        results.append({
+            "sample_size": n,
+            "num_sites": args.num_sites,
+            "num_patterns": num_patterns,
+            "num_ancestors": builder.num_ancestors,
+            "time_per_site": duration / args.num_sites})
+        logging.info("num_patterns={} time_per_site={}".format(
+            num_patterns, duration / args.num_sites))
+
+    df = pd.DataFrame(results)
+    print(df)
+    name_format = os.path.join(
+        args.destination_dir, "add-sites-performance_n={}_m={}_{{}}".format(
+            args.sample_size, args.num_sites))
+    plt.semilogx(df.num_patterns, df.time_per_site * 10**6, marker="o")
+    plt.title("n = {}, frequency = {}, sites = {}".format(n, frequency, args.num_sites))
+    plt.ylabel("Time per site (microseconds)")
+    plt.xlabel("Num distinct patterns")
+    save_figure(name_format.format("time"))
+
+
+def run_root_turnover(args):
+    """
+    Measures the time taken to match ancestors as the recombination rate
+    increases. Higher recombination rates give shorter ancestors, and so more
+    nonzero roots enter and leave the tree between adjacent sites during
+    the forwards matching pass.
+    """
+    MB = 10**6
+    num_points = 5
+    rng = random.Random()
+    if args.random_seed is not None:
+        rng.seed(args.random_seed)
+    results = []
+    for r in np.geomspace(
+            args.recombination_rate / 100, args.recombination_rate, num_points):
+        ts = msprime.simulate(
+            sample_size=args.sample_size, length=args.length * MB,
+            recombination_rate=r, mutation_rate=args.mutation_rate, Ne=10**4,
+            random_seed=rng.randint(1, 2**30))
+        sample_data = tsinfer.SampleData.from_tree_sequence(ts)
+        ancestor_data = tsinfer.generate_ancestors(sample_data, engine=args.engine)
+        times = []
+        for _ in range(args.num_replicates):
+            before = time.perf_counter()
+            ancestors_ts = tsinfer.match_ancestors(
+                sample_data, ancestor_data, engine=args.engine)
+            times.append(time.perf_counter() - before)
+        duration = min(times)
+        results.append({
+            "recombination_rate": r,
+            "num_trees": ts.num_trees,
+            "num_ancestors": ancestor_data.num_ancestors,
+            "num_edges": ancestors_ts.num_edges,
+            "time": duration,
+            "time_per_ancestor": duration / ancestor_data.num_ancestors})
+        logging.info("r={} num_edges={} time={}".format(
+            r, ancestors_ts.num_edges, duration))
+
+    df = pd.DataFrame(results)
+    print(df)
+    name_format = os.path.join(
+        args.destination_dir, "root-turnover_n={}_L={}_{{}}".format(
+            args.sample_size, args.length))
+    plt.semilogx(df.recombination_rate, df.time_per_ancestor * 10**6, marker="o")
+    plt.title("n = {}, L = {}MB".format(args.sample_size, args.length))
+    plt.ylabel("Time per ancestor (microseconds)")
+    plt.xlabel("Recombination rate")
+    save_figure(name_format.format("time"))
+
+
 def setup_logging(args):
     log_level = "WARN"
     if args.verbosity > 0:
@@ -1589,6 +1750,60 @@ if __name__ == "__main__":
     parser.add_argument("--random-seed", "-s", type=int, default=None)
     parser.add_argument("--destination-dir", "-d", default="")
 
+    parser = subparsers.add_parser(
+        "matcher-overhead", aliases=["mo"],
+        help="Plots the per-sample matching overhead against the number of nodes.")
+    cli.add_logging_arguments(parser)
+    parser.set_defaults(runner=run_matcher_overhead)
+    parser.add_argument("--sample-size", "-n", type=int, default=100)
+    parser.add_argument(
+        "--length", "-l", type=float, default=1, help="Sequence length in MB")
+    parser.add_argument(
+        "--recombination-rate", "-r", type=float, default=1e-8,
+        help="Recombination rate")
+    parser.add_argument(
+        "--mutation-rate", "-u", type=float, default=1e-8,
+        help="Mutation rate")
+    parser.add_argument(
+        "--window", "-w", type=int, default=10,
+        help="The number of sites to match each haplotype over.")
+    parser.add_argument("--num-replicates", "-R", type=int, default=10)
+    parser.add_argument("--random-seed", "-s", type=int, default=None)
+    parser.add_argument("--destination-dir", "-d", default="")
+
+    parser = subparsers.add_parser(
+        "add-sites-performance", aliases=["asp"],
+        help=(
+            "Plots the time taken to add sites to the ancestor builder against "
+            "the number of distinct patterns with the same frequency."))
+    cli.add_logging_arguments(parser)
+    parser.set_defaults(runner=run_add_sites_performance)
+    parser.add_argument("--sample-size", "-n", type=int, default=1000)
+    parser.add_argument("--num-sites", "-m", type=int, default=10000)
+    parser.add_argument("--num-replicates", "-R", type=int, default=3)
+    parser.add_argument("--random-seed", "-s", type=int, default=None)
+    parser.add_argument("--destination-dir", "-d", default="")
+
+    parser = subparsers.add_parser(
+        "root-turnover", aliases=["rt"],
+        help=(
+            "Plots the time taken to match ancestors against the recombination "
+            "rate."))
+    cli.add_logging_arguments(parser)
+    parser.set_defaults(runner=run_root_turnover)
+    parser.add_argument("--sample-size", "-n", type=int, default=100)
+    parser.add_argument(
+        "--length", "-l", type=float, default=1, help="Sequence length in MB")
+    parser.add_argument(
+        "--recombination-rate", "-r", type=float, default=1e-7,
+        help="The largest recombination rate")
+    parser.add_argument(
+        "--mutation-rate", "-u", type=float, default=1e-8,
+        help="Mutation rate")
+    parser.add_argument("--num-replicates", "-R", type=int, default=3)
+    parser.add_argument("--random-seed", "-s", type=int, default=None)
+    parser.add_argument("--destination-dir", "-d", default="")
+
     args = top_parser.parse_args()
     cli.setup_logging(args)
     _output_format = args.output_format
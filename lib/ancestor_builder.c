@@ -34,6 +34,9 @@ typedef struct {
 } site_equality_t;
 
 
+#define NUM_WORDS(num_samples) (((num_samples) + 63) / 64)
+#define SAMPLE_BIT(j) (((uint64_t) 1) << (63 - ((j) % 64)))
+
 static int
 cmp_pattern_map(const void *a, const void *b) {
     const pattern_map_t *ia = (pattern_map_t const *) a;
@@ -42,12 +45,143 @@ cmp_pattern_map(const void *a, const void *b) {
     return ret;
 }
 
+/* Compare the packed genotypes word by word. Because the first sample is
+ * stored in the most significant bit this gives the same ordering as
+ * cmp_pattern_map does for the unpacked genotypes. */
+static int
+cmp_packed_pattern_map(const void *a, const void *b) {
+    const pattern_map_t *ia = (pattern_map_t const *) a;
+    const pattern_map_t *ib = (pattern_map_t const *) b;
+    const size_t num_words = NUM_WORDS(ia->num_samples);
+    size_t j;
+    int ret = 0;
+
+    for (j = 0; j < num_words; j++) {
+        if (ia->packed_genotypes[j] != ib->packed_genotypes[j]) {
+            ret = ia->packed_genotypes[j] < ib->packed_genotypes[j] ? -1 : 1;
+            break;
+        }
+    }
+    return ret;
+}
+
+/* Sparse patterns all have the same frequency within a tree. If the first
+ * difference between two carrier lists is a[j] < b[j], then sample a[j]
+ * carries the derived state in a but not in b, and so a sorts after b when
+ * comparing the dense genotypes. We therefore reverse the comparison so that
+ * the order matches cmp_pattern_map. */
+static int
+cmp_sparse_pattern_map(const void *a, const void *b) {
+    const pattern_map_t *ia = (pattern_map_t const *) a;
+    const pattern_map_t *ib = (pattern_map_t const *) b;
+    size_t j;
+    int ret = 0;
+
+    assert(ia->frequency == ib->frequency);
+    for (j = 0; j < ia->frequency; j++) {
+        if (ia->carriers[j] != ib->carriers[j]) {
+            ret = ia->carriers[j] < ib->carriers[j] ? 1 : -1;
+            break;
+        }
+    }
+    return ret;
+}
+
+static inline size_t
+popcount(const uint64_t *restrict words, size_t num_words)
+{
+    size_t j;
+    size_t count = 0;
+
+    for (j = 0; j < num_words; j++) {
+        count += (size_t) __builtin_popcountll(words[j]);
+    }
+    return count;
+}
+
+/* Returns the number of ones in the intersection of the specified words */
+static inline size_t
+popcount_and(const uint64_t *restrict a, const uint64_t *restrict b, size_t num_words)
+{
+    size_t j;
+    size_t count = 0;
+
+    for (j = 0; j < num_words; j++) {
+        count += (size_t) __builtin_popcountll(a[j] & b[j]);
+    }
+    return count;
+}
+
+/* Returns the first site reached from site l (inclusive) moving in the specified
+ * direction that has frequency greater than the specified value. If there is
+ * no such site, return num_sites when moving forwards and -1 when moving
+ * backwards. The frequency tree stores the maximum frequency of the sites
+ * below each node, so this takes O(log num_sites) time. */
+static inline int64_t
+ancestor_builder_next_site(ancestor_builder_t *self, int64_t l, int direction,
+        size_t frequency)
+{
+    const size_t *restrict tree = self->frequency_tree;
+    const size_t num_leaves = self->num_tree_leaves;
+    size_t u, j;
+
+    /* Nearby sites usually qualify when the frequency is low, so look at
+     * the next few leaves directly before using the tree. */
+    for (j = 0; j < 16; j++) {
+        if (l < 0 || l >= (int64_t) self->num_sites) {
+            return direction > 0 ? (int64_t) self->num_sites : -1;
+        }
+        if (tree[num_leaves + (size_t) l] > frequency) {
+            return l;
+        }
+        l += direction;
+    }
+    if (l < 0 || l >= (int64_t) self->num_sites) {
+        return direction > 0 ? (int64_t) self->num_sites : -1;
+    }
+    u = num_leaves + (size_t) l;
+    if (tree[u] > frequency) {
+        return l;
+    }
+    /* Go up until the subtree next to u in this direction contains a site
+     * with high enough frequency */
+    while (true) {
+        if (u == 1) {
+            return direction > 0 ? (int64_t) self->num_sites : -1;
+        }
+        if (direction > 0 && (u & 1) == 0 && tree[u + 1] > frequency) {
+            u++;
+            break;
+        }
+        if (direction < 0 && (u & 1) == 1 && tree[u - 1] > frequency) {
+            u--;
+            break;
+        }
+        u >>= 1;
+    }
+    /* Go down to the nearest leaf with high enough frequency */
+    while (u < num_leaves) {
+        if (direction > 0) {
+            u = 2 * u;
+            if (tree[u] <= frequency) {
+                u++;
+            }
+        } else {
+            u = 2 * u + 1;
+            if (tree[u] <= frequency) {
+                u--;
+            }
+        }
+    }
+    return (int64_t) (u - num_leaves);
+}
+
 int
 ancestor_builder_alloc(ancestor_builder_t *self, size_t num_samples, size_t num_sites,
         int flags)
 {
     int ret = 0;
-    size_t j;
+    size_t j, num_buckets;
     // TODO error checking
     //
     assert(num_samples > 1);
@@ -57,12 +191,35 @@ ancestor_builder_alloc(ancestor_builder_t *self, size_t num_samples, size_t num_
     memset(self, 0, sizeof(ancestor_builder_t));
     self->num_samples = num_samples;
     self->num_sites = num_sites;
+    self->num_words = NUM_WORDS(num_samples);
+    /* Store sites as carrier lists when this takes less space than the
+     * dense genotypes. */
+    self->max_sparse_frequency = num_samples / 64;
+    if (flags & TSI_BITPACK_GENOTYPES) {
+        self->max_sparse_frequency = 0;
+    }
     self->flags = flags;
     self->sites = calloc(num_sites, sizeof(site_t));
     self->frequency_map = calloc(num_samples + 1, sizeof(avl_tree_t));
     self->descriptors = calloc(num_sites, sizeof(ancestor_descriptor_t));
+    self->packed_genotypes_buffer = malloc(self->num_words * sizeof(uint64_t));
+    self->carriers_buffer = malloc(num_samples * sizeof(node_id_t));
+    /* There are at most num_sites patterns, so keep the load factor <= 1/2 */
+    num_buckets = 1;
+    while (num_buckets < 2 * num_sites) {
+        num_buckets *= 2;
+    }
+    self->pattern_table_mask = num_buckets - 1;
+    self->pattern_table = calloc(num_buckets, sizeof(pattern_map_t *));
+    self->num_tree_leaves = 1;
+    while (self->num_tree_leaves < num_sites) {
+        self->num_tree_leaves *= 2;
+    }
+    self->frequency_tree = calloc(2 * self->num_tree_leaves, sizeof(size_t));
     if (self->sites == NULL || self->frequency_map == NULL
-            || self->descriptors == NULL) {
+            || self->descriptors == NULL || self->packed_genotypes_buffer == NULL
+            || self->carriers_buffer == NULL || self->pattern_table == NULL
+            || self->frequency_tree == NULL) {
         ret = TSI_ERR_NO_MEMORY;
         goto out;
     }
@@ -71,7 +228,13 @@ ancestor_builder_alloc(ancestor_builder_t *self, size_t num_samples, size_t num_
         goto out;
     }
     for (j = 0; j < num_samples + 1; j++) {
-        avl_init_tree(&self->frequency_map[j], cmp_pattern_map, NULL);
+        if (self->flags & TSI_BITPACK_GENOTYPES) {
+            avl_init_tree(&self->frequency_map[j], cmp_packed_pattern_map, NULL);
+        } else if (j <= self->max_sparse_frequency) {
+            avl_init_tree(&self->frequency_map[j], cmp_sparse_pattern_map, NULL);
+        } else {
+            avl_init_tree(&self->frequency_map[j], cmp_pattern_map, NULL);
+        }
     }
 out:
     return ret;
@@ -83,17 +246,60 @@ ancestor_builder_free(ancestor_builder_t *self)
     tsi_safe_free(self->sites);
     tsi_safe_free(self->frequency_map);
     tsi_safe_free(self->descriptors);
+    tsi_safe_free(self->packed_genotypes_buffer);
+    tsi_safe_free(self->carriers_buffer);
+    tsi_safe_free(self->pattern_table);
+    tsi_safe_free(self->frequency_tree);
     block_allocator_free(&self->allocator);
     return 0;
 }
 
+int
+ancestor_builder_workspace_alloc(ancestor_builder_workspace_t *self, size_t num_samples)
+{
+    int ret = 0;
+
+    memset(self, 0, sizeof(ancestor_builder_workspace_t));
+    self->num_samples = num_samples;
+    self->num_words = NUM_WORDS(num_samples);
+    self->sample_set = malloc(num_samples * sizeof(node_id_t));
+    self->genotypes = malloc(num_samples * sizeof(allele_t));
+    self->disagree = malloc(num_samples * sizeof(bool));
+    self->sample_set_mask = malloc(self->num_words * sizeof(uint64_t));
+    self->disagree_mask = malloc(self->num_words * sizeof(uint64_t));
+    if (self->sample_set == NULL || self->genotypes == NULL || self->disagree == NULL
+            || self->sample_set_mask == NULL || self->disagree_mask == NULL) {
+        ret = TSI_ERR_NO_MEMORY;
+        goto out;
+    }
+out:
+    return ret;
+}
+
+int
+ancestor_builder_workspace_free(ancestor_builder_workspace_t *self)
+{
+    tsi_safe_free(self->sample_set);
+    tsi_safe_free(self->genotypes);
+    tsi_safe_free(self->disagree);
+    tsi_safe_free(self->sample_set_mask);
+    tsi_safe_free(self->disagree_mask);
+    return 0;
+}
+
 static inline void
 ancestor_builder_get_consistent_samples(ancestor_builder_t *self, site_id_t site,
         node_id_t *samples, size_t *num_samples)
 {
     node_id_t j, k;
-    allele_t *restrict genotypes = self->sites[site].genotypes;
+    const site_t *site_ptr = &self->sites[site];
+    allele_t *restrict genotypes = site_ptr->genotypes;
 
+    if (site_ptr->carriers != NULL) {
+        memcpy(samples, site_ptr->carriers, site_ptr->frequency * sizeof(node_id_t));
+        *num_samples = site_ptr->frequency;
+        return;
+    }
     k = 0;
     for (j = 0; j < (node_id_t) self->num_samples; j++) {
         if (genotypes[j] == 1) {
@@ -104,82 +310,151 @@ ancestor_builder_get_consistent_samples(ancestor_builder_t *self, site_id_t site
     *num_samples = (size_t) k;
 }
 
+/* Returns the first index k >= start such that values[k] >= x, searching
+ * exponentially outwards from start. This makes the intersection of a short
+ * list with a long one cost O(short * log(long / short)). */
+static inline size_t
+gallop_search(const node_id_t *restrict values, size_t start, size_t n, node_id_t x)
+{
+    size_t lo = start;
+    size_t step = 1;
+    size_t hi, mid;
+
+    while (lo + step < n && values[lo + step] < x) {
+        lo += step;
+        step *= 2;
+    }
+    hi = TSI_MIN(lo + step, n);
+    /* Invariant: values[k] < x for start <= k < lo, and values[k] >= x for k >= hi */
+    while (lo < hi) {
+        mid = lo + (hi - lo) / 2;
+        if (values[mid] < x) {
+            lo = mid + 1;
+        } else {
+            hi = mid;
+        }
+    }
+    return lo;
+}
+
+/* Returns the number of the specified sorted samples that carry the derived
+ * state at the specified site. If sample_genotypes is not NULL, the genotype
+ * for samples[j] is also stored in sample_genotypes[j]. For sparse sites this
+ * is a sorted intersection of the samples with the carriers. */
+static inline size_t
+ancestor_builder_get_sample_genotypes(ancestor_builder_t *self, site_id_t site,
+        const node_id_t *restrict samples, size_t num_samples,
+        allele_t *restrict sample_genotypes)
+{
+    size_t j, k, ones;
+    allele_t g;
+    const site_t *site_ptr = &self->sites[site];
+    const allele_t *restrict genotypes = site_ptr->genotypes;
+    const node_id_t *restrict carriers = site_ptr->carriers;
+    const size_t num_carriers = site_ptr->frequency;
+
+    ones = 0;
+    if (carriers == NULL) {
+        for (j = 0; j < num_samples; j++) {
+            g = genotypes[samples[j]];
+            ones += (size_t) g;
+            if (sample_genotypes != NULL) {
+                sample_genotypes[j] = g;
+            }
+        }
+    } else {
+        k = 0;
+        for (j = 0; j < num_samples; j++) {
+            k = gallop_search(carriers, k, num_carriers, samples[j]);
+            g = (allele_t) (k < num_carriers && carriers[k] == samples[j]);
+            ones += (size_t) g;
+            if (sample_genotypes != NULL) {
+                sample_genotypes[j] = g;
+            }
+        }
+    }
+    return ones;
+}
+
 static int
 ancestor_builder_compute_ancestral_states(ancestor_builder_t *self,
         int direction, site_id_t focal_site, allele_t *ancestor,
-        node_id_t *restrict sample_set, bool *restrict disagree,
-        site_id_t *last_site_ret)
+        node_id_t *restrict sample_set, allele_t *restrict genotypes,
+        bool *restrict disagree, site_id_t *last_site_ret)
 {
     int ret = 0;
     site_id_t last_site = focal_site;
-    int64_t l;
-    node_id_t u;
+    int64_t l, next;
     size_t j, ones, zeros, tmp_size, sample_set_size;
     size_t focal_site_frequency = self->sites[focal_site].frequency;
     size_t min_sample_set_size = focal_site_frequency / 2;
     const site_t *restrict sites = self->sites;
     const size_t num_sites = self->num_sites;
-    const allele_t *restrict genotypes;
     allele_t consensus;
 
+    /* The sample set is kept sorted, and disagree[j] records whether
+     * sample_set[j] disagreed with the consensus at the previous site. */
     ancestor_builder_get_consistent_samples(self, focal_site,
             sample_set, &sample_set_size);
     assert(sample_set_size == focal_site_frequency);
-    memset(disagree, 0, self->num_samples * sizeof(*disagree));
+    memset(disagree, 0, sample_set_size * sizeof(*disagree));
 
     /* printf("site=%d, direction=%d\n", (int) focal_site, direction); */
-    for (l = focal_site + direction; l >= 0 && l < (int64_t) num_sites; l += direction) {
+    l = focal_site + direction;
+    while (l >= 0 && l < (int64_t) num_sites) {
+        if (sites[l].frequency <= focal_site_frequency) {
+            /* Jump to the next site with higher frequency than the focal site.
+             * The sites we skip over are all zero in the ancestor. */
+            next = ancestor_builder_next_site(self, l, direction, focal_site_frequency);
+            if (direction > 0) {
+                memset(ancestor + l, 0, (size_t) (next - l) * sizeof(allele_t));
+            } else {
+                memset(ancestor + next + 1, 0, (size_t) (l - next) * sizeof(allele_t));
+            }
+            if (next < 0 || next >= (int64_t) num_sites) {
+                last_site = direction > 0 ? (site_id_t) num_sites - 1 : 0;
+                break;
+            }
+            l = next;
+        }
         /* printf("\tl = %d\n", l); */
         ancestor[l] = 0;
         last_site = (site_id_t) l;
-        if (sites[l].frequency > focal_site_frequency) {
+        /* printf("\t%d\t%d:", l, (int) sample_set_size); */
+        /* for (j = 0; j < sample_set_size; j++) { */
+        /*     printf("%d, ", sample_set[j]); */
+        /* } */
 
-            /* printf("\t%d\t%d:", l, (int) sample_set_size); */
-            /* for (j = 0; j < sample_set_size; j++) { */
-            /*     printf("%d, ", sample_set[j]); */
-            /* } */
-
-            genotypes = self->sites[l].genotypes;
-            ones = 0;
-            for (j = 0; j < sample_set_size; j++) {
-                ones += genotypes[sample_set[j]];
-            }
-            zeros = sample_set_size - ones;
-            consensus = 0;
-            if (ones >= zeros) {
-                consensus = 1;
-            }
-            /* printf("\t:ones=%d, consensus=%d\n", (int) ones, consensus); */
-            for (j = 0; j < sample_set_size; j++) {
-                u = sample_set[j];
-                if (disagree[u] && genotypes[u] != consensus) {
-                    /* This sample has disagreed with consensus twice in a row,
-                     * so remove it */
-                    /* printf("\t\tremoving %d\n", sample_set[j]); */
-                    sample_set[j] = -1;
-                }
-            }
-            /* Repack the sample set */
-            tmp_size = 0;
-            for (j = 0; j < sample_set_size; j++) {
-                if (sample_set[j] != -1) {
-                    sample_set[tmp_size] = sample_set[j];
-                    tmp_size++;
-                }
-            }
-            sample_set_size = tmp_size;
-            if (sample_set_size <= min_sample_set_size) {
-                /* printf("BREAK\n"); */
-                break;
-            }
-            ancestor[l] = consensus;
-            /* For the remaining sample set, set the disagree flags based
-             * on whether they agree with the consensus for this site. */
-            for (j = 0; j < sample_set_size; j++) {
-                u = sample_set[j];
-                disagree[u] = genotypes[u] != consensus;
+        ones = ancestor_builder_get_sample_genotypes(self, (site_id_t) l,
+                sample_set, sample_set_size, genotypes);
+        zeros = sample_set_size - ones;
+        consensus = 0;
+        if (ones >= zeros) {
+            consensus = 1;
+        }
+        /* printf("\t:ones=%d, consensus=%d\n", (int) ones, consensus); */
+        /* Remove samples that have disagreed with consensus twice in a row,
+         * and repack the sample set. */
+        tmp_size = 0;
+        for (j = 0; j < sample_set_size; j++) {
+            if (!(disagree[j] && genotypes[j] != consensus)) {
+                sample_set[tmp_size] = sample_set[j];
+                genotypes[tmp_size] = genotypes[j];
+                tmp_size++;
             }
         }
+        sample_set_size = tmp_size;
+        if (sample_set_size <= min_sample_set_size) {
+            /* printf("BREAK\n"); */
+            break;
+        }
+        ancestor[l] = consensus;
+        /* For the remaining sample set, set the disagree flags based
+         * on whether they agree with the consensus for this site. */
+        for (j = 0; j < sample_set_size; j++) {
+            disagree[j] = genotypes[j] != consensus;
+        }
+        l += direction;
     }
     *last_site_ret = last_site;
     return ret;
@@ -191,10 +466,8 @@ ancestor_builder_compute_between_focal_sites(ancestor_builder_t *self,
         allele_t *ancestor, node_id_t *sample_set)
 {
     int ret = 0;
-    site_id_t l;
-    size_t j, k, ones, zeros, sample_set_size, focal_site_frequency;
-    const site_t *restrict sites = self->sites;
-    const allele_t *restrict genotypes;
+    int64_t l, end;
+    size_t j, ones, zeros, sample_set_size, focal_site_frequency;
 
     assert(num_focal_sites > 0);
     ancestor_builder_get_consistent_samples(self, focal_sites[0],
@@ -205,45 +478,193 @@ ancestor_builder_compute_between_focal_sites(ancestor_builder_t *self,
     ancestor[focal_sites[0]] = 1;
     for (j = 1; j < num_focal_sites; j++) {
         ancestor[focal_sites[j]] = 1;
-        for (l = focal_sites[j - 1] + 1; l < focal_sites[j]; l++) {
-            ancestor[l] = 0;
-            if (sites[l].frequency > focal_site_frequency) {
-                /* printf("\t%d\t%d:", l, (int) sample_set_size); */
-                /* for (k = 0; k < sample_set_size; k++) { */
-                /*     printf("%d, ", sample_set[k]); */
-                /* } */
-                genotypes = self->sites[l].genotypes;
-                ones = 0;
-                for (k = 0; k < sample_set_size; k++) {
-                    ones += genotypes[sample_set[k]];
-                }
-                zeros = sample_set_size - ones;
-                if (ones >= zeros) {
-                    ancestor[l] = 1;
-                }
+        l = focal_sites[j - 1] + 1;
+        end = focal_sites[j];
+        memset(ancestor + l, 0, (size_t) (end - l) * sizeof(allele_t));
+        for (l = ancestor_builder_next_site(self, l, +1, focal_site_frequency);
+                l < end;
+                l = ancestor_builder_next_site(self, l + 1, +1, focal_site_frequency)) {
+            ones = ancestor_builder_get_sample_genotypes(self, (site_id_t) l,
+                    sample_set, sample_set_size, NULL);
+            zeros = sample_set_size - ones;
+            if (ones >= zeros) {
+                ancestor[l] = 1;
             }
         }
     }
     return ret;
 }
 
-/* Build the ancestors for sites in the specified focal sites */
-int
-ancestor_builder_make_ancestor(ancestor_builder_t *self, size_t num_focal_sites,
-        site_id_t *focal_sites, site_id_t *ret_start, site_id_t *ret_end,
+/* Equivalent to ancestor_builder_compute_ancestral_states for bitpacked
+ * genotypes. The sample set and disagree flags are stored as bitmasks
+ * and the consensus computed using popcounts. */
+static int
+ancestor_builder_compute_ancestral_states_packed(ancestor_builder_t *self,
+        int direction, site_id_t focal_site, allele_t *ancestor,
+        uint64_t *restrict sample_set, uint64_t *restrict disagree,
+        site_id_t *last_site_ret)
+{
+    int ret = 0;
+    site_id_t last_site = focal_site;
+    int64_t l, next;
+    size_t k, ones, zeros, sample_set_size;
+    size_t focal_site_frequency = self->sites[focal_site].frequency;
+    size_t min_sample_set_size = focal_site_frequency / 2;
+    const site_t *restrict sites = self->sites;
+    const size_t num_sites = self->num_sites;
+    const size_t num_words = self->num_words;
+    const uint64_t *restrict genotypes;
+    uint64_t consensus_mask, differs;
+    allele_t consensus;
+
+    memcpy(sample_set, sites[focal_site].packed_genotypes,
+            num_words * sizeof(*sample_set));
+    sample_set_size = focal_site_frequency;
+    assert(popcount(sample_set, num_words) == focal_site_frequency);
+    memset(disagree, 0, num_words * sizeof(*disagree));
+
+    l = focal_site + direction;
+    while (l >= 0 && l < (int64_t) num_sites) {
+        if (sites[l].frequency <= focal_site_frequency) {
+            next = ancestor_builder_next_site(self, l, direction, focal_site_frequency);
+            if (direction > 0) {
+                memset(ancestor + l, 0, (size_t) (next - l) * sizeof(allele_t));
+            } else {
+                memset(ancestor + next + 1, 0, (size_t) (l - next) * sizeof(allele_t));
+            }
+            if (next < 0 || next >= (int64_t) num_sites) {
+                last_site = direction > 0 ? (site_id_t) num_sites - 1 : 0;
+                break;
+            }
+            l = next;
+        }
+        ancestor[l] = 0;
+        last_site = (site_id_t) l;
+        genotypes = sites[l].packed_genotypes;
+        ones = popcount_and(sample_set, genotypes, num_words);
+        zeros = sample_set_size - ones;
+        consensus = 0;
+        consensus_mask = 0;
+        if (ones >= zeros) {
+            consensus = 1;
+            consensus_mask = ~((uint64_t) 0);
+        }
+        /* Remove samples that have disagreed with consensus twice in a row */
+        for (k = 0; k < num_words; k++) {
+            differs = genotypes[k] ^ consensus_mask;
+            sample_set[k] &= ~(disagree[k] & differs);
+        }
+        sample_set_size = popcount(sample_set, num_words);
+        if (sample_set_size <= min_sample_set_size) {
+            break;
+        }
+        ancestor[l] = consensus;
+        for (k = 0; k < num_words; k++) {
+            disagree[k] = sample_set[k] & (genotypes[k] ^ consensus_mask);
+        }
+        l += direction;
+    }
+    *last_site_ret = last_site;
+    return ret;
+}
+
+/* Equivalent to ancestor_builder_compute_between_focal_sites for bitpacked
+ * genotypes. */
+static int
+ancestor_builder_compute_between_focal_sites_packed(ancestor_builder_t *self,
+        size_t num_focal_sites, site_id_t *focal_sites,
         allele_t *ancestor)
+{
+    int ret = 0;
+    int64_t l, end;
+    size_t j, ones, zeros, focal_site_frequency;
+    const site_t *restrict sites = self->sites;
+    const uint64_t *restrict sample_set;
+
+    assert(num_focal_sites > 0);
+    sample_set = sites[focal_sites[0]].packed_genotypes;
+    focal_site_frequency = sites[focal_sites[0]].frequency;
+
+    ancestor[focal_sites[0]] = 1;
+    for (j = 1; j < num_focal_sites; j++) {
+        ancestor[focal_sites[j]] = 1;
+        l = focal_sites[j - 1] + 1;
+        end = focal_sites[j];
+        memset(ancestor + l, 0, (size_t) (end - l) * sizeof(allele_t));
+        for (l = ancestor_builder_next_site(self, l, +1, focal_site_frequency);
+                l < end;
+                l = ancestor_builder_next_site(self, l + 1, +1, focal_site_frequency)) {
+            ones = popcount_and(sample_set, sites[l].packed_genotypes,
+                    self->num_words);
+            zeros = focal_site_frequency - ones;
+            if (ones >= zeros) {
+                ancestor[l] = 1;
+            }
+        }
+    }
+    return ret;
+}
+
+static int
+ancestor_builder_make_ancestor_packed(ancestor_builder_t *self,
+        ancestor_builder_workspace_t *workspace,
+        size_t num_focal_sites, site_id_t *focal_sites, site_id_t *ret_start,
+        site_id_t *ret_end, allele_t *ancestor)
 {
     int ret = 0;
     site_id_t focal_site, last_site;
-    node_id_t *sample_set = malloc(self->num_samples * sizeof(node_id_t));
-    bool *restrict disagree = calloc(self->num_samples, sizeof(*disagree));
 
-    if (sample_set == NULL || disagree == NULL) {
-        ret = TSI_ERR_NO_MEMORY;
+    ret = ancestor_builder_compute_between_focal_sites_packed(self,
+            num_focal_sites, focal_sites, ancestor);
+    if (ret != 0) {
         goto out;
     }
+    focal_site = focal_sites[num_focal_sites - 1];
+    ret = ancestor_builder_compute_ancestral_states_packed(self,
+            +1, focal_site, ancestor, workspace->sample_set_mask,
+            workspace->disagree_mask, &last_site);
+    if (ret != 0) {
+        goto out;
+    }
+    assert(ancestor[last_site] != -1);
+    *ret_end = last_site + 1;
+
+    focal_site = focal_sites[0];
+    ret = ancestor_builder_compute_ancestral_states_packed(self,
+            -1, focal_site, ancestor, workspace->sample_set_mask,
+            workspace->disagree_mask, &last_site);
+    if (ret != 0) {
+        goto out;
+    }
+    assert(ancestor[last_site] != -1);
+    *ret_start = last_site;
+out:
+    return ret;
+}
+
+/* Build the ancestors for sites in the specified focal sites, using the
+ * scratch memory in the specified workspace. */
+int
+ancestor_builder_make_ancestor(ancestor_builder_t *self,
+        ancestor_builder_workspace_t *workspace,
+        size_t num_focal_sites, site_id_t *focal_sites, site_id_t *ret_start,
+        site_id_t *ret_end, allele_t *ancestor)
+{
+    int ret = 0;
+    site_id_t focal_site, last_site;
+    node_id_t *sample_set = workspace->sample_set;
+    allele_t *genotypes = workspace->genotypes;
+    bool *restrict disagree = workspace->disagree;
+
+    assert(workspace->num_samples == self->num_samples);
     memset(ancestor, 0xff, self->num_sites * sizeof(*ancestor));
 
+    if (self->flags & TSI_BITPACK_GENOTYPES) {
+        ret = ancestor_builder_make_ancestor_packed(self, workspace,
+                num_focal_sites, focal_sites, ret_start, ret_end, ancestor);
+        goto out;
+    }
+
     ret = ancestor_builder_compute_between_focal_sites(self,
             num_focal_sites, focal_sites, ancestor, sample_set);
     if (ret != 0) {
@@ -252,7 +673,7 @@ ancestor_builder_make_ancestor(ancestor_builder_t *self, size_t num_focal_sites,
 
     focal_site = focal_sites[num_focal_sites - 1];
     ret = ancestor_builder_compute_ancestral_states(self,
-            +1, focal_site, ancestor, sample_set, disagree, &last_site);
+            +1, focal_site, ancestor, sample_set, genotypes, disagree, &last_site);
     if (ret != 0) {
         goto out;
     }
@@ -261,73 +682,270 @@ ancestor_builder_make_ancestor(ancestor_builder_t *self, size_t num_focal_sites,
 
     focal_site = focal_sites[0];
     ret = ancestor_builder_compute_ancestral_states(self,
-            -1, focal_site, ancestor, sample_set, disagree, &last_site);
+            -1, focal_site, ancestor, sample_set, genotypes, disagree, &last_site);
     if (ret != 0) {
         goto out;
     }
     assert(ancestor[last_site] != -1);
     *ret_start = last_site;
 out:
-    tsi_safe_free(sample_set);
-    tsi_safe_free(disagree);
     return ret;
 }
 
 
+#define HASH_PRIME_1 0x9e3779b185ebca87ULL
+#define HASH_PRIME_2 0xc2b2ae3d27d4eb4fULL
+#define HASH_PRIME_3 0x165667b19e3779f9ULL
+
+static inline uint64_t
+hash_round(uint64_t acc, uint64_t word)
+{
+    acc += word * HASH_PRIME_2;
+    acc = (acc << 31) | (acc >> 33);
+    return acc * HASH_PRIME_1;
+}
+
+/* Returns a 64 bit hash of the specified bytes, seeded with h. This follows
+ * the structure of xxHash64: we keep four independent accumulators so that
+ * the multiplications for consecutive words can be pipelined, which matters
+ * because dense genotypes are hashed for every site added. */
+static uint64_t
+hash_bytes(const void *data, size_t size, uint64_t h)
+{
+    const char *bytes = (const char *) data;
+    uint64_t v0, v1, v2, v3, w[4], word;
+    size_t j;
+
+    v0 = h + HASH_PRIME_1 + HASH_PRIME_2;
+    v1 = h + HASH_PRIME_2;
+    v2 = h;
+    v3 = h - HASH_PRIME_1;
+    for (j = 0; j + sizeof(w) <= size; j += sizeof(w)) {
+        memcpy(w, bytes + j, sizeof(w));
+        v0 = hash_round(v0, w[0]);
+        v1 = hash_round(v1, w[1]);
+        v2 = hash_round(v2, w[2]);
+        v3 = hash_round(v3, w[3]);
+    }
+    h = v0 ^ ((v1 << 7) | (v1 >> 57)) ^ ((v2 << 12) | (v2 >> 52))
+        ^ ((v3 << 18) | (v3 >> 46));
+    h += (uint64_t) size;
+    for (; j + sizeof(uint64_t) <= size; j += sizeof(uint64_t)) {
+        memcpy(&word, bytes + j, sizeof(uint64_t));
+        h = hash_round(h, word) * HASH_PRIME_3;
+    }
+    word = 0;
+    memcpy(&word, bytes + j, size - j);
+    h = hash_round(h, word);
+    /* Final avalanche */
+    h ^= h >> 33;
+    h *= HASH_PRIME_2;
+    h ^= h >> 29;
+    h *= HASH_PRIME_3;
+    h ^= h >> 32;
+    return h;
+}
+
+static uint64_t
+ancestor_builder_hash_pattern(const ancestor_builder_t *self, const pattern_map_t *pattern)
+{
+    uint64_t h = (uint64_t) pattern->frequency;
+
+    if (pattern->packed_genotypes != NULL) {
+        h = hash_bytes(pattern->packed_genotypes, self->num_words * sizeof(uint64_t), h);
+    } else if (pattern->carriers != NULL) {
+        h = hash_bytes(pattern->carriers, pattern->frequency * sizeof(node_id_t), h);
+    } else {
+        h = hash_bytes(pattern->genotypes, self->num_samples * sizeof(allele_t), h);
+    }
+    return h;
+}
+
+/* Add site l to the pattern described by search, creating a new pattern if
+ * we have not seen it before. Patterns are found using the pattern_table
+ * hash index, so that each site costs O(num_samples) regardless of how many
+ * other patterns have the same frequency. */
+static int WARN_UNUSED
+ancestor_builder_add_pattern_site(ancestor_builder_t *self, site_id_t l,
+        pattern_map_t *search)
+{
+    int ret = 0;
+    site_t *site = &self->sites[l];
+    site_list_t *list_node;
+    pattern_map_t *map_elem, **bucket;
+    avl_compare_t cmp = self->frequency_map[search->frequency].cmp;
+    size_t size;
+
+    search->hash = ancestor_builder_hash_pattern(self, search);
+    bucket = &self->pattern_table[search->hash & self->pattern_table_mask];
+    for (map_elem = *bucket; map_elem != NULL; map_elem = map_elem->next) {
+        if (map_elem->hash == search->hash && map_elem->frequency == search->frequency
+                && cmp(map_elem, search) == 0) {
+            break;
+        }
+    }
+    if (map_elem == NULL) {
+        map_elem = block_allocator_get(&self->allocator, sizeof(pattern_map_t));
+        if (map_elem == NULL) {
+            ret = TSI_ERR_NO_MEMORY;
+            goto out;
+        }
+        memcpy(map_elem, search, sizeof(pattern_map_t));
+        if (search->packed_genotypes != NULL) {
+            size = self->num_words * sizeof(uint64_t);
+            map_elem->packed_genotypes = block_allocator_get(&self->allocator, size);
+            if (map_elem->packed_genotypes == NULL) {
+                ret = TSI_ERR_NO_MEMORY;
+                goto out;
+            }
+            memcpy(map_elem->packed_genotypes, search->packed_genotypes, size);
+        } else if (search->carriers != NULL) {
+            size = search->frequency * sizeof(node_id_t);
+            map_elem->carriers = block_allocator_get(&self->allocator, size);
+            if (map_elem->carriers == NULL) {
+                ret = TSI_ERR_NO_MEMORY;
+                goto out;
+            }
+            memcpy(map_elem->carriers, search->carriers, size);
+        } else {
+            size = self->num_samples * sizeof(allele_t);
+            map_elem->genotypes = block_allocator_get(&self->allocator, size);
+            if (map_elem->genotypes == NULL) {
+                ret = TSI_ERR_NO_MEMORY;
+                goto out;
+            }
+            memcpy(map_elem->genotypes, search->genotypes, size);
+        }
+        map_elem->sites = NULL;
+        map_elem->num_sites = 0;
+        map_elem->next = *bucket;
+        *bucket = map_elem;
+        self->num_patterns++;
+    }
+    site->genotypes = map_elem->genotypes;
+    site->packed_genotypes = map_elem->packed_genotypes;
+    site->carriers = map_elem->carriers;
+    map_elem->num_sites++;
+
+    list_node = block_allocator_get(&self->allocator, sizeof(site_list_t));
+    if (list_node == NULL) {
+        ret = TSI_ERR_NO_MEMORY;
+        goto out;
+    }
+    list_node->site = l;
+    list_node->next = map_elem->sites;
+    map_elem->sites = list_node;
+out:
+    return ret;
+}
+
+static void
+ancestor_builder_pack_genotypes(ancestor_builder_t *self, const allele_t *genotypes,
+        uint64_t *packed)
+{
+    size_t j;
+
+    memset(packed, 0, self->num_words * sizeof(uint64_t));
+    for (j = 0; j < self->num_samples; j++) {
+        if (genotypes[j] == 1) {
+            packed[j / 64] |= SAMPLE_BIT(j);
+        }
+    }
+}
+
+/* Store the sorted list of samples carrying the derived state in carriers */
+static void
+ancestor_builder_get_carriers(ancestor_builder_t *self, const allele_t *genotypes,
+        size_t frequency, node_id_t *carriers)
+{
+    size_t j, k;
+    uint64_t word;
+
+    k = 0;
+    j = 0;
+    /* Carriers are rare, so skip over blocks of zero genotypes quickly */
+    while (j < self->num_samples) {
+        if (j + sizeof(uint64_t) <= self->num_samples) {
+            memcpy(&word, genotypes + j, sizeof(uint64_t));
+            if (word == 0) {
+                j += sizeof(uint64_t);
+                continue;
+            }
+        }
+        if (genotypes[j] == 1) {
+            carriers[k] = (node_id_t) j;
+            k++;
+        }
+        j++;
+    }
+    assert(k == frequency);
+}
+
 int WARN_UNUSED
 ancestor_builder_add_site(ancestor_builder_t *self, site_id_t l, size_t frequency,
         allele_t *genotypes)
 {
     int ret = 0;
+    size_t u;
     site_t *site;
-    avl_node_t *avl_node;
-    site_list_t *list_node;
-    pattern_map_t search, *map_elem;
-    avl_tree_t *pattern_map = &self->frequency_map[frequency];
+    pattern_map_t search;
 
     assert(frequency <= self->num_samples);
     assert(l < (site_id_t) self->num_sites);
     site = &self->sites[l];
     site->frequency = frequency;
+    site->genotypes = NULL;
+    site->packed_genotypes = NULL;
+    site->carriers = NULL;
+    /* Update the maximum frequencies on the path to the root */
+    u = self->num_tree_leaves + (size_t) l;
+    self->frequency_tree[u] = frequency;
+    for (u >>= 1; u > 0; u >>= 1) {
+        self->frequency_tree[u] = TSI_MAX(self->frequency_tree[2 * u],
+                self->frequency_tree[2 * u + 1]);
+    }
     if (frequency > 1) {
-        search.genotypes = genotypes;
+        memset(&search, 0, sizeof(search));
+        search.frequency = frequency;
         search.num_samples = self->num_samples;
-        avl_node = avl_search(pattern_map, &search);
-        if (avl_node == NULL) {
-            avl_node = block_allocator_get(&self->allocator, sizeof(avl_node_t));
-            map_elem = block_allocator_get(&self->allocator, sizeof(pattern_map_t));
-            site->genotypes = block_allocator_get(&self->allocator,
-                    self->num_samples * sizeof(allele_t));
-            if (avl_node == NULL || map_elem == NULL || site->genotypes == NULL) {
-                ret = TSI_ERR_NO_MEMORY;
-                goto out;
-            }
-            memcpy(site->genotypes, genotypes, self->num_samples * sizeof(allele_t));
-            avl_init_node(avl_node, map_elem);
-            map_elem->genotypes = site->genotypes;
-            map_elem->num_samples = self->num_samples;
-            map_elem->sites = NULL;
-            map_elem->num_sites = 0;
-            avl_node = avl_insert_node(pattern_map, avl_node);
-            assert(avl_node != NULL);
-            if (site->genotypes == NULL) {
-                ret = TSI_ERR_NO_MEMORY;
-                goto out;
-            }
+        if (self->flags & TSI_BITPACK_GENOTYPES) {
+            ancestor_builder_pack_genotypes(self, genotypes,
+                    self->packed_genotypes_buffer);
+            search.packed_genotypes = self->packed_genotypes_buffer;
+        } else if (frequency <= self->max_sparse_frequency) {
+            ancestor_builder_get_carriers(self, genotypes, frequency,
+                    self->carriers_buffer);
+            search.carriers = self->carriers_buffer;
         } else {
-            map_elem = (pattern_map_t *) avl_node->item;
-            site->genotypes = map_elem->genotypes;
+            search.genotypes = genotypes;
         }
-        map_elem->num_sites++;
+        ret = ancestor_builder_add_pattern_site(self, l, &search);
+    }
+    return ret;
+}
 
-        list_node = block_allocator_get(&self->allocator, sizeof(site_list_t));
-        if (list_node == NULL) {
-            ret = TSI_ERR_NO_MEMORY;
+/* Add the num_sites sites with the specified IDs, where the genotypes for
+ * site_ids[j] are stored in row j of the num_sites x num_samples genotypes
+ * matrix. The frequency of each site is the number of samples with genotype 1. */
+int WARN_UNUSED
+ancestor_builder_add_sites(ancestor_builder_t *self, size_t num_sites,
+        site_id_t *site_ids, allele_t *genotypes)
+{
+    int ret = 0;
+    size_t j, k, frequency;
+    const size_t num_samples = self->num_samples;
+    allele_t *row;
+
+    for (j = 0; j < num_sites; j++) {
+        row = genotypes + j * num_samples;
+        frequency = 0;
+        for (k = 0; k < num_samples; k++) {
+            frequency += row[k] == 1;
+        }
+        ret = ancestor_builder_add_site(self, site_ids[j], frequency, row);
+        if (ret != 0) {
             goto out;
         }
-        list_node->site = l;
-        list_node->next = map_elem->sites;
-        map_elem->sites = list_node;
     }
 out:
     return ret;
@@ -336,28 +954,52 @@ out:
 static void
 ancestor_builder_check_state(ancestor_builder_t *self)
 {
-    size_t f, k, count;
-    avl_node_t *a;
+    size_t f, j, k, count, num_patterns, num_indexed;
     pattern_map_t *map_elem;
     site_list_t *s;
 
-    for (f = 0; f < self->num_samples + 1; f++) {
-        for (a = self->frequency_map[f].head; a != NULL; a = a->next) {
-            map_elem = (pattern_map_t *) a->item;
+    num_patterns = 0;
+    for (j = 0; j <= self->pattern_table_mask; j++) {
+        for (map_elem = self->pattern_table[j]; map_elem != NULL;
+                map_elem = map_elem->next) {
+            num_patterns++;
+            f = map_elem->frequency;
+            assert(map_elem->hash == ancestor_builder_hash_pattern(self, map_elem));
+            assert((map_elem->hash & self->pattern_table_mask) == j);
             count = 0;
-            for (k = 0; k < self->num_samples; k++) {
-                count += map_elem->genotypes[k] == 1;
+            if (self->flags & TSI_BITPACK_GENOTYPES) {
+                count = popcount(map_elem->packed_genotypes, self->num_words);
+            } else if (map_elem->carriers != NULL) {
+                assert(f <= self->max_sparse_frequency);
+                for (k = 0; k < map_elem->frequency; k++) {
+                    assert(map_elem->carriers[k] < (node_id_t) self->num_samples);
+                    assert(k == 0 || map_elem->carriers[k - 1] < map_elem->carriers[k]);
+                }
+                count = map_elem->frequency;
+            } else {
+                for (k = 0; k < self->num_samples; k++) {
+                    count += map_elem->genotypes[k] == 1;
+                }
             }
             assert(count == f);
             count = 0;
             for (s = map_elem->sites; s != NULL; s = s->next) {
                 assert(self->sites[s->site].frequency == f);
                 assert(self->sites[s->site].genotypes == map_elem->genotypes);
+                assert(self->sites[s->site].packed_genotypes
+                        == map_elem->packed_genotypes);
+                assert(self->sites[s->site].carriers == map_elem->carriers);
                 count++;
             }
             assert(map_elem->num_sites == count);
         }
     }
+    assert(num_patterns == self->num_patterns);
+    num_indexed = 0;
+    for (f = 0; f < self->num_samples + 1; f++) {
+        num_indexed += avl_count(&self->frequency_map[f]);
+    }
+    assert(num_indexed == self->num_indexed_patterns);
 }
 
 int
@@ -372,11 +1014,15 @@ ancestor_builder_print_state(ancestor_builder_t *self, FILE *out)
     fprintf(out, "num_samples = %d\n", (int) self->num_samples);
     fprintf(out, "num_sites = %d\n", (int) self->num_sites);
     fprintf(out, "num_ancestors = %d\n", (int) self->num_ancestors);
+    fprintf(out, "max_sparse_frequency = %d\n", (int) self->max_sparse_frequency);
+    fprintf(out, "num_patterns = %d\n", (int) self->num_patterns);
 
     fprintf(out, "Sites:\n");
     for (j = 0; j < self->num_sites; j++) {
-        fprintf(out, "%d\t%d\t%p\n", (int) j, (int) self->sites[j].frequency,
-                self->sites[j].genotypes);
+        fprintf(out, "%d\t%d\t%p\t%p\t%p\n", (int) j, (int) self->sites[j].frequency,
+                (void *) self->sites[j].genotypes,
+                (void *) self->sites[j].packed_genotypes,
+                (void *) self->sites[j].carriers);
     }
     fprintf(out, "Frequency map:\n");
     for (j = 0; j < self->num_samples + 1; j++) {
@@ -385,8 +1031,17 @@ ancestor_builder_print_state(ancestor_builder_t *self, FILE *out)
         for (a = self->frequency_map[j].head; a != NULL; a = a->next) {
             map_elem = (pattern_map_t *) a->item;
             printf("\t");
-            for (k = 0; k < self->num_samples; k++) {
-                printf("%d", map_elem->genotypes[k]);
+            if (map_elem->carriers != NULL) {
+                for (k = 0; k < map_elem->frequency; k++) {
+                    printf("%d,", map_elem->carriers[k]);
+                }
+            }
+            for (k = 0; k < self->num_samples && map_elem->carriers == NULL; k++) {
+                if (self->flags & TSI_BITPACK_GENOTYPES) {
+                    printf("%d", (map_elem->packed_genotypes[k / 64] & SAMPLE_BIT(k)) != 0);
+                } else {
+                    printf("%d", map_elem->genotypes[k]);
+                }
             }
             printf("\t");
             for (s = map_elem->sites; s != NULL; s = s->next) {
@@ -411,23 +1066,44 @@ ancestor_builder_print_state(ancestor_builder_t *self, FILE *out)
 
 /* Returns true if we should break the an ancestor that spans from focal
  * site a to focal site b */
+static bool
+ancestor_builder_break_packed_ancestor(ancestor_builder_t *self, site_id_t a,
+        site_id_t b)
+{
+    bool ret = false;
+    int64_t j;
+    size_t ones;
+    const uint64_t *restrict samples = self->sites[a].packed_genotypes;
+    const size_t num_samples = self->sites[a].frequency;
+
+    for (j = ancestor_builder_next_site(self, a + 1, +1, num_samples);
+            j < b && !ret;
+            j = ancestor_builder_next_site(self, j + 1, +1, num_samples)) {
+        ones = popcount_and(samples, self->sites[j].packed_genotypes,
+                self->num_words);
+        if (ones != num_samples && ones != 0) {
+            ret = true;
+        }
+    }
+    return ret;
+}
+
 static bool
 ancestor_builder_break_ancestor(ancestor_builder_t *self, site_id_t a,
         site_id_t b, node_id_t *restrict samples, size_t num_samples)
 {
     bool ret = false;
-    site_id_t j, k;
+    int64_t j;
     size_t ones;
+    const size_t frequency = self->sites[a].frequency;
 
-    for (j = a + 1; j < b && !ret; j++) {
-        if (self->sites[j].frequency > self->sites[a].frequency) {
-            ones = 0;
-            for (k = 0; k < (site_id_t) num_samples; k++) {
-                ones += self->sites[j].genotypes[samples[k]];
-            }
-            if (ones != num_samples && ones != 0) {
-                ret = true;
-            }
+    for (j = ancestor_builder_next_site(self, a + 1, +1, frequency);
+            j < b && !ret;
+            j = ancestor_builder_next_site(self, j + 1, +1, frequency)) {
+        ones = ancestor_builder_get_sample_genotypes(self, (site_id_t) j, samples,
+                num_samples, NULL);
+        if (ones != num_samples && ones != 0) {
+            ret = true;
         }
     }
     return ret;
@@ -445,11 +1121,32 @@ ancestor_builder_finalise(ancestor_builder_t *self)
     site_id_t *focal_sites = NULL;
     site_id_t *p;
     site_id_t *consistent_samples = malloc(self->num_samples * sizeof(node_id_t));
+    bool packed = !!(self->flags & TSI_BITPACK_GENOTYPES);
+    bool split;
 
     if (consistent_samples == NULL) {
         ret = TSI_ERR_NO_MEMORY;
         goto out;
     }
+    /* Sort the unique patterns within each frequency class. We may have been
+     * finalised before, in which case the patterns already in the AVL trees
+     * are not inserted again. */
+    for (j = 0; j <= self->pattern_table_mask
+            && self->num_indexed_patterns < self->num_patterns; j++) {
+        for (map_elem = self->pattern_table[j]; map_elem != NULL;
+                map_elem = map_elem->next) {
+            a = block_allocator_get(&self->allocator, sizeof(avl_node_t));
+            if (a == NULL) {
+                ret = TSI_ERR_NO_MEMORY;
+                goto out;
+            }
+            avl_init_node(a, map_elem);
+            if (avl_insert_node(&self->frequency_map[map_elem->frequency], a) != NULL) {
+                self->num_indexed_patterns++;
+            }
+        }
+    }
+    assert(self->num_indexed_patterns == self->num_patterns);
     num_consistent_samples = 0;  /* Keep the compiler happy */
     self->num_ancestors = 0;
     for (j = self->num_samples; j > 1; j--) {
@@ -473,15 +1170,21 @@ ancestor_builder_finalise(ancestor_builder_t *self)
             }
             /* Now check to see if we need to split this ancestor up
              * further */
-            if (map_elem->num_sites > 1) {
+            if (map_elem->num_sites > 1 && !packed) {
                 ancestor_builder_get_consistent_samples(self, focal_sites[0],
                         consistent_samples, &num_consistent_samples);
                 assert(num_consistent_samples == descriptor->frequency);
             }
             for (k = 0; k < map_elem->num_sites - 1; k++) {
-                if (ancestor_builder_break_ancestor(
+                if (packed) {
+                    split = ancestor_builder_break_packed_ancestor(
+                        self, focal_sites[k], focal_sites[k + 1]);
+                } else {
+                    split = ancestor_builder_break_ancestor(
                         self, focal_sites[k], focal_sites[k + 1],
-                        consistent_samples, num_consistent_samples)) {
+                        consistent_samples, num_consistent_samples);
+                }
+                if (split) {
                     p = focal_sites + k + 1;
                     descriptor->num_focal_sites = p - descriptor->focal_sites;
                     descriptor = self->descriptors + self->num_ancestors;
@@ -32,6 +32,12 @@ is_nonzero_root(const node_id_t u, const node_id_t *restrict parent,
     return u != 0 && parent[u] == NULL_NODE && left_child[u] == NULL_NODE;
 }
 
+static inline int8_t
+initial_likelihood(const node_id_t u, const node_id_t *restrict parent)
+{
+    return parent[u] == NULL_NODE ? NONZERO_ROOT_LIKELIHOOD : NULL_LIKELIHOOD;
+}
+
 static void
 ancestor_matcher_check_state(ancestor_matcher_t *self)
 {
@@ -57,6 +63,27 @@ ancestor_matcher_check_state(ancestor_matcher_t *self)
     assert(num_likelihoods == self->num_likelihood_nodes);
 }
 
+/* Checks that all per node state has been returned to its reset state
+ * at the end of a match. */
+static void
+ancestor_matcher_check_reset_state(ancestor_matcher_t *self)
+{
+    node_id_t u;
+
+    assert(self->num_reset_nodes == self->num_nodes);
+    for (u = 0; u < (node_id_t) self->num_nodes; u++) {
+        assert(self->parent[u] == NULL_NODE);
+        assert(self->left_child[u] == NULL_NODE);
+        assert(self->right_child[u] == NULL_NODE);
+        assert(self->left_sib[u] == NULL_NODE);
+        assert(self->right_sib[u] == NULL_NODE);
+        assert(self->recombination_required[u] == -1);
+        assert(self->path_cache[u] == CACHE_UNSET);
+        assert(self->likelihood_cache[u] == CACHE_UNSET);
+        assert(self->likelihood[u] == NONZERO_ROOT_LIKELIHOOD);
+    }
+}
+
 int
 ancestor_matcher_print_state(ancestor_matcher_t *self, FILE *out)
 {
@@ -79,8 +106,9 @@ ancestor_matcher_print_state(ancestor_matcher_t *self, FILE *out)
     }
     fprintf(out, "traceback\n");
     for (j = 0; j < (int) self->num_sites; j++) {
-        fprintf(out, "\t%d:%d (%d)\t", (int) j,
-                self->max_likelihood_node[j], self->traceback[j].size);
+        fprintf(out, "\t%d:%d (%d, run=%d)\t", (int) j,
+                self->max_likelihood_node[j], self->traceback[j].size,
+                self->traceback[j].run_length);
         for (k = 0; k < self->traceback[j].size; k++) {
             fprintf(out, "(%d, %d)", self->traceback[j].node[k],
                     self->traceback[j].recombination_required[k]);
@@ -95,13 +123,17 @@ ancestor_matcher_print_state(ancestor_matcher_t *self, FILE *out)
 
 int
 ancestor_matcher_alloc(ancestor_matcher_t *self,
-        tree_sequence_builder_t *tree_sequence_builder, int flags)
+        tree_sequence_builder_t *tree_sequence_builder,
+        size_t traceback_block_size, int flags)
 {
     int ret = 0;
-    /* TODO make these input parameters. */
-    size_t traceback_block_size = 64 * 1024 * 1024;
+    /* The initial number of buckets in the traceback table */
+    size_t table_size = 1024;
 
     memset(self, 0, sizeof(ancestor_matcher_t));
+    if (traceback_block_size == 0) {
+        traceback_block_size = TSI_DEFAULT_TRACEBACK_BLOCK_SIZE;
+    }
     /* All allocs for arrays related to nodes are done in expand_nodes */
     self->flags = flags;
     self->max_nodes = 0;
@@ -113,9 +145,12 @@ ancestor_matcher_alloc(ancestor_matcher_t *self,
     self->output.left = malloc(self->output.max_size * sizeof(site_id_t));
     self->output.right = malloc(self->output.max_size * sizeof(site_id_t));
     self->output.parent = malloc(self->output.max_size * sizeof(node_id_t));
+    self->traceback_table.entries = calloc(table_size, sizeof(traceback_entry_t));
+    self->traceback_table.mask = table_size - 1;
+    self->traceback_table.generation = 1;
     if (self->traceback == NULL || self->max_likelihood_node == NULL
             || self->output.left == NULL || self->output.right == NULL
-            || self->output.parent == NULL) {
+            || self->output.parent == NULL || self->traceback_table.entries == NULL) {
         ret = TSI_ERR_NO_MEMORY;
         goto out;
     }
@@ -146,39 +181,170 @@ ancestor_matcher_free(ancestor_matcher_t *self)
     tsi_safe_free(self->output.left);
     tsi_safe_free(self->output.right);
     tsi_safe_free(self->output.parent);
+    tsi_safe_free(self->traceback_table.entries);
+    tsi_safe_free(self->traceback_scratch);
+    tsi_safe_free(self->intervals.left);
+    tsi_safe_free(self->intervals.right);
+    tsi_safe_free(self->intervals.epoch);
     block_allocator_free(&self->traceback_allocator);
     return 0;
 }
 
-static int
+/* Removes the likelihood for the specified node. The node is left in the
+ * likelihood_nodes list until ancestor_matcher_compact_likelihood_nodes is
+ * called, so that removing many nodes from a long list costs a single pass.
+ * No nodes may be added to the list while deletions are pending. */
+static inline void
 ancestor_matcher_delete_likelihood(ancestor_matcher_t *self, const node_id_t node,
         int8_t *restrict L)
 {
-    /* Remove the specified node from the list of nodes */
+    assert(L[node] >= 0);
+    L[node] = NULL_LIKELIHOOD;
+    self->num_deleted_likelihood_nodes++;
+}
+
+/* Removes the nodes deleted since the last call from the likelihood_nodes
+ * list, keeping the remaining nodes in the same order. */
+static void
+ancestor_matcher_compact_likelihood_nodes(ancestor_matcher_t *self,
+        const int8_t *restrict L)
+{
     int j, k;
     node_id_t *restrict L_nodes = self->likelihood_nodes;
 
-    k = 0;
-    for (j = 0; j < self->num_likelihood_nodes; j++) {
-        L_nodes[k] = L_nodes[j];
-        if (L_nodes[j] != node) {
-            k++;
+    if (self->num_deleted_likelihood_nodes > 0) {
+        k = 0;
+        for (j = 0; j < self->num_likelihood_nodes; j++) {
+            L_nodes[k] = L_nodes[j];
+            if (L[L_nodes[j]] >= 0) {
+                k++;
+            }
         }
+        assert(self->num_likelihood_nodes == k + self->num_deleted_likelihood_nodes);
+        self->num_likelihood_nodes = k;
+        self->num_deleted_likelihood_nodes = 0;
     }
-    assert(self->num_likelihood_nodes == k + 1);
-    self->num_likelihood_nodes = k;
-    L[node] = NULL_LIKELIHOOD;
-    return 0;
 }
 
-/* Store the recombination_required state in the traceback */
+static inline uint32_t
+traceback_hash(const void *data, size_t num_bytes)
+{
+    /* FNV-1a */
+    const uint8_t *restrict bytes = (const uint8_t *) data;
+    uint32_t h = 2166136261u;
+    size_t j;
+
+    for (j = 0; j < num_bytes; j++) {
+        h = (h ^ bytes[j]) * 16777619u;
+    }
+    return h;
+}
+
+/* Doubles the number of buckets in the traceback table, rehashing the entries
+ * from the current generation. */
+static int WARN_UNUSED
+ancestor_matcher_expand_traceback_table(ancestor_matcher_t *self)
+{
+    int ret = 0;
+    size_t j, k;
+    const size_t old_size = self->traceback_table.mask + 1;
+    const size_t new_mask = 2 * old_size - 1;
+    const uint32_t generation = self->traceback_table.generation;
+    traceback_entry_t *old_entries = self->traceback_table.entries;
+    traceback_entry_t *new_entries = calloc(new_mask + 1, sizeof(traceback_entry_t));
+
+    if (new_entries == NULL) {
+        ret = TSI_ERR_NO_MEMORY;
+        goto out;
+    }
+    for (j = 0; j < old_size; j++) {
+        if (old_entries[j].generation == generation) {
+            k = old_entries[j].hash & new_mask;
+            while (new_entries[k].generation == generation) {
+                k = (k + 1) & new_mask;
+            }
+            new_entries[k] = old_entries[j];
+        }
+    }
+    free(old_entries);
+    self->traceback_table.entries = new_entries;
+    self->traceback_table.mask = new_mask;
+out:
+    return ret;
+}
+
+/* Returns a pointer to a copy of the specified array in the traceback
+ * allocator, reusing an identical array from earlier in the current match
+ * if one exists. Returns NULL if memory cannot be allocated. */
+static void *
+ancestor_matcher_intern_traceback_array(ancestor_matcher_t *self,
+        const void *data, size_t num_bytes)
+{
+    void *ret = NULL;
+    void *copy;
+    size_t k;
+    const uint32_t hash = traceback_hash(data, num_bytes);
+    const uint32_t generation = self->traceback_table.generation;
+    traceback_entry_t *entry;
+
+    /* Keep the load factor below 1/2 */
+    if (2 * (self->traceback_table.num_entries + 1) > self->traceback_table.mask) {
+        if (ancestor_matcher_expand_traceback_table(self) != 0) {
+            goto out;
+        }
+    }
+    k = hash & self->traceback_table.mask;
+    while (true) {
+        entry = &self->traceback_table.entries[k];
+        if (entry->generation != generation) {
+            break;
+        }
+        if (entry->hash == hash && entry->num_bytes == num_bytes
+                && memcmp(entry->data, data, num_bytes) == 0) {
+            ret = entry->data;
+            goto out;
+        }
+        k = (k + 1) & self->traceback_table.mask;
+    }
+    copy = block_allocator_get(&self->traceback_allocator, num_bytes);
+    if (copy == NULL) {
+        goto out;
+    }
+    memcpy(copy, data, num_bytes);
+    entry->data = copy;
+    entry->num_bytes = num_bytes;
+    entry->hash = hash;
+    entry->generation = generation;
+    self->traceback_table.num_entries++;
+    ret = copy;
+out:
+    return ret;
+}
+
+/* Empties the traceback table in constant time by moving to a new generation. */
+static void
+ancestor_matcher_reset_traceback_table(ancestor_matcher_t *self)
+{
+    self->traceback_table.generation++;
+    if (self->traceback_table.generation == 0) {
+        /* Generation counter wrapped around, so clear the stale entries. */
+        memset(self->traceback_table.entries, 0,
+                (self->traceback_table.mask + 1) * sizeof(traceback_entry_t));
+        self->traceback_table.generation = 1;
+    }
+    self->traceback_table.num_entries = 0;
+}
+
+/* Store the recombination_required state in the traceback. The node and
+ * recombination_required arrays are interned separately, so that each distinct
+ * array is stored once per match: the node lists change only when likelihoods
+ * are compressed, and the recombination_required lists frequently recur. */
 static int WARN_UNUSED
 ancestor_matcher_store_traceback(ancestor_matcher_t *self, const site_id_t site_id)
 {
     int ret = 0;
-    node_id_t u;
     int j;
-    int8_t *restrict list_R;
+    int8_t *restrict list_R = self->traceback_scratch;
     node_id_t *restrict list_node;
     node_state_list_t *restrict list;
     node_state_list_t *restrict T = self->traceback;
@@ -187,46 +353,40 @@ ancestor_matcher_store_traceback(ancestor_matcher_t *self, const site_id_t site_
     const int num_likelihood_nodes = self->num_likelihood_nodes;
     bool match;
 
-    /* Check to see if the previous site has the same recombination_required. If so,
-     * we can reuse the same list. */
+    for (j = 0; j < num_likelihood_nodes; j++) {
+        list_R[j] = R[nodes[j]];
+    }
+    /* Check to see if the previous site has the same node list, which is
+     * by far the most common case. If so, we can reuse it without hashing. */
     match = false;
+    list_node = NULL;
     if (site_id > 0) {
         list = &T[site_id - 1];
         if (list->size == num_likelihood_nodes) {
             list_node = list->node;
-            list_R = list->recombination_required;
-            match = true;
-            for (j = 0; j < num_likelihood_nodes; j++) {
-                if (list_node[j] != nodes[j] || list_R[j] != R[nodes[j]]) {
-                    match = false;
-                    break;
-                }
+            match = memcmp(list_node, nodes,
+                    num_likelihood_nodes * sizeof(node_id_t)) == 0;
+            if (match && memcmp(list->recombination_required, list_R,
+                        (size_t) num_likelihood_nodes) == 0) {
+                T[site_id] = *list;
+                T[site_id].run_length = 0;
+                goto done;
             }
         }
     }
-
-    if (match) {
-        T[site_id].size = T[site_id - 1].size;
-        T[site_id].node = T[site_id - 1].node;
-        T[site_id].recombination_required = T[site_id - 1].recombination_required;
-    } else {
-        list_node = block_allocator_get(&self->traceback_allocator,
+    if (!match) {
+        list_node = ancestor_matcher_intern_traceback_array(self, nodes,
                 num_likelihood_nodes * sizeof(node_id_t));
-        list_R = block_allocator_get(&self->traceback_allocator,
-                num_likelihood_nodes * sizeof(int8_t));
-        if (list_node == NULL || list_R == NULL) {
-            ret = TSI_ERR_NO_MEMORY;
-            goto out;
-        }
-        T[site_id].node = list_node;
-        T[site_id].recombination_required = list_R;
-        T[site_id].size = num_likelihood_nodes;
-        for (j = 0; j < num_likelihood_nodes; j++) {
-            u = nodes[j];
-            list_node[j] = u;
-            list_R[j] = R[u];
-        }
     }
+    T[site_id].recombination_required = ancestor_matcher_intern_traceback_array(
+            self, list_R, (size_t) num_likelihood_nodes);
+    if (list_node == NULL || T[site_id].recombination_required == NULL) {
+        ret = TSI_ERR_NO_MEMORY;
+        goto out;
+    }
+    T[site_id].node = list_node;
+    T[site_id].size = num_likelihood_nodes;
+done:
     self->total_traceback_size += num_likelihood_nodes;
 out:
     return ret;
@@ -250,6 +410,85 @@ is_descendant(const node_id_t u, const node_id_t v, const node_id_t *restrict pa
     return ret;
 }
 
+/* Moves on to a new tree, invalidating all existing interval labels. */
+static void
+ancestor_matcher_invalidate_intervals(ancestor_matcher_t *self)
+{
+    self->intervals.current_epoch++;
+    if (self->intervals.current_epoch == 0) {
+        /* Epoch counter wrapped around, so clear the stale labels. */
+        memset(self->intervals.epoch, 0, self->max_nodes * sizeof(uint32_t));
+        self->intervals.current_epoch = 1;
+    }
+    self->intervals.next_label = 0;
+}
+
+/* Labels the nodes in the subtree rooted at the specified node in pre-order,
+ * so that the labels for the descendants of u are in [left[u], right[u]). */
+static void
+ancestor_matcher_label_intervals(ancestor_matcher_t *self, const node_id_t root)
+{
+    const node_id_t *restrict parent = self->parent;
+    const node_id_t *restrict left_child = self->left_child;
+    const node_id_t *restrict right_sib = self->right_sib;
+    int32_t *restrict left = self->intervals.left;
+    int32_t *restrict right = self->intervals.right;
+    uint32_t *restrict epoch = self->intervals.epoch;
+    const uint32_t current_epoch = self->intervals.current_epoch;
+    int32_t label = self->intervals.next_label;
+    node_id_t u = root;
+
+    while (true) {
+        left[u] = label;
+        epoch[u] = current_epoch;
+        label++;
+        if (left_child[u] != NULL_NODE) {
+            u = left_child[u];
+            continue;
+        }
+        /* Close off the subtrees we have finished and move to the next sibling. */
+        while (true) {
+            right[u] = label;
+            if (u == root) {
+                goto done;
+            }
+            if (right_sib[u] != NULL_NODE) {
+                u = right_sib[u];
+                break;
+            }
+            u = parent[u];
+        }
+    }
+done:
+    self->intervals.next_label = label;
+}
+
+/* Ensures that the subtree rooted at the specified node has interval labels
+ * in the current tree. Subtrees are labelled on demand, since a full
+ * traversal of the tree for each new tree would cost more than the descendant
+ * tests that it saves. */
+static void
+ancestor_matcher_prepare_intervals(ancestor_matcher_t *self, const node_id_t u)
+{
+    if (self->intervals.epoch[u] != self->intervals.current_epoch) {
+        ancestor_matcher_label_intervals(self, u);
+    }
+}
+
+/* Returns true if u is a descendant of v using the interval labels. The
+ * subtree rooted at v must already be labelled, and so any node that is
+ * not labelled cannot be a descendant of v. Labels from earlier subtrees
+ * are either nested within v's interval or disjoint from it. */
+static inline bool
+ancestor_matcher_is_descendant_interval(const ancestor_matcher_t *self,
+        const node_id_t u, const node_id_t v)
+{
+    const int32_t label = self->intervals.left[u];
+
+    return self->intervals.epoch[u] == self->intervals.current_epoch
+        && self->intervals.left[v] <= label && label < self->intervals.right[v];
+}
+
 static int WARN_UNUSED
 ancestor_matcher_update_site_likelihood_values(ancestor_matcher_t *self,
         const site_id_t site, const node_id_t mutation_node, const char state,
@@ -260,6 +499,7 @@ ancestor_matcher_update_site_likelihood_values(ancestor_matcher_t *self,
     const node_id_t *restrict L_nodes = self->likelihood_nodes;
     int8_t *restrict path_cache = self->path_cache;
     int8_t *restrict recombination_required = self->recombination_required;
+    const bool use_intervals = !!(self->flags & TSI_INTERVAL_LABELS);
     int j, descendant;
     node_id_t u, v, max_L_node;
     int8_t max_L;
@@ -267,16 +507,22 @@ ancestor_matcher_update_site_likelihood_values(ancestor_matcher_t *self,
     max_L = -1;
     max_L_node = NULL_NODE;
     assert(num_likelihood_nodes > 0);
+    if (use_intervals && mutation_node != NULL_NODE) {
+        ancestor_matcher_prepare_intervals(self, mutation_node);
+    }
     /* printf("likelihoods for node=%d, n=%d\n", mutation_node, self->num_likelihood_nodes); */
     for (j = 0; j < num_likelihood_nodes; j++) {
         u = L_nodes[j];
         /* Determine if the node this likelihood is associated with is a descendant
          * of the mutation node. To avoid the cost of repeatedly traversing up the
-         * tree, we keep a cache of the paths that we have already traversed. When
-         * we meet one of these paths we can immediately finish.
+         * tree, we either use the interval labels for the tree or keep a cache
+         * of the paths that we have already traversed. When we meet one of these
+         * paths we can immediately finish.
          */
         descendant = 0;
-        if (mutation_node != NULL_NODE) {
+        if (mutation_node != NULL_NODE && use_intervals) {
+            descendant = ancestor_matcher_is_descendant_interval(self, u, mutation_node);
+        } else if (mutation_node != NULL_NODE) {
             v = u;
             while (likely(v != NULL_NODE)
                     && likely(v != mutation_node)
@@ -440,15 +686,60 @@ out:
     return ret;
 }
 
+/* Records the traceback for the sites in [start, end), which have no mutations
+ * and follow a site without mutations at which no likelihoods were coalesced.
+ * The likelihoods are therefore the same at all of these sites, and no
+ * recombination is required at any of them. Rather than storing a traceback
+ * for each site we store a single run entry at the last site. */
 static void
-ancestor_matcher_reset_tree(ancestor_matcher_t *self)
+ancestor_matcher_store_site_run(ancestor_matcher_t *self, const site_id_t start,
+        const site_id_t end)
 {
-    memset(self->parent, 0xff, self->num_nodes * sizeof(node_id_t));
-    memset(self->left_child, 0xff, self->num_nodes * sizeof(node_id_t));
-    memset(self->right_child, 0xff, self->num_nodes * sizeof(node_id_t));
-    memset(self->left_sib, 0xff, self->num_nodes * sizeof(node_id_t));
-    memset(self->right_sib, 0xff, self->num_nodes * sizeof(node_id_t));
-    memset(self->recombination_required, 0xff, self->num_nodes * sizeof(int8_t));
+    const node_id_t max_L_node = self->max_likelihood_node[start - 1];
+    site_id_t site;
+
+    for (site = start; site < end; site++) {
+        self->max_likelihood_node[site] = max_L_node;
+    }
+    self->traceback[end - 1].run_length = end - start;
+    self->total_traceback_size += (size_t) self->num_likelihood_nodes
+        * (size_t) (end - start);
+}
+
+/* Sets the per node state for nodes in [start, end) to the reset state. */
+static void
+ancestor_matcher_reset_nodes(ancestor_matcher_t *self, size_t start, size_t end)
+{
+    size_t n = end - start;
+    node_id_t u;
+
+    memset(self->parent + start, 0xff, n * sizeof(node_id_t));
+    memset(self->left_child + start, 0xff, n * sizeof(node_id_t));
+    memset(self->right_child + start, 0xff, n * sizeof(node_id_t));
+    memset(self->left_sib + start, 0xff, n * sizeof(node_id_t));
+    memset(self->right_sib + start, 0xff, n * sizeof(node_id_t));
+    memset(self->recombination_required + start, 0xff, n * sizeof(int8_t));
+    memset(self->path_cache + start, 0xff, n * sizeof(int8_t));
+    memset(self->likelihood_cache + start, 0xff, n * sizeof(int8_t));
+    for (u = (node_id_t) start; u < (node_id_t) end; u++) {
+        self->likelihood[u] = NONZERO_ROOT_LIKELIHOOD;
+    }
+}
+
+/* Returns the state for a node touched during the forwards match to the
+ * reset state. The path_cache is cleared as we go, and so does not need
+ * to be reset here. */
+static inline void
+ancestor_matcher_reset_node(ancestor_matcher_t *self, const node_id_t u)
+{
+    self->parent[u] = NULL_NODE;
+    self->left_child[u] = NULL_NODE;
+    self->right_child[u] = NULL_NODE;
+    self->left_sib[u] = NULL_NODE;
+    self->right_sib[u] = NULL_NODE;
+    self->recombination_required[u] = -1;
+    self->likelihood[u] = NONZERO_ROOT_LIKELIHOOD;
+    self->likelihood_cache[u] = CACHE_UNSET;
 }
 
 static int WARN_UNUSED
@@ -467,6 +758,10 @@ ancestor_matcher_expand_nodes(ancestor_matcher_t *self)
     tsi_safe_free(self->likelihood_nodes);
     tsi_safe_free(self->likelihood_nodes_tmp);
     tsi_safe_free(self->path_cache);
+    tsi_safe_free(self->traceback_scratch);
+    tsi_safe_free(self->intervals.left);
+    tsi_safe_free(self->intervals.right);
+    tsi_safe_free(self->intervals.epoch);
 
     assert(self->max_nodes > 0);
     self->parent = malloc(self->max_nodes * sizeof(node_id_t));
@@ -480,6 +775,17 @@ ancestor_matcher_expand_nodes(ancestor_matcher_t *self)
     self->likelihood_nodes = malloc(self->max_nodes * sizeof(node_id_t));
     self->likelihood_nodes_tmp = malloc(self->max_nodes * sizeof(node_id_t));
     self->path_cache = malloc(self->max_nodes * sizeof(int8_t));
+    self->traceback_scratch = malloc(self->max_nodes * sizeof(int8_t));
+    if (self->flags & TSI_INTERVAL_LABELS) {
+        self->intervals.left = malloc(self->max_nodes * sizeof(int32_t));
+        self->intervals.right = malloc(self->max_nodes * sizeof(int32_t));
+        self->intervals.epoch = calloc(self->max_nodes, sizeof(uint32_t));
+        self->intervals.current_epoch = 0;
+        if (self->intervals.left == NULL || self->intervals.right == NULL
+                || self->intervals.epoch == NULL) {
+            goto out;
+        }
+    }
 
     if (self->parent == NULL
             || self->left_child == NULL || self->right_child == NULL
@@ -487,7 +793,8 @@ ancestor_matcher_expand_nodes(ancestor_matcher_t *self)
             || self->recombination_required == NULL
             || self->likelihood == NULL || self->likelihood_cache == NULL
             || self->likelihood_nodes == NULL
-            || self->likelihood_nodes_tmp == NULL || self->path_cache == NULL) {
+            || self->likelihood_nodes_tmp == NULL || self->path_cache == NULL
+            || self->traceback_scratch == NULL) {
         goto out;
     }
     ret = 0;
@@ -499,26 +806,36 @@ static int
 ancestor_matcher_reset(ancestor_matcher_t *self)
 {
     int ret = 0;
-
-    /* TODO realloc when this grows */
-    if (self->max_nodes != self->tree_sequence_builder->max_nodes) {
-        self->max_nodes = self->tree_sequence_builder->max_nodes;
+    tree_sequence_builder_t *tsb = self->tree_sequence_builder;
+
+    /* Only the nodes that existed when the indexes were frozen can be in the
+     * trees. Paths may be added to the builder by another thread while we
+     * match, so we must not look at its current node count or capacity. */
+    self->num_nodes = tsb->num_frozen_nodes;
+    if (self->max_nodes == 0 || self->num_nodes > self->max_nodes) {
+        self->max_nodes = TSI_MAX(self->num_nodes,
+                TSI_MAX(2 * self->max_nodes, tsb->nodes_chunk_size));
+        self->num_reset_nodes = 0;
         ret = ancestor_matcher_expand_nodes(self);
         if (ret != 0) {
             goto out;
         }
     }
-    self->num_nodes = self->tree_sequence_builder->num_nodes;
-    assert(self->num_nodes <= self->max_nodes);
 
-    memset(self->path_cache, 0xff, self->num_nodes * sizeof(int8_t));
+    /* Nodes seen in previous calls are returned to the reset state at the end
+     * of each match, so we only need to initialise any new nodes here. */
+    if (self->num_reset_nodes < self->num_nodes) {
+        ancestor_matcher_reset_nodes(self, self->num_reset_nodes, self->num_nodes);
+        self->num_reset_nodes = self->num_nodes;
+    }
     ret = block_allocator_reset(&self->traceback_allocator);
     if (ret != 0) {
         goto out;
     }
+    ancestor_matcher_reset_traceback_table(self);
     self->total_traceback_size = 0;
     self->num_likelihood_nodes = 0;
-    ancestor_matcher_reset_tree(self);
+    self->num_deleted_likelihood_nodes = 0;
 out:
     return ret;
 }
@@ -568,13 +885,16 @@ ancestor_matcher_run_traceback(ancestor_matcher_t *self, site_id_t start,
     edge_t edge;
     node_id_t u, max_likelihood_node;
     site_id_t left, right, pos;
+    int32_t run_length;
     mutation_list_node_t *mut_list;
     node_id_t *restrict parent = self->parent;
     int8_t *restrict recombination_required = self->recombination_required;
     const edge_t *restrict in = self->tree_sequence_builder->right_index_edges;
     const edge_t *restrict out = self->tree_sequence_builder->left_index_edges;
-    int_fast32_t in_index = (int_fast32_t) self->tree_sequence_builder->num_edges - 1;
-    int_fast32_t out_index = (int_fast32_t) self->tree_sequence_builder->num_edges - 1;
+    const int_fast32_t num_edges = (int_fast32_t) self->tree_sequence_builder->num_edges;
+    int_fast32_t in_index = num_edges - 1;
+    int_fast32_t out_index = num_edges - 1;
+    int_fast32_t k;
 
     /* Prepare for the traceback and get the memory ready for recording
      * the output edges. */
@@ -587,10 +907,8 @@ ancestor_matcher_run_traceback(ancestor_matcher_t *self, site_id_t start,
     self->output.parent[self->output.size] = max_likelihood_node;
     assert(self->output.parent[self->output.size] != NULL_NODE);
 
-    /* Now go through the trees in reverse and run the traceback */
-    memset(parent, 0xff, self->num_nodes * sizeof(*parent));
-    memset(recombination_required, 0xff,
-            self->num_nodes * sizeof(*recombination_required));
+    /* Now go through the trees in reverse and run the traceback. The parent
+     * and recombination_required arrays are all unset on entry. */
     pos = self->num_sites;
 
     while (pos > start) {
@@ -617,6 +935,15 @@ ancestor_matcher_run_traceback(ancestor_matcher_t *self, site_id_t start,
         /* The tree is ready; perform the traceback at each site in this tree */
         assert(left < right);
         for (l = TSI_MIN(right, end) - 1; l >= (int) TSI_MAX(left, start); l--) {
+            run_length = self->traceback[l].run_length;
+            if (run_length > 0) {
+                /* There are no mutations and no recombinations in this run
+                 * of sites, so we can skip straight to the start of it. */
+                l -= run_length - 1;
+                assert(l >= (int) TSI_MAX(left, start));
+                memset(match + l, 0, (size_t) run_length * sizeof(*match));
+                continue;
+            }
             match[l] = 0;
             u = self->output.parent[self->output.size];
             /* Set the state of the matched haplotype */
@@ -654,6 +981,11 @@ ancestor_matcher_run_traceback(ancestor_matcher_t *self, site_id_t start,
     self->output.left[self->output.size] = start;
     self->output.size++;
     assert(self->output.right[self->output.size - 1] != start);
+
+    /* Unset the parents for the edges that remain in the tree */
+    for (k = in_index + 1; k < num_edges; k++) {
+        parent[in[k].child] = NULL_NODE;
+    }
     return ret;
 }
 
@@ -704,6 +1036,28 @@ insert_edge(edge_t edge, node_id_t *restrict parent, node_id_t *restrict left_ch
     right_child[p] = c;
 }
 
+/* Returns the index of the last checkpoint with position <= start, or -1
+ * if there is no such checkpoint. */
+static int
+ancestor_matcher_find_checkpoint(ancestor_matcher_t *self, site_id_t start)
+{
+    const site_id_t *position = self->tree_sequence_builder->checkpoints.position;
+    int lo = 0;
+    int hi = (int) self->tree_sequence_builder->checkpoints.num_checkpoints;
+    int mid;
+
+    /* Find the first checkpoint with position > start */
+    while (lo < hi) {
+        mid = (lo + hi) / 2;
+        if (position[mid] <= start) {
+            lo = mid + 1;
+        } else {
+            hi = mid;
+        }
+    }
+    return lo - 1;
+}
+
 static int
 ancestor_matcher_run_forwards_match(ancestor_matcher_t *self, site_id_t start,
         site_id_t end, allele_t *haplotype)
@@ -728,21 +1082,45 @@ ancestor_matcher_run_forwards_match(ancestor_matcher_t *self, site_id_t start,
     const edge_t *restrict in = self->tree_sequence_builder->left_index_edges;
     const edge_t *restrict out = self->tree_sequence_builder->right_index_edges;
     const int_fast32_t M = (site_id_t) self->tree_sequence_builder->num_edges;
-    int_fast32_t in_index, out_index, l, remove_start;
+    int_fast32_t in_index, out_index, in_start, l, remove_start;
+    int j, num_likelihood_nodes;
+    site_id_t site_end, run_end;
+    const tree_sequence_builder_t *tsb = self->tree_sequence_builder;
 
     /* Load the tree for start */
     left = 0;
     pos = 0;
     in_index = 0;
+    in_start = 0;
     out_index = 0;
     right = self->num_sites;
     if (in_index < M && start < in[in_index].left) {
         right = in[in_index].left;
     }
 
-    /* TODO there's probably quite a big gain to made here by seeking
-     * directly to the tree that we're interested in rather than just
-     * building the trees sequentially */
+    /* Seek to the last checkpoint at or before start, and then build the
+     * remaining trees sequentially from there. */
+    j = ancestor_matcher_find_checkpoint(self, start);
+    if (j >= 0) {
+        for (l = (int_fast32_t) tsb->checkpoints.edges_offset[j];
+                l < (int_fast32_t) tsb->checkpoints.edges_offset[j + 1]; l++) {
+            insert_edge(tsb->checkpoints.edges[l], parent, left_child, right_child,
+                    left_sib, right_sib);
+        }
+        in_index = (int_fast32_t) tsb->checkpoints.in_index[j];
+        in_start = in_index;
+        out_index = (int_fast32_t) tsb->checkpoints.out_index[j];
+        left = tsb->checkpoints.position[j];
+        right = self->num_sites;
+        if (in_index < M) {
+            right = TSI_MIN(right, in[in_index].left);
+        }
+        if (out_index < M) {
+            right = TSI_MIN(right, out[out_index].right);
+        }
+        pos = right;
+    }
+
     while (in_index < M && out_index < M && in[in_index].left <= start) {
         while (out_index < M && out[out_index].right == pos) {
             remove_edge(out[out_index], parent, left_child, right_child,
@@ -766,16 +1144,22 @@ ancestor_matcher_run_forwards_match(ancestor_matcher_t *self, site_id_t start,
     }
 
     /* Insert the initial likelihoods. All non-zero roots are marked with a
-     * special value so we can identify them when the enter the tree */
-    L_cache[0] = CACHE_UNSET;
-    for (u = 0; u < (node_id_t) self->num_nodes; u++) {
-        L_cache[u] = CACHE_UNSET;
-        if (parent[u] != NULL_NODE) {
-            L[u] = NULL_LIKELIHOOD;
-        } else {
-            L[u] = NONZERO_ROOT_LIKELIHOOD;
+     * special value so we can identify them when the enter the tree. Nodes
+     * that have not been touched are already marked as non-zero roots, so
+     * we only need to update the nodes for the edges we have inserted. */
+    if (j >= 0) {
+        for (l = (int_fast32_t) tsb->checkpoints.edges_offset[j];
+                l < (int_fast32_t) tsb->checkpoints.edges_offset[j + 1]; l++) {
+            edge = tsb->checkpoints.edges[l];
+            L[edge.child] = initial_likelihood(edge.child, parent);
+            L[edge.parent] = initial_likelihood(edge.parent, parent);
         }
     }
+    for (l = in_start; l < in_index; l++) {
+        edge = in[l];
+        L[edge.child] = initial_likelihood(edge.child, parent);
+        L[edge.parent] = initial_likelihood(edge.parent, parent);
+    }
     if (self->flags & TSI_EXTENDED_CHECKS) {
         ancestor_matcher_check_state(self);
     }
@@ -791,6 +1175,9 @@ ancestor_matcher_run_forwards_match(ancestor_matcher_t *self, site_id_t start,
     remove_start = out_index;
     while (left < end) {
         assert(left < right);
+        if (self->flags & TSI_INTERVAL_LABELS) {
+            ancestor_matcher_invalidate_intervals(self);
+        }
 
         /* Remove the likelihoods for any nonzero roots that have just left
          * the tree */
@@ -815,11 +1202,12 @@ ancestor_matcher_run_forwards_match(ancestor_matcher_t *self, site_id_t start,
             root = left_child[0];
             assert(right_sib[root] == NULL_NODE);
         }
+        if (root != last_root && last_root == 0) {
+            ancestor_matcher_delete_likelihood(self, last_root, L);
+            L[last_root] = NONZERO_ROOT_LIKELIHOOD;
+        }
+        ancestor_matcher_compact_likelihood_nodes(self, L);
         if (root != last_root) {
-            if (last_root == 0) {
-                ancestor_matcher_delete_likelihood(self, last_root, L);
-                L[last_root] = NONZERO_ROOT_LIKELIHOOD;
-            }
             if (L[root] == NONZERO_ROOT_LIKELIHOOD) {
                 L[root] = MISMATCH_LIKELIHOOD;
                 self->likelihood_nodes[self->num_likelihood_nodes] = root;
@@ -831,12 +1219,30 @@ ancestor_matcher_run_forwards_match(ancestor_matcher_t *self, site_id_t start,
         if (self->flags & TSI_EXTENDED_CHECKS) {
             ancestor_matcher_check_state(self);
         }
-        for (site = TSI_MAX(left, start); site < TSI_MIN(right, end); site++) {
+        site = TSI_MAX(left, start);
+        site_end = TSI_MIN(right, end);
+        while (site < site_end) {
+            num_likelihood_nodes = self->num_likelihood_nodes;
             ret = ancestor_matcher_update_site_state(self, site, haplotype[site],
                     parent, L, L_cache);
             if (ret != 0) {
                 goto out;
             }
+            site++;
+            /* If this site has no mutations and no likelihoods were coalesced,
+             * the state will be the same for any following sites in this tree
+             * that have no mutations, and so we process them as a single run. */
+            if (tsb->sites.mutations[site - 1] == NULL
+                    && self->num_likelihood_nodes == num_likelihood_nodes) {
+                run_end = site;
+                while (run_end < site_end && tsb->sites.mutations[run_end] == NULL) {
+                    run_end++;
+                }
+                if (run_end > site) {
+                    ancestor_matcher_store_site_run(self, site, run_end);
+                    site = run_end;
+                }
+            }
         }
 
         /* Move on to the next tree */
@@ -906,6 +1312,22 @@ ancestor_matcher_run_forwards_match(ancestor_matcher_t *self, site_id_t start,
             right = TSI_MIN(right, out[out_index].right);
         }
     }
+
+    /* Return the state for all the nodes we have touched to the reset state */
+    if (j >= 0) {
+        for (l = (int_fast32_t) tsb->checkpoints.edges_offset[j];
+                l < (int_fast32_t) tsb->checkpoints.edges_offset[j + 1]; l++) {
+            edge = tsb->checkpoints.edges[l];
+            ancestor_matcher_reset_node(self, edge.child);
+            ancestor_matcher_reset_node(self, edge.parent);
+        }
+    }
+    for (l = in_start; l < in_index; l++) {
+        edge = in[l];
+        ancestor_matcher_reset_node(self, edge.child);
+        ancestor_matcher_reset_node(self, edge.parent);
+    }
+    ancestor_matcher_reset_node(self, 0);
 out:
     return ret;
 }
@@ -931,6 +1353,9 @@ ancestor_matcher_find_path(ancestor_matcher_t *self,
     if (ret != 0) {
         goto out;
     }
+    if (self->flags & TSI_EXTENDED_CHECKS) {
+        ancestor_matcher_check_reset_state(self);
+    }
     /* Reset some memory for the next call */
     memset(self->traceback + start, 0, (end - start) * sizeof(*self->traceback));
     memset(self->max_likelihood_node + start, 0xff,
@@ -941,6 +1366,11 @@ ancestor_matcher_find_path(ancestor_matcher_t *self,
     *parent_output = self->output.parent;
     *num_output_edges = self->output.size;
 out:
+    if (ret != 0) {
+        /* The per node state may have been left partially updated, so
+         * make sure we reset all nodes on the next call. */
+        self->num_reset_nodes = 0;
+    }
     return ret;
 }
 
@@ -954,7 +1384,16 @@ size_t
 ancestor_matcher_get_total_memory(ancestor_matcher_t *self)
 {
     size_t total = self->traceback_allocator.total_size;
-    /* TODO add contributions from other objects */
+
+    total += (self->traceback_table.mask + 1) * sizeof(traceback_entry_t);
+    total += self->num_sites * (sizeof(node_state_list_t) + sizeof(node_id_t));
+    total += 3 * self->output.max_size * sizeof(node_id_t);
+    /* parent, left_child, right_child, left_sib, right_sib, likelihood_nodes
+     * and likelihood_nodes_tmp, plus five int8_t arrays */
+    total += self->max_nodes * (7 * sizeof(node_id_t) + 5 * sizeof(int8_t));
+    if (self->flags & TSI_INTERVAL_LABELS) {
+        total += self->max_nodes * (2 * sizeof(int32_t) + sizeof(uint32_t));
+    }
 
     return total;
 }
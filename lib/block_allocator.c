@@ -34,6 +34,24 @@ block_allocator_print_state(block_allocator_t *self, FILE *out)
     fprintf(out, "\tnum_chunks = %d\n", (int) self->num_chunks);
     fprintf(out, "\ttotal_allocated = %d\n", (int) self->total_allocated);
     fprintf(out, "\ttotal_size = %d\n", (int) self->total_size);
+    fprintf(out, "\tnum_large_chunks = %d\n", (int) self->num_large_chunks);
+}
+
+static void
+block_allocator_free_large_chunks(block_allocator_t *self)
+{
+    size_t j;
+
+    for (j = 0; j < self->num_large_chunks; j++) {
+        free(self->large_chunks[j]);
+    }
+    if (self->large_chunks != NULL) {
+        free(self->large_chunks);
+    }
+    self->large_chunks = NULL;
+    self->total_size -= self->large_size;
+    self->large_size = 0;
+    self->num_large_chunks = 0;
 }
 
 int WARN_UNUSED
@@ -41,6 +59,7 @@ block_allocator_reset(block_allocator_t *self)
 {
     int ret = 0;
 
+    block_allocator_free_large_chunks(self);
     self->top = 0;
     self->current_chunk = 0;
     self->total_allocated = 0;
@@ -82,7 +101,24 @@ block_allocator_get(block_allocator_t *self, size_t size)
     void *ret = NULL;
     void *p;
 
-    assert(size < self->chunk_size);
+    if (size > self->chunk_size) {
+        p = realloc(self->large_chunks, (self->num_large_chunks + 1) * sizeof(void *));
+        if (p == NULL) {
+            goto out;
+        }
+        self->large_chunks = p;
+        p = malloc(size);
+        if (p == NULL) {
+            goto out;
+        }
+        self->large_chunks[self->num_large_chunks] = p;
+        self->num_large_chunks++;
+        self->large_size += size + sizeof(void *);
+        self->total_size += size + sizeof(void *);
+        self->total_allocated += size;
+        ret = p;
+        goto out;
+    }
     if ((self->top + size) > self->chunk_size) {
         if (self->current_chunk == (self->num_chunks - 1)) {
             p = realloc(self->mem_chunks, (self->num_chunks + 1) * sizeof(void *));
@@ -121,4 +157,5 @@ block_allocator_free(block_allocator_t *self)
     if (self->mem_chunks != NULL) {
         free(self->mem_chunks);
     }
+    block_allocator_free_large_chunks(self);
 }
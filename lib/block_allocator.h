@@ -26,7 +26,8 @@
  * responding to calls to get(), it will return a chunk of this memory.
  * This memory cannot be subsequently handed back to the allocator. However,
  * all memory allocated by the allocator can be returned at once by calling
- * reset.
+ * reset. Requests larger than the chunk size are satisfied by a dedicated
+ * malloc, which is released when the allocator is reset.
  */
 
 #include <stdio.h>
@@ -41,6 +42,9 @@ typedef struct {
     size_t total_allocated;   /* the total number of bytes allocated. */
     size_t num_chunks;        /* the number of memory chunks. */
     char **mem_chunks;        /* the memory chunks */
+    size_t num_large_chunks;  /* the number of oversized chunks. */
+    size_t large_size;        /* the total number of bytes in oversized chunks. */
+    char **large_chunks;      /* chunks for requests larger than chunk_size */
 } block_allocator_t;
 
 extern void block_allocator_print_state(block_allocator_t *self, FILE *out);
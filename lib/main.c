@@ -242,6 +242,7 @@ run_generate(const char *input_file, int verbose, int path_compression)
     site_id_t l, start, end;
     size_t num_focal_sites;
     ancestor_builder_t ancestor_builder;
+    ancestor_builder_workspace_t workspace;
     tree_sequence_builder_t ts_builder;
     ancestor_matcher_t matcher;
     allele_t *a, *sample, *match;
@@ -278,6 +279,10 @@ run_generate(const char *input_file, int verbose, int path_compression)
     if (ret != 0) {
         fatal_error("Builder alloc error.");
     }
+    ret = ancestor_builder_workspace_alloc(&workspace, num_samples);
+    if (ret != 0) {
+        fatal_error("Workspace alloc error.");
+    }
     genotypes = malloc(num_sites * sizeof(allele_t));
     focal_sites = malloc(num_sites * sizeof(site_id_t));
     if (genotypes == NULL || focal_sites == NULL) {
@@ -306,7 +311,8 @@ run_generate(const char *input_file, int verbose, int path_compression)
     if (ret != 0) {
         fatal_error("alloc error");
     }
-    ret = ancestor_matcher_alloc(&matcher, &ts_builder, 0);
+    ret = ancestor_matcher_alloc(&matcher, &ts_builder,
+            TSI_DEFAULT_TRACEBACK_BLOCK_SIZE, 0);
     if (ret != 0) {
         fatal_error("alloc error");
     }
@@ -397,8 +403,8 @@ run_generate(const char *input_file, int verbose, int path_compression)
                 focal_sites[k] = s->site;
                 k--;
             }
-            ret = ancestor_builder_make_ancestor(&ancestor_builder, num_focal_sites,
-                    focal_sites, &start, &end, a);
+            ret = ancestor_builder_make_ancestor(&ancestor_builder, &workspace,
+                    num_focal_sites, focal_sites, &start, &end, a);
             if (ret != 0) {
                 fatal_error("Error in make ancestor");
             }
@@ -558,6 +564,7 @@ run_generate(const char *input_file, int verbose, int path_compression)
     }
 
     ancestor_builder_free(&ancestor_builder);
+    ancestor_builder_workspace_free(&workspace);
     tree_sequence_builder_free(&ts_builder);
     ancestor_matcher_free(&matcher);
     tsi_safe_free(genotypes);
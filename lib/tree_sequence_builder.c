@@ -25,52 +25,80 @@
 #include <string.h>
 #include <stdbool.h>
 
-#include "avl.h"
 
 /* Time increment between path compression ancestors and their parents.
  * Power-of-two value chosen here so that we can manipulate time values
  * reasonably losslessly. */
 #define PC_ANCESTOR_INCREMENT (1.0 / 65536)
 
-static int
-cmp_edge_left_increasing_time(const void *a, const void *b) {
-    const indexed_edge_t *ca = (const indexed_edge_t *) a;
-    const indexed_edge_t *cb = (const indexed_edge_t *) b;
-    int ret = (ca->edge.left > cb->edge.left) - (ca->edge.left < cb->edge.left);
+/* The orders used for the frozen tree traversal indexes. The live edges are
+ * uniquely identified by (left, child) and (right, child), so the final
+ * comparisons on the remaining fields only serve to make this a total order
+ * on edge values, which we need when merging in the pending edges. */
+typedef int (*index_cmp_func_t)(const edge_t *, double, const edge_t *, double);
+
+static inline int
+cmp_index_left_increasing_time(const edge_t *a, double ta, const edge_t *b, double tb)
+{
+    int ret = (a->left > b->left) - (a->left < b->left);
     if (ret == 0) {
-        ret = (ca->time > cb->time) - (ca->time < cb->time);
+        ret = (ta > tb) - (ta < tb);
         if (ret == 0) {
-            ret = (ca->edge.child > cb->edge.child) - (ca->edge.child < cb->edge.child);
+            ret = (a->child > b->child) - (a->child < b->child);
+            if (ret == 0) {
+                ret = (a->right > b->right) - (a->right < b->right);
+                if (ret == 0) {
+                    ret = (a->parent > b->parent) - (a->parent < b->parent);
+                }
+            }
         }
     }
     return ret;
 }
 
-static int
-cmp_edge_right_decreasing_time(const void *a, const void *b) {
-    const indexed_edge_t *ca = (const indexed_edge_t *) a;
-    const indexed_edge_t *cb = (const indexed_edge_t *) b;
-    int ret = (ca->edge.right > cb->edge.right) - (ca->edge.right < cb->edge.right);
+static inline int
+cmp_index_right_decreasing_time(const edge_t *a, double ta, const edge_t *b, double tb)
+{
+    int ret = (a->right > b->right) - (a->right < b->right);
     if (ret == 0) {
-        ret = (ca->time < cb->time) - (ca->time > cb->time);
+        ret = (ta < tb) - (ta > tb);
         if (ret == 0) {
-            ret = (ca->edge.child > cb->edge.child) - (ca->edge.child < cb->edge.child);
+            ret = (a->child > b->child) - (a->child < b->child);
+            if (ret == 0) {
+                ret = (a->left > b->left) - (a->left < b->left);
+                if (ret == 0) {
+                    ret = (a->parent > b->parent) - (a->parent < b->parent);
+                }
+            }
         }
     }
     return ret;
 }
 
 static int
-cmp_edge_path(const void *a, const void *b) {
+cmp_edge_left_increasing_time(const void *a, const void *b) {
+    const indexed_edge_t *ca = (const indexed_edge_t *) a;
+    const indexed_edge_t *cb = (const indexed_edge_t *) b;
+    return cmp_index_left_increasing_time(&ca->edge, ca->time, &cb->edge, cb->time);
+}
+
+static int
+cmp_edge_right_decreasing_time(const void *a, const void *b) {
     const indexed_edge_t *ca = (const indexed_edge_t *) a;
     const indexed_edge_t *cb = (const indexed_edge_t *) b;
-    int ret = (ca->edge.left > cb->edge.left) - (ca->edge.left < cb->edge.left);
+    return cmp_index_right_decreasing_time(&ca->edge, ca->time, &cb->edge, cb->time);
+}
+
+static inline int
+cmp_path_order(const edge_t *a, const edge_t *b)
+{
+    int ret = (a->left > b->left) - (a->left < b->left);
     if (ret == 0) {
-        ret = (ca->edge.right > cb->edge.right) - (ca->edge.right < cb->edge.right);
+        ret = (a->right > b->right) - (a->right < b->right);
         if (ret == 0) {
-            ret = (ca->edge.parent > cb->edge.parent) - (ca->edge.parent < cb->edge.parent);
+            ret = (a->parent > b->parent) - (a->parent < b->parent);
             if (ret == 0) {
-                ret = (ca->edge.child > cb->edge.child) - (ca->edge.child < cb->edge.child);
+                ret = (a->child > b->child) - (a->child < b->child);
             }
         }
     }
@@ -92,26 +120,366 @@ print_edge_path(indexed_edge_t *head, FILE *out)
     fprintf(out, "\n");
 }
 
+/* Path index. */
+
+static inline size_t
+path_index_hash(site_id_t left, site_id_t right, node_id_t parent)
+{
+    uint64_t h = ((uint64_t) (uint32_t) left << 32) | (uint32_t) right;
+
+    h ^= (uint64_t) (uint32_t) parent * 0x9e3779b97f4a7c15ULL;
+    h ^= h >> 31;
+    h *= 0xbf58476d1ce4e5b9ULL;
+    h ^= h >> 29;
+    return (size_t) h;
+}
+
+static int WARN_UNUSED
+path_index_alloc(path_index_t *self, size_t num_buckets, bool sorted_runs)
+{
+    int ret = 0;
+    size_t size = 1;
+
+    memset(self, 0, sizeof(*self));
+    self->sorted_runs = sorted_runs;
+    if (!sorted_runs) {
+        while (size < num_buckets) {
+            size *= 2;
+        }
+        self->table = calloc(size, sizeof(*self->table));
+        if (self->table == NULL) {
+            ret = TSI_ERR_NO_MEMORY;
+            goto out;
+        }
+        self->table_mask = size - 1;
+    }
+out:
+    return ret;
+}
+
+static void
+path_index_free(path_index_t *self)
+{
+    size_t k;
+
+    tsi_safe_free(self->table);
+    for (k = 0; k < TSI_PATH_INDEX_MAX_RUNS; k++) {
+        tsi_safe_free(self->runs[k]);
+    }
+}
+
+static void
+path_index_print_state(path_index_t *self, FILE *out)
+{
+    size_t j, k;
+    indexed_edge_t *e;
+    path_index_entry_t *entry;
+
+    if (self->sorted_runs) {
+        for (k = 0; k < TSI_PATH_INDEX_MAX_RUNS; k++) {
+            if (self->run_size[k] > 0) {
+                fprintf(out, "run %d: size = %d\n", (int) k, (int) self->run_size[k]);
+                for (j = 0; j < self->run_size[k]; j++) {
+                    entry = &self->runs[k][j];
+                    fprintf(out, "%d\t%d\t%d\t%d\t%s\n", entry->edge.left,
+                            entry->edge.right, entry->edge.parent, entry->edge.child,
+                            entry->item == NULL ? "removed": "");
+                }
+            }
+        }
+    } else {
+        fprintf(out, "num_buckets = %d\n", (int) (self->table_mask + 1));
+        for (j = 0; j <= self->table_mask; j++) {
+            for (e = self->table[j]; e != NULL; e = e->hash_next) {
+                fprintf(out, "%d\t%d\t%d\t%d\t%d\n", (int) j, e->edge.left,
+                        e->edge.right, e->edge.parent, e->edge.child);
+            }
+        }
+    }
+}
+
+/* Doubles the number of buckets in the hash table. */
+static int WARN_UNUSED
+path_index_expand_table(path_index_t *self)
+{
+    int ret = 0;
+    size_t new_mask = 2 * self->table_mask + 1;
+    indexed_edge_t **new_table = calloc(new_mask + 1, sizeof(*new_table));
+    indexed_edge_t *e, *next;
+    size_t j, h;
+
+    if (new_table == NULL) {
+        ret = TSI_ERR_NO_MEMORY;
+        goto out;
+    }
+    for (j = 0; j <= self->table_mask; j++) {
+        for (e = self->table[j]; e != NULL; e = next) {
+            next = e->hash_next;
+            h = path_index_hash(e->edge.left, e->edge.right, e->edge.parent) & new_mask;
+            e->hash_next = new_table[h];
+            new_table[h] = e;
+        }
+    }
+    free(self->table);
+    self->table = new_table;
+    self->table_mask = new_mask;
+out:
+    return ret;
+}
+
+/* Returns the index of the first entry in the specified run that is
+ * greater than or equal to the specified edge. */
+static inline size_t
+path_index_lower_bound(const path_index_entry_t *run, size_t size, const edge_t *edge)
+{
+    size_t lo = 0;
+    size_t hi = size;
+    size_t mid;
+
+    while (lo < hi) {
+        mid = (lo + hi) / 2;
+        if (cmp_path_order(&run[mid].edge, edge) < 0) {
+            lo = mid + 1;
+        } else {
+            hi = mid;
+        }
+    }
+    return lo;
+}
+
+/* Empties the smallest run by merging it, along with as many of the following
+ * runs as are needed, into the first run that has space for them. */
+static int WARN_UNUSED
+path_index_merge_runs(path_index_t *self)
+{
+    int ret = 0;
+    path_index_entry_t *dest, *source;
+    size_t total = self->run_size[0];
+    size_t j, k, u, v, w;
+
+    k = 1;
+    while (k < TSI_PATH_INDEX_MAX_RUNS
+            && total + self->run_size[k] > ((size_t) TSI_PATH_INDEX_RUN_SIZE << k)) {
+        total += self->run_size[k];
+        k++;
+    }
+    if (k == TSI_PATH_INDEX_MAX_RUNS) {
+        ret = TSI_ERR_NO_MEMORY;
+        goto out;
+    }
+    if (self->runs[k] == NULL) {
+        self->runs[k] = malloc(((size_t) TSI_PATH_INDEX_RUN_SIZE << k)
+                * sizeof(path_index_entry_t));
+        if (self->runs[k] == NULL) {
+            ret = TSI_ERR_NO_MEMORY;
+            goto out;
+        }
+    }
+    /* Merge each of the smaller runs into the end of run k, working backwards. */
+    dest = self->runs[k];
+    for (j = 0; j < k; j++) {
+        source = self->runs[j];
+        u = self->run_size[k];
+        v = self->run_size[j];
+        w = u + v;
+        while (v > 0) {
+            if (u > 0 && cmp_path_order(&dest[u - 1].edge, &source[v - 1].edge) > 0) {
+                dest[w - 1] = dest[u - 1];
+                u--;
+            } else {
+                dest[w - 1] = source[v - 1];
+                v--;
+            }
+            w--;
+        }
+        self->run_size[k] += self->run_size[j];
+        self->run_size[j] = 0;
+    }
+    /* Drop the removed edges */
+    w = 0;
+    for (u = 0; u < self->run_size[k]; u++) {
+        if (dest[u].item != NULL) {
+            dest[w] = dest[u];
+            w++;
+        }
+    }
+    self->run_size[k] = w;
+out:
+    return ret;
+}
+
+static int WARN_UNUSED
+path_index_insert_run(path_index_t *self, indexed_edge_t *edge)
+{
+    int ret = 0;
+    path_index_entry_t *run;
+    size_t j;
+
+    if (self->run_size[0] == TSI_PATH_INDEX_RUN_SIZE) {
+        ret = path_index_merge_runs(self);
+        if (ret != 0) {
+            goto out;
+        }
+    }
+    if (self->runs[0] == NULL) {
+        self->runs[0] = malloc(TSI_PATH_INDEX_RUN_SIZE * sizeof(path_index_entry_t));
+        if (self->runs[0] == NULL) {
+            ret = TSI_ERR_NO_MEMORY;
+            goto out;
+        }
+    }
+    run = self->runs[0];
+    j = path_index_lower_bound(run, self->run_size[0], &edge->edge);
+    memmove(run + j + 1, run + j, (self->run_size[0] - j) * sizeof(*run));
+    run[j].edge = edge->edge;
+    run[j].item = edge;
+    self->run_size[0]++;
+out:
+    return ret;
+}
+
+/* Returns the sorted run entry for the specified edge, or NULL if it is
+ * not present. */
+static path_index_entry_t *
+path_index_search_runs(path_index_t *self, indexed_edge_t *edge)
+{
+    path_index_entry_t *ret = NULL;
+    path_index_entry_t *run;
+    size_t j, k;
+
+    for (k = 0; k < TSI_PATH_INDEX_MAX_RUNS && ret == NULL; k++) {
+        run = self->runs[k];
+        j = path_index_lower_bound(run, self->run_size[k], &edge->edge);
+        while (j < self->run_size[k] && cmp_path_order(&run[j].edge, &edge->edge) == 0) {
+            if (run[j].item == edge) {
+                ret = &run[j];
+                break;
+            }
+            j++;
+        }
+    }
+    return ret;
+}
+
+static int WARN_UNUSED
+path_index_insert(path_index_t *self, indexed_edge_t *edge)
+{
+    int ret = 0;
+    size_t h;
+
+    if (self->sorted_runs) {
+        ret = path_index_insert_run(self, edge);
+        if (ret != 0) {
+            goto out;
+        }
+    } else {
+        if (self->num_edges > self->table_mask) {
+            ret = path_index_expand_table(self);
+            if (ret != 0) {
+                goto out;
+            }
+        }
+        h = path_index_hash(edge->edge.left, edge->edge.right, edge->edge.parent)
+            & self->table_mask;
+        edge->hash_next = self->table[h];
+        self->table[h] = edge;
+    }
+    self->num_edges++;
+out:
+    return ret;
+}
+
+static bool
+path_index_contains(path_index_t *self, indexed_edge_t *edge)
+{
+    size_t h;
+    indexed_edge_t *e;
+
+    if (self->sorted_runs) {
+        return path_index_search_runs(self, edge) != NULL;
+    }
+    h = path_index_hash(edge->edge.left, edge->edge.right, edge->edge.parent)
+        & self->table_mask;
+    for (e = self->table[h]; e != NULL && e != edge; e = e->hash_next);
+    return e != NULL;
+}
+
+static void
+path_index_remove(path_index_t *self, indexed_edge_t *edge)
+{
+    size_t h;
+    indexed_edge_t **e;
+    path_index_entry_t *entry;
+
+    if (self->sorted_runs) {
+        entry = path_index_search_runs(self, edge);
+        assert(entry != NULL);
+        entry->item = NULL;
+    } else {
+        h = path_index_hash(edge->edge.left, edge->edge.right, edge->edge.parent)
+            & self->table_mask;
+        for (e = &self->table[h]; *e != edge; e = &(*e)->hash_next) {
+            assert(*e != NULL);
+        }
+        *e = edge->hash_next;
+        edge->hash_next = NULL;
+    }
+    self->num_edges--;
+}
+
+/* Returns the edge with the smallest child that has the same left, right
+ * and parent values as the specified edge, or NULL if there is none. */
+static indexed_edge_t *
+path_index_find_match(path_index_t *self, const edge_t *query)
+{
+    indexed_edge_t *ret = NULL;
+    indexed_edge_t *e;
+    path_index_entry_t *run;
+    edge_t search;
+    size_t h, j, k;
+
+    if (self->sorted_runs) {
+        search = *query;
+        search.child = 0;
+        for (k = 0; k < TSI_PATH_INDEX_MAX_RUNS; k++) {
+            run = self->runs[k];
+            j = path_index_lower_bound(run, self->run_size[k], &search);
+            /* Entries with the same key are sorted by child, so the first one
+             * that has not been removed is the best in this run. */
+            while (j < self->run_size[k] && run[j].edge.left == query->left
+                    && run[j].edge.right == query->right
+                    && run[j].edge.parent == query->parent) {
+                if (run[j].item != NULL) {
+                    if (ret == NULL || run[j].edge.child < ret->edge.child) {
+                        ret = run[j].item;
+                    }
+                    break;
+                }
+                j++;
+            }
+        }
+    } else {
+        h = path_index_hash(query->left, query->right, query->parent) & self->table_mask;
+        for (e = self->table[h]; e != NULL; e = e->hash_next) {
+            if (e->edge.left == query->left && e->edge.right == query->right
+                    && e->edge.parent == query->parent
+                    && (ret == NULL || e->edge.child < ret->edge.child)) {
+                ret = e;
+            }
+        }
+    }
+    return ret;
+}
+
 static void
 tree_sequence_builder_check_index_integrity(tree_sequence_builder_t *self)
 {
-    avl_node_t *avl_node;
     indexed_edge_t *edge;
     size_t j;
 
     for (j = 0; j < self->num_nodes; j++) {
         for (edge = self->path[j]; edge != NULL; edge = edge->next) {
-            avl_node = avl_search(&self->left_index, edge);
-            assert(avl_node != NULL);
-            assert(avl_node->item == (void *) edge);
-
-            avl_node = avl_search(&self->right_index, edge);
-            assert(avl_node != NULL);
-            assert(avl_node->item == (void *) edge);
-
-            avl_node = avl_search(&self->path_index, edge);
-            assert(avl_node != NULL);
-            assert(avl_node->item == (void *) edge);
+            assert(path_index_contains(&self->path_index, edge));
         }
     }
 }
@@ -132,11 +500,10 @@ tree_sequence_builder_check_state(tree_sequence_builder_t *self)
             }
         }
     }
-    assert(avl_count(&self->left_index) == total_edges);
-    assert(avl_count(&self->right_index) == total_edges);
-    assert(avl_count(&self->path_index) == total_edges);
     assert(total_edges == object_heap_get_num_allocated(&self->edge_heap));
-    assert(3 * total_edges == object_heap_get_num_allocated(&self->avl_node_heap));
+    assert(self->path_index.num_edges == total_edges);
+    assert(self->num_edges + self->pending.num_added - self->pending.num_removed
+            == total_edges);
     tree_sequence_builder_check_index_integrity(self);
 }
 
@@ -145,8 +512,6 @@ tree_sequence_builder_print_state(tree_sequence_builder_t *self, FILE *out)
 {
     size_t j;
     mutation_list_node_t *u;
-    avl_node_t *a;
-    edge_t *edge;
 
     fprintf(out, "Tree sequence builder state\n");
     fprintf(out, "flags = %d\n", (int) self->flags);
@@ -177,16 +542,10 @@ tree_sequence_builder_print_state(tree_sequence_builder_t *self, FILE *out)
         }
     }
     fprintf(out, "path index \n");
-    for (a = self->path_index.head; a != NULL; a = a->next) {
-        edge = (edge_t *) a->item;
-        fprintf(out, "%d\t%d\t%d\t%d\n", edge->left, edge->right,
-                edge->parent, edge->child);
-    }
+    path_index_print_state(&self->path_index, out);
 
     fprintf(out, "block_allocator = \n");
     block_allocator_print_state(&self->block_allocator, out);
-    fprintf(out, "avl_node_heap = \n");
-    object_heap_print_state(&self->avl_node_heap, out);
     fprintf(out, "edge_heap = \n");
     object_heap_print_state(&self->edge_heap, out);
 
@@ -219,8 +578,8 @@ tree_sequence_builder_alloc(tree_sequence_builder_t *self,
         ret = TSI_ERR_NO_MEMORY;
         goto out;
     }
-    ret = object_heap_init(&self->avl_node_heap, sizeof(avl_node_t),
-            self->edges_chunk_size, NULL);
+    ret = path_index_alloc(&self->path_index, self->edges_chunk_size,
+            !!(flags & TSI_SORTED_RUN_PATH_INDEX));
     if (ret != 0) {
         goto out;
     }
@@ -234,9 +593,6 @@ tree_sequence_builder_alloc(tree_sequence_builder_t *self,
     if (ret != 0) {
         goto out;
     }
-    avl_init_tree(&self->left_index, cmp_edge_left_increasing_time, NULL);
-    avl_init_tree(&self->right_index, cmp_edge_right_decreasing_time, NULL);
-    avl_init_tree(&self->path_index, cmp_edge_path, NULL);
 out:
     return ret;
 }
@@ -250,34 +606,19 @@ tree_sequence_builder_free(tree_sequence_builder_t *self)
     tsi_safe_free(self->sites.mutations);
     tsi_safe_free(self->left_index_edges);
     tsi_safe_free(self->right_index_edges);
+    tsi_safe_free(self->pending.added);
+    tsi_safe_free(self->pending.removed);
+    tsi_safe_free(self->checkpoints.position);
+    tsi_safe_free(self->checkpoints.in_index);
+    tsi_safe_free(self->checkpoints.out_index);
+    tsi_safe_free(self->checkpoints.edges_offset);
+    tsi_safe_free(self->checkpoints.edges);
     block_allocator_free(&self->block_allocator);
-    object_heap_free(&self->avl_node_heap);
+    path_index_free(&self->path_index);
     object_heap_free(&self->edge_heap);
     return 0;
 }
 
-static inline avl_node_t * WARN_UNUSED
-tree_sequence_builder_alloc_avl_node(tree_sequence_builder_t *self, indexed_edge_t *e)
-{
-    avl_node_t *ret = NULL;
-
-    if (object_heap_empty(&self->avl_node_heap)) {
-        if (object_heap_expand(&self->avl_node_heap) != 0) {
-            goto out;
-        }
-    }
-    ret = (avl_node_t *) object_heap_alloc_object(&self->avl_node_heap);
-    avl_init_node(ret, e);
-out:
-    return ret;
-}
-
-static inline void
-tree_sequence_builder_free_avl_node(tree_sequence_builder_t *self, avl_node_t *node)
-{
-    object_heap_free_object(&self->avl_node_heap, node);
-}
-
 static inline indexed_edge_t * WARN_UNUSED
 tree_sequence_builder_alloc_edge(tree_sequence_builder_t *self,
         site_id_t left, site_id_t right, node_id_t parent, node_id_t child,
@@ -399,26 +740,42 @@ out:
     return ret;
 }
 
+/* Appends a copy of the specified edge to the specified list of pending edges,
+ * expanding it as necessary. */
 static int WARN_UNUSED
-tree_sequence_builder_unindex_edge(tree_sequence_builder_t *self, indexed_edge_t *edge)
+tree_sequence_builder_append_pending_edge(tree_sequence_builder_t *self,
+        indexed_edge_t **edges, size_t *num_edges, size_t *max_edges,
+        indexed_edge_t *edge)
 {
     int ret = 0;
-    avl_node_t *avl_node;
+    indexed_edge_t *tmp;
+    size_t new_max;
 
-    avl_node = avl_search(&self->left_index, edge);
-    assert(avl_node != NULL);
-    avl_unlink_node(&self->left_index, avl_node);
-    tree_sequence_builder_free_avl_node(self, avl_node);
+    if (*num_edges == *max_edges) {
+        new_max = *max_edges + TSI_MAX(self->edges_chunk_size, *max_edges);
+        tmp = realloc(*edges, new_max * sizeof(**edges));
+        if (tmp == NULL) {
+            ret = TSI_ERR_NO_MEMORY;
+            goto out;
+        }
+        *edges = tmp;
+        *max_edges = new_max;
+    }
+    (*edges)[*num_edges] = *edge;
+    (*edges)[*num_edges].next = NULL;
+    (*num_edges)++;
+out:
+    return ret;
+}
 
-    avl_node = avl_search(&self->right_index, edge);
-    assert(avl_node != NULL);
-    avl_unlink_node(&self->right_index, avl_node);
-    tree_sequence_builder_free_avl_node(self, avl_node);
+static int WARN_UNUSED
+tree_sequence_builder_unindex_edge(tree_sequence_builder_t *self, indexed_edge_t *edge)
+{
+    int ret = 0;
 
-    avl_node = avl_search(&self->path_index, edge);
-    assert(avl_node != NULL);
-    avl_unlink_node(&self->path_index, avl_node);
-    tree_sequence_builder_free_avl_node(self, avl_node);
+    path_index_remove(&self->path_index, edge);
+    ret = tree_sequence_builder_append_pending_edge(self, &self->pending.removed,
+            &self->pending.num_removed, &self->pending.max_removed, edge);
     return ret;
 }
 
@@ -426,31 +783,13 @@ static int WARN_UNUSED
 tree_sequence_builder_index_edge(tree_sequence_builder_t *self, indexed_edge_t *edge)
 {
     int ret = 0;
-    avl_node_t *avl_node;
 
-    avl_node = tree_sequence_builder_alloc_avl_node(self, edge);
-    if (avl_node == NULL) {
-        ret = TSI_ERR_NO_MEMORY;
-        goto out;
-    }
-    avl_node = avl_insert_node(&self->left_index, avl_node);
-    assert(avl_node != NULL);
-
-    avl_node = tree_sequence_builder_alloc_avl_node(self, edge);
-    if (avl_node == NULL) {
-        ret = TSI_ERR_NO_MEMORY;
-        goto out;
-    }
-    avl_node = avl_insert_node(&self->right_index, avl_node);
-    assert(avl_node != NULL);
-
-    avl_node = tree_sequence_builder_alloc_avl_node(self, edge);
-    if (avl_node == NULL) {
-        ret = TSI_ERR_NO_MEMORY;
+    ret = tree_sequence_builder_append_pending_edge(self, &self->pending.added,
+            &self->pending.num_added, &self->pending.max_added, edge);
+    if (ret != 0) {
         goto out;
     }
-    avl_node = avl_insert_node(&self->path_index, avl_node);
-    assert(avl_node != NULL);
+    ret = path_index_insert(&self->path_index, edge);
 out:
     return ret;
 }
@@ -476,43 +815,7 @@ out:
 static indexed_edge_t *
 tree_sequence_builder_find_match(tree_sequence_builder_t *self, indexed_edge_t *query)
 {
-    indexed_edge_t *ret = NULL;
-    indexed_edge_t search, *found;
-    avl_node_t *avl_node;
-
-    search.edge.left = query->edge.left;
-    search.edge.right = query->edge.right;
-    search.edge.parent = query->edge.parent;
-    search.edge.child = 0;
-
-    avl_search_closest(&self->path_index, &search, &avl_node);
-    if (avl_node != NULL) {
-        found = (indexed_edge_t *) avl_node->item;
-        if (found->edge.left == query->edge.left
-                && found->edge.right == query->edge.right
-                && found->edge.parent == query->edge.parent) {
-            ret = found;
-        } else {
-            /* Check the adjacent nodes. */
-            if (avl_node->prev != NULL) {
-                found = (indexed_edge_t *) avl_node->prev->item;
-                if (found->edge.left == query->edge.left
-                        && found->edge.right == query->edge.right
-                        && found->edge.parent == query->edge.parent) {
-                    ret = found;
-                }
-            }
-            if (ret == NULL && avl_node->next != NULL) {
-                found = (indexed_edge_t *) avl_node->next->item;
-                if (found->edge.left == query->edge.left
-                        && found->edge.right == query->edge.right
-                        && found->edge.parent == query->edge.parent) {
-                    ret = found;
-                }
-            }
-        }
-    }
-    return ret;
+    return path_index_find_match(&self->path_index, &query->edge);
 }
 
 typedef struct {
@@ -818,40 +1121,191 @@ out:
     return ret;
 }
 
-/* Freeze the tree traversal indexes from the state of the dynamic AVL
- * tree based indexes. This is done because it is *much* more efficient
- * to get the edges sequentially than to find the randomly around memory
+/* Build the checkpoints used to seek directly to a given tree in the frozen
+ * indexes. We only add a checkpoint when the number of edges inserted since
+ * the last one is at least the number of edges stored in it, so the total
+ * storage required is at most 2 * num_edges.
  */
-int
-tree_sequence_builder_freeze_indexes(tree_sequence_builder_t *self)
+static int
+tree_sequence_builder_build_checkpoints(tree_sequence_builder_t *self)
 {
     int ret = 0;
-    avl_node_t *restrict a;
-    size_t j = 0;
-
-    tsi_safe_free(self->left_index_edges);
-    tsi_safe_free(self->right_index_edges);
-    self->num_edges = avl_count(&self->left_index);
-    assert(self->num_edges == avl_count(&self->right_index));
-
-    self->left_index_edges = malloc(self->num_edges * sizeof(*self->left_index_edges));
-    self->right_index_edges = malloc(self->num_edges * sizeof(*self->right_index_edges));
-    if (self->left_index_edges == NULL || self->right_index_edges == NULL) {
+    const edge_t *in = self->left_index_edges;
+    const edge_t *out = self->right_index_edges;
+    const size_t M = self->num_edges;
+    const size_t max_checkpoints = M / TSI_CHECKPOINT_MIN_EDGES + 1;
+    size_t in_index, out_index, last_in_index, j, k, num_alive, num_stored;
+    site_id_t pos;
+    edge_t *alive = NULL;
+
+    tsi_safe_free(self->checkpoints.position);
+    tsi_safe_free(self->checkpoints.in_index);
+    tsi_safe_free(self->checkpoints.out_index);
+    tsi_safe_free(self->checkpoints.edges_offset);
+    tsi_safe_free(self->checkpoints.edges);
+    self->checkpoints.num_checkpoints = 0;
+
+    self->checkpoints.position = malloc(max_checkpoints * sizeof(site_id_t));
+    self->checkpoints.in_index = malloc(max_checkpoints * sizeof(size_t));
+    self->checkpoints.out_index = malloc(max_checkpoints * sizeof(size_t));
+    self->checkpoints.edges_offset = malloc((max_checkpoints + 1) * sizeof(size_t));
+    self->checkpoints.edges = malloc((2 * M + 1) * sizeof(edge_t));
+    alive = malloc((M + 1) * sizeof(edge_t));
+    if (self->checkpoints.position == NULL || self->checkpoints.in_index == NULL
+            || self->checkpoints.out_index == NULL
+            || self->checkpoints.edges_offset == NULL
+            || self->checkpoints.edges == NULL || alive == NULL) {
         ret = TSI_ERR_NO_MEMORY;
         goto out;
     }
 
-    j = 0;
-    for (a = self->left_index.head; a != NULL; a = a->next) {
-        self->left_index_edges[j] = ((indexed_edge_t *) a->item)->edge;
-        j++;
+    in_index = 0;
+    out_index = 0;
+    last_in_index = 0;
+    num_alive = 0;
+    num_stored = 0;
+    self->checkpoints.edges_offset[0] = 0;
+    while (in_index < M) {
+        pos = in[in_index].left;
+        while (in_index < M && in[in_index].left == pos) {
+            in_index++;
+        }
+        while (out_index < M && out[out_index].right <= pos) {
+            out_index++;
+        }
+        if (in_index - last_in_index >= TSI_MAX(TSI_CHECKPOINT_MIN_EDGES, num_alive)) {
+            /* Retain the edges from the last checkpoint that are still in
+             * the tree, followed by those inserted since. */
+            k = 0;
+            for (j = 0; j < num_alive; j++) {
+                if (alive[j].right > pos) {
+                    alive[k] = alive[j];
+                    k++;
+                }
+            }
+            for (j = last_in_index; j < in_index; j++) {
+                if (in[j].right > pos) {
+                    alive[k] = in[j];
+                    k++;
+                }
+            }
+            num_alive = k;
+            last_in_index = in_index;
+
+            k = self->checkpoints.num_checkpoints;
+            assert(k < max_checkpoints);
+            assert(num_stored + num_alive <= 2 * M);
+            self->checkpoints.position[k] = pos;
+            self->checkpoints.in_index[k] = in_index;
+            self->checkpoints.out_index[k] = out_index;
+            memcpy(self->checkpoints.edges + num_stored, alive,
+                    num_alive * sizeof(edge_t));
+            num_stored += num_alive;
+            self->checkpoints.edges_offset[k + 1] = num_stored;
+            self->checkpoints.num_checkpoints++;
+        }
     }
-    j = 0;
-    for (a = self->right_index.head; a != NULL; a = a->next) {
-        self->right_index_edges[j] = ((indexed_edge_t *) a->item)->edge;
-        j++;
+out:
+    tsi_safe_free(alive);
+    return ret;
+}
+
+/* Merges the specified pending edges into the specified frozen index, writing
+ * the result to dest and returning the number of edges written. The frozen,
+ * added and removed edges must all be sorted using the specified order, and
+ * the removed edges must be present in the union of the frozen and added edges.
+ */
+static size_t
+tree_sequence_builder_merge_index(tree_sequence_builder_t *self,
+        const edge_t *frozen, size_t num_frozen,
+        const indexed_edge_t *added, size_t num_added,
+        const indexed_edge_t *removed, size_t num_removed,
+        index_cmp_func_t cmp, edge_t *dest)
+{
+    const double *restrict time = self->time;
+    size_t j = 0;
+    size_t k = 0;
+    size_t r = 0;
+    size_t num_dest = 0;
+    const edge_t *e;
+    double t;
+
+    while (j < num_frozen || k < num_added) {
+        if (k == num_added || (j < num_frozen && cmp(&frozen[j],
+                    time[frozen[j].child], &added[k].edge, added[k].time) <= 0)) {
+            e = &frozen[j];
+            t = time[e->child];
+            j++;
+        } else {
+            e = &added[k].edge;
+            t = added[k].time;
+            k++;
+        }
+        if (r < num_removed && cmp(e, t, &removed[r].edge, removed[r].time) == 0) {
+            r++;
+        } else {
+            dest[num_dest] = *e;
+            num_dest++;
+        }
+    }
+    assert(r == num_removed);
+    return num_dest;
+}
+
+/* Freeze the tree traversal indexes. This is done because it is *much* more
+ * efficient to get the edges sequentially than to find them randomly around
+ * memory. Rather than rebuilding the indexes from scratch each time, we sort
+ * the edges that have been added and removed since the last freeze and
+ * merge them into the existing indexes.
+ */
+int
+tree_sequence_builder_freeze_indexes(tree_sequence_builder_t *self)
+{
+    int ret = 0;
+    const size_t max_edges = self->num_edges + self->pending.num_added;
+    indexed_edge_t *added = self->pending.added;
+    indexed_edge_t *removed = self->pending.removed;
+    size_t num_added = self->pending.num_added;
+    size_t num_removed = self->pending.num_removed;
+    edge_t *left_index_edges = NULL;
+    edge_t *right_index_edges = NULL;
+    size_t num_edges;
+
+    left_index_edges = malloc((max_edges + 1) * sizeof(*left_index_edges));
+    right_index_edges = malloc((max_edges + 1) * sizeof(*right_index_edges));
+    if (left_index_edges == NULL || right_index_edges == NULL) {
+        ret = TSI_ERR_NO_MEMORY;
+        goto out;
     }
+
+    qsort(added, num_added, sizeof(*added), cmp_edge_left_increasing_time);
+    qsort(removed, num_removed, sizeof(*removed), cmp_edge_left_increasing_time);
+    num_edges = tree_sequence_builder_merge_index(self,
+            self->left_index_edges, self->num_edges, added, num_added,
+            removed, num_removed, cmp_index_left_increasing_time, left_index_edges);
+
+    qsort(added, num_added, sizeof(*added), cmp_edge_right_decreasing_time);
+    qsort(removed, num_removed, sizeof(*removed), cmp_edge_right_decreasing_time);
+    tree_sequence_builder_merge_index(self,
+            self->right_index_edges, self->num_edges, added, num_added,
+            removed, num_removed, cmp_index_right_decreasing_time, right_index_edges);
+    assert(num_edges == tree_sequence_builder_get_num_edges(self));
+
+    tsi_safe_free(self->left_index_edges);
+    tsi_safe_free(self->right_index_edges);
+    self->left_index_edges = left_index_edges;
+    self->right_index_edges = right_index_edges;
+    left_index_edges = NULL;
+    right_index_edges = NULL;
+    self->num_edges = num_edges;
+    self->num_frozen_nodes = self->num_nodes;
+    self->pending.num_added = 0;
+    self->pending.num_removed = 0;
+
+    ret = tree_sequence_builder_build_checkpoints(self);
 out:
+    tsi_safe_free(left_index_edges);
+    tsi_safe_free(right_index_edges);
     return ret;
 }
 
@@ -1003,7 +1457,7 @@ tree_sequence_builder_get_num_nodes(tree_sequence_builder_t *self)
 size_t
 tree_sequence_builder_get_num_edges(tree_sequence_builder_t *self)
 {
-    return avl_count(&self->left_index);
+    return self->num_edges + self->pending.num_added - self->pending.num_removed;
 }
 
 size_t
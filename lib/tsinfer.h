@@ -41,9 +41,23 @@
 
 #define TSI_COMPRESS_PATH   1
 #define TSI_EXTENDED_CHECKS 2
+#define TSI_BITPACK_GENOTYPES 4
+#define TSI_INTERVAL_LABELS 8
+#define TSI_SORTED_RUN_PATH_INDEX 16
 
 #define TSI_NODE_IS_PC_ANCESTOR ((uint32_t) (1u << 16))
 
+/* The minimum number of edge insertions between tree position checkpoints */
+#define TSI_CHECKPOINT_MIN_EDGES 64
+
+#define TSI_DEFAULT_TRACEBACK_BLOCK_SIZE (64 * 1024 * 1024)
+
+/* The path index used for path compression is a hash table by default. If
+ * the TSI_SORTED_RUN_PATH_INDEX flag is set, it is stored as a set of sorted
+ * runs instead. Run k holds at most TSI_PATH_INDEX_RUN_SIZE * 2^k edges. */
+#define TSI_PATH_INDEX_RUN_SIZE 64
+#define TSI_PATH_INDEX_MAX_RUNS 48
+
 /* TODO change all instances of this to node_id_t */
 typedef int32_t ancestor_id_t;
 typedef int32_t node_id_t;
@@ -62,8 +76,35 @@ typedef struct _indexed_edge_t {
     edge_t edge;
     double time;
     struct _indexed_edge_t *next;
+    /* The next edge in the same path index hash table bucket */
+    struct _indexed_edge_t *hash_next;
 } indexed_edge_t;
 
+typedef struct {
+    edge_t edge;
+    indexed_edge_t *item; /* NULL if the edge has been removed from the index */
+} path_index_entry_t;
+
+/* The index of edges by (left, right, parent) used for path compression.
+ *
+ * By default this is a hash table. The edges in each bucket are chained
+ * through their hash_next pointers. The number of buckets is a power of two,
+ * and is doubled when the number of edges exceeds it.
+ *
+ * If sorted_runs is true, the edges are instead kept in a log-structured set
+ * of runs sorted by (left, right, parent, child). New edges are inserted into
+ * the smallest run, and when a run fills up it is merged into the first
+ * larger run with space for it. Removed edges are marked in place and dropped
+ * when their run is next merged. */
+typedef struct {
+    bool sorted_runs;
+    indexed_edge_t **table;
+    size_t table_mask;
+    path_index_entry_t *runs[TSI_PATH_INDEX_MAX_RUNS];
+    size_t run_size[TSI_PATH_INDEX_MAX_RUNS];
+    size_t num_edges;
+} path_index_t;
+
 typedef struct _node_segment_list_node_t {
     ancestor_id_t start;
     ancestor_id_t end;
@@ -81,6 +122,12 @@ typedef struct _segment_t {
 typedef struct {
     size_t frequency;
     allele_t *genotypes;
+    /* When genotypes are bitpacked, sample j is stored in bit 63 - (j % 64)
+     * of word j / 64, and genotypes is NULL. */
+    uint64_t *packed_genotypes;
+    /* Low frequency sites are stored as the sorted list of the frequency
+     * samples carrying the derived state, and genotypes is NULL. */
+    node_id_t *carriers;
 } site_t;
 
 typedef struct {
@@ -95,11 +142,17 @@ typedef struct _site_list_t {
     struct _site_list_t *next;
 } site_list_t;
 
-typedef struct {
+typedef struct _pattern_map_t {
     allele_t *genotypes;
+    uint64_t *packed_genotypes;
+    node_id_t *carriers;
+    size_t frequency;
     size_t num_samples;
     size_t num_sites;
     site_list_t *sites;
+    uint64_t hash;
+    /* The next pattern in the same pattern_table bucket */
+    struct _pattern_map_t *next;
 } pattern_map_t;
 
 typedef struct {
@@ -112,15 +165,47 @@ typedef struct {
     size_t num_sites;
     size_t num_samples;
     size_t num_ancestors;
+    size_t num_words; /* The number of 64 bit words in a packed genotype array */
+    /* Sites with frequency <= max_sparse_frequency are stored as carrier lists */
+    size_t max_sparse_frequency;
     int flags;
     site_t *sites;
+    /* Hash index of the unique genotype patterns, with a power of two number
+     * of buckets. This is used to find the pattern for each site as it is added. */
+    pattern_map_t **pattern_table;
+    size_t pattern_table_mask;
+    size_t num_patterns;
+    size_t num_indexed_patterns;
     /* frequency_map[f] is an AVL tree mapping unique genotypes to the sites that
-     * the occur at. Each of these sites has frequency f. */
+     * the occur at. Each of these sites has frequency f. The trees are built
+     * from the pattern_table when the builder is finalised. */
     avl_tree_t *frequency_map;
     block_allocator_t allocator;
     ancestor_descriptor_t *descriptors;
+    uint64_t *packed_genotypes_buffer;
+    node_id_t *carriers_buffer;
+    /* Binary tree over the sites in which each node stores the maximum
+     * frequency of the sites below it. The leaf for site j is at index
+     * num_tree_leaves + j, and the children of node u are 2u and 2u + 1. */
+    size_t *frequency_tree;
+    size_t num_tree_leaves;
 } ancestor_builder_t;
 
+/* Scratch memory used when making ancestors. Each thread calling
+ * ancestor_builder_make_ancestor concurrently must have its own workspace. */
+typedef struct {
+    size_t num_samples;
+    size_t num_words;
+    node_id_t *sample_set;
+    /* The genotypes of the samples in sample_set at the current site, and
+     * whether they disagreed with the consensus at the previous site. */
+    allele_t *genotypes;
+    bool *disagree;
+    /* Bitmask versions of the above used with packed genotypes */
+    uint64_t *sample_set_mask;
+    uint64_t *disagree_mask;
+} ancestor_builder_workspace_t;
+
 typedef struct _mutation_list_node_t {
     ancestor_id_t node;
     allele_t derived_state;
@@ -129,10 +214,23 @@ typedef struct _mutation_list_node_t {
 
 typedef struct {
     int32_t size;
+    /* If non-zero, this is the last site in a run of run_length sites that
+     * have no mutations and at which no recombination is required. */
+    int32_t run_length;
     node_id_t *node;
     int8_t *recombination_required;
 } node_state_list_t;
 
+/* An array stored in the traceback, indexed by the hash of its contents so
+ * that identical arrays seen anywhere during a match are stored only once.
+ * Entries with a generation other than the current one are empty. */
+typedef struct {
+    void *data;
+    size_t num_bytes;
+    uint32_t hash;
+    uint32_t generation;
+} traceback_entry_t;
+
 typedef struct {
     int flags;
     size_t num_sites;
@@ -149,19 +247,40 @@ typedef struct {
     size_t num_nodes;
     size_t num_mutations;
     block_allocator_t block_allocator;
-    object_heap_t avl_node_heap;
     object_heap_t edge_heap;
-    /* Dynamic edge indexes used for tree generation and path compression. The
-     * AVL trees are used to keep the indexes updated without needing to perform
-     * repeated sorting */
-    avl_tree_t left_index;
-    avl_tree_t right_index;
-    avl_tree_t path_index;
-    /* The static tree generation indexes. We populate these at the end of each
-     * epoch using the order defined by the AVL trees. */
+    /* Dynamic edge index used for path compression. */
+    path_index_t path_index;
+    /* The static tree generation indexes. We update these at the start of each
+     * epoch by merging in the edges that have been indexed and unindexed since
+     * the last freeze. */
     edge_t *left_index_edges;
     edge_t *right_index_edges;
     size_t num_edges; /* the number of edges in the frozen indexes */
+    /* The number of nodes when the indexes were last frozen. The matchers only
+     * use these nodes, so that other nodes can be added while they run. */
+    size_t num_frozen_nodes;
+    /* The edges that have been indexed (added) and unindexed (removed) since
+     * the indexes were last frozen, recorded by value. */
+    struct {
+        indexed_edge_t *added;
+        indexed_edge_t *removed;
+        size_t num_added;
+        size_t num_removed;
+        size_t max_added;
+        size_t max_removed;
+    } pending;
+    /* Checkpoints into the frozen indexes, so that we can seek directly to the
+     * tree at a given site. Checkpoint j is the state after processing all
+     * edges with left <= position[j]; the edges in the tree at this point are
+     * stored in left index order in edges[edges_offset[j]:edges_offset[j + 1]] */
+    struct {
+        site_id_t *position;
+        size_t *in_index;
+        size_t *out_index;
+        size_t *edges_offset;
+        edge_t *edges;
+        size_t num_checkpoints;
+    } checkpoints;
 } tree_sequence_builder_t;
 
 typedef struct {
@@ -170,6 +289,9 @@ typedef struct {
     size_t num_nodes;
     size_t num_sites;
     size_t max_nodes;
+    /* Per node state for nodes [0, num_reset_nodes) is known to be in the
+     * reset state between calls, so we only need to initialise new nodes. */
+    size_t num_reset_nodes;
     /* The quintuply linked tree */
     node_id_t *parent;
     node_id_t *left_child;
@@ -180,6 +302,8 @@ typedef struct {
     int8_t *likelihood_cache;
     int8_t *path_cache;
     int num_likelihood_nodes;
+    /* Deleted nodes still to be removed from likelihood_nodes */
+    int num_deleted_likelihood_nodes;
     /* At each site, record a node with the maximum likelihood. */
     node_id_t *max_likelihood_node;
     /* Used during traceback to map nodes where recombination is required. */
@@ -189,6 +313,26 @@ typedef struct {
     node_state_list_t *traceback;
     block_allocator_t traceback_allocator;
     size_t total_traceback_size;
+    /* Hash table of the distinct arrays stored in the traceback allocator
+     * during the current match. */
+    struct {
+        traceback_entry_t *entries;
+        size_t mask;
+        size_t num_entries;
+        uint32_t generation;
+    } traceback_table;
+    /* Workspace used to build recombination_required lists before storing. */
+    int8_t *traceback_scratch;
+    /* Pre-order interval labels for the nodes in the current tree, used for
+     * descendant tests when TSI_INTERVAL_LABELS is set. Node u is labelled
+     * with [left[u], right[u]) only if epoch[u] is the current epoch. */
+    struct {
+        int32_t *left;
+        int32_t *right;
+        uint32_t *epoch;
+        uint32_t current_epoch;
+        int32_t next_label;
+    } intervals;
     struct {
         site_id_t *left;
         site_id_t *right;
@@ -204,13 +348,20 @@ int ancestor_builder_free(ancestor_builder_t *self);
 int ancestor_builder_print_state(ancestor_builder_t *self, FILE *out);
 int ancestor_builder_add_site(ancestor_builder_t *self, site_id_t site,
         size_t frequency, allele_t *genotypes);
+int ancestor_builder_add_sites(ancestor_builder_t *self, size_t num_sites,
+        site_id_t *site_ids, allele_t *genotypes);
 int ancestor_builder_make_ancestor(ancestor_builder_t *self,
+        ancestor_builder_workspace_t *workspace,
         size_t num_focal_sites, site_id_t *focal_sites,
         site_id_t *start, site_id_t *end, allele_t *haplotype);
 int ancestor_builder_finalise(ancestor_builder_t *self);
+int ancestor_builder_workspace_alloc(ancestor_builder_workspace_t *self,
+        size_t num_samples);
+int ancestor_builder_workspace_free(ancestor_builder_workspace_t *self);
 
 int ancestor_matcher_alloc(ancestor_matcher_t *self,
-        tree_sequence_builder_t *tree_sequence_builder, int flags);
+        tree_sequence_builder_t *tree_sequence_builder,
+        size_t traceback_block_size, int flags);
 int ancestor_matcher_free(ancestor_matcher_t *self);
 int ancestor_matcher_find_path(ancestor_matcher_t *self,
         site_id_t start, site_id_t end, allele_t *haplotype,
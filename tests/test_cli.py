@@ -160,6 +160,12 @@ class TestCommandsDefaults(TestCli):
         self.run_command(["match-samples", self.sample_file, "-O", output_trees])
         self.verify_output(output_trees)
 
+    def test_num_decode_threads(self):
+        output_trees = os.path.join(self.tempdir.name, "output.trees")
+        self.run_command(["infer", self.sample_file, "-O", output_trees, "-D", "2"])
+        self.verify_output(output_trees)
+        self.run_command(["verify", self.sample_file, output_trees, "-D", "2"])
+
     def test_verify(self):
         output_trees = os.path.join(self.tempdir.name, "output.trees")
         self.run_command(["infer", self.sample_file, "-O", output_trees])
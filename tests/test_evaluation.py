@@ -812,6 +812,18 @@ class TestCli(unittest.TestCase):
     def test_ancestor_quality(self):
         self.run_command(["ancestor-quality", "-n", "5", "-l", "0.1"])
 
+    def test_matcher_overhead(self):
+        self.run_command([
+            "matcher-overhead", "-n", "10", "-l", "0.1", "-R", "1", "-s", "1"])
+
+    def test_add_sites_performance(self):
+        self.run_command([
+            "add-sites-performance", "-n", "10", "-m", "20", "-R", "1", "-s", "1"])
+
+    def test_root_turnover(self):
+        self.run_command([
+            "root-turnover", "-n", "10", "-l", "0.1", "-R", "1", "-s", "1"])
+
 
 class TestCountSampleChildEdges(unittest.TestCase):
     """
@@ -25,6 +25,7 @@ import tempfile
 import os.path
 import datetime
 import warnings
+import threading
 
 import numpy as np
 import msprime
@@ -698,6 +699,54 @@ class TestSampleData(unittest.TestCase, DataContainerMixin):
         data.finalise()
         self.assertEqual(data.sequence_length, 1)
 
+    def verify_haplotype_index(self, data):
+        self.assertTrue(data.has_haplotype_index)
+        inference = data.sites_inference[:] == 1
+        G = data.sites_genotypes[:][inference]
+        self.assertEqual(
+            data.samples_inference_haplotypes.shape, (data.num_samples, G.shape[0]))
+        self.assertTrue(np.array_equal(data.samples_inference_haplotypes[:], G.T))
+        for subset in [None, [0], [1, 4, 5], np.arange(data.num_samples)]:
+            haplotypes = list(data.haplotypes(subset, inference_sites=True))
+            samples = np.arange(data.num_samples) if subset is None else subset
+            self.assertEqual([j for j, _ in haplotypes], list(samples))
+            for j, h in haplotypes:
+                self.assertTrue(np.array_equal(h, G[:, j]))
+
+    def test_haplotype_index(self):
+        ts = self.get_example_ts(13, 10)
+        with tempfile.TemporaryDirectory(prefix="tsinf_format_test") as tempdir:
+            filename = os.path.join(tempdir, "samples.tmp")
+            for path in [None, filename]:
+                data = formats.SampleData(
+                    sequence_length=ts.sequence_length, path=path, chunk_size=4,
+                    index_haplotypes=True)
+                self.verify_data_round_trip(ts, data)
+                self.verify_haplotype_index(data)
+                self.assertIn("samples/inference_haplotypes", str(data))
+                no_index = formats.SampleData(
+                    sequence_length=ts.sequence_length, chunk_size=4)
+                self.verify_data_round_trip(ts, no_index)
+                self.assertFalse(no_index.has_haplotype_index)
+                self.assertTrue(no_index.data_equal(data))
+                data.close()
+
+    def test_copy_haplotype_index(self):
+        with formats.SampleData(chunk_size=2, index_haplotypes=True) as data:
+            for j in range(5):
+                data.add_site(position=j, genotypes=[0, 1, j % 2, 1, 0, 0])
+        self.verify_haplotype_index(data)
+        with data.copy() as copy:
+            copy.sites_inference = [0, 1, 0, 1, 1]
+        self.verify_haplotype_index(copy)
+        self.assertEqual(copy.samples_inference_haplotypes.shape, (6, 3))
+        with data.copy(index_haplotypes=False) as copy:
+            pass
+        self.assertFalse(copy.has_haplotype_index)
+        with copy.copy(index_haplotypes=True) as other:
+            pass
+        self.verify_haplotype_index(other)
+
 
 class TestAncestorData(unittest.TestCase, DataContainerMixin):
     """
@@ -1081,3 +1130,115 @@ class TestBufferedItemWriterThreads2(unittest.TestCase, BufferedItemWriterMixin)
 
 class TestBufferedItemWriterThreads20(unittest.TestCase, BufferedItemWriterMixin):
     num_threads = 20
+
+
+class PrefetchIteratorMixin(object):
+    """
+    Tests for the iterators that decode chunks ahead of the consumer.
+    """
+    def test_prefetch_order(self):
+        for num_items in [0, 1, 5, 33]:
+            items = list(formats.prefetch_iterator(
+                lambda j: j * j, num_items, num_threads=self.num_threads))
+            self.assertEqual(items, [j * j for j in range(num_items)])
+
+    def test_prefetch_early_exit(self):
+        before = threading.active_count()
+        for _ in range(5):
+            iterator = formats.prefetch_iterator(
+                lambda j: j, 100, num_threads=self.num_threads, queue_depth=1)
+            self.assertEqual(next(iterator), 0)
+            iterator.close()
+        self.assertEqual(threading.active_count(), before)
+
+    def test_chunk_iterator(self):
+        for n, chunks in [(0, 2), (1, 2), (10, 3), (10, 10), (11, 100)]:
+            z = zarr.array(np.arange(2 * n).reshape((n, 2)), chunks=(chunks, 1))
+            rows = list(formats.chunk_iterator(z, num_threads=self.num_threads))
+            self.assertEqual(len(rows), n)
+            for j, row in enumerate(rows):
+                self.assertTrue(np.array_equal(row, z[j]))
+
+    def test_sample_data(self):
+        ts = msprime.simulate(
+            11, mutation_rate=5, recombination_rate=1, random_seed=5)
+        with tempfile.TemporaryDirectory(prefix="tsinf_format_test") as tempdir:
+            filename = os.path.join(tempdir, "samples.tmp")
+            sample_data = formats.SampleData.from_tree_sequence(
+                ts, path=filename, chunk_size=3, num_decode_threads=self.num_threads)
+            G = ts.genotype_matrix()
+            genotypes = list(sample_data.genotypes())
+            self.assertEqual(len(genotypes), ts.num_sites)
+            for j, a in genotypes:
+                self.assertTrue(np.array_equal(a, G[j]))
+            haplotypes = list(sample_data.haplotypes())
+            self.assertEqual(len(haplotypes), ts.num_samples)
+            for j, h in haplotypes:
+                self.assertTrue(np.array_equal(h, G[:, j]))
+            for v1, v2 in zip(sample_data.variants(), ts.variants()):
+                self.assertTrue(np.array_equal(v1.genotypes, v2.genotypes))
+            source = tsinfer.generate_ancestors(sample_data, chunk_size=3)
+            ancestor_data = formats.AncestorData(
+                sample_data, chunk_size=3, num_decode_threads=self.num_threads)
+            for a in source.ancestors():
+                ancestor_data.add_ancestor(
+                    a.start, a.end, a.time, a.focal_sites, a.haplotype)
+            ancestor_data.finalise()
+            haplotypes = source.ancestors_haplotype[:]
+            ancestors = list(ancestor_data.ancestors())
+            self.assertEqual(len(ancestors), source.num_ancestors)
+            for ancestor in ancestors:
+                self.assertTrue(
+                    np.array_equal(ancestor.haplotype, haplotypes[ancestor.id]))
+            sample_data.close()
+
+
+    def get_chunked_sample_data(self, num_decode_threads):
+        ts = msprime.simulate(
+            11, mutation_rate=5, recombination_rate=1, random_seed=6)
+        sample_data = formats.SampleData(
+            sequence_length=ts.sequence_length, chunk_size=3,
+            num_decode_threads=num_decode_threads)
+        for j, variant in enumerate(ts.variants()):
+            sample_data.add_site(
+                variant.site.position, variant.genotypes,
+                inference=False if j % 4 == 0 else None)
+        sample_data.finalise()
+        return sample_data
+
+    def test_generate_ancestors(self):
+        a1 = tsinfer.generate_ancestors(self.get_chunked_sample_data(0))
+        a2 = tsinfer.generate_ancestors(self.get_chunked_sample_data(self.num_threads))
+        self.assertEqual(a1.num_ancestors, a2.num_ancestors)
+        for x, y in zip(a1.ancestors(), a2.ancestors()):
+            self.assertEqual((x.start, x.end, x.time), (y.start, y.end, y.time))
+            self.assertTrue(np.array_equal(x.focal_sites, y.focal_sites))
+            self.assertTrue(np.array_equal(x.haplotype, y.haplotype))
+
+    def test_generate_ancestors_error(self):
+
+        class FailingAncestorBuilder(object):
+            def add_sites(self, site_ids, genotypes):
+                raise ValueError("add_sites failed")
+
+        sample_data = self.get_chunked_sample_data(self.num_threads)
+        before = threading.active_count()
+        generator = tsinfer.inference.AncestorsGenerator(
+            sample_data, None, tsinfer.inference.DummyProgressMonitor(),
+            tsinfer.PY_ENGINE)
+        generator.ancestor_builder = FailingAncestorBuilder()
+        self.assertRaises(ValueError, generator.add_sites)
+        # None of the decode threads are left blocked on their queues.
+        self.assertEqual(threading.active_count(), before)
+
+
+class TestPrefetchIteratorSynchronous(unittest.TestCase, PrefetchIteratorMixin):
+    num_threads = 0
+
+
+class TestPrefetchIteratorThreads1(unittest.TestCase, PrefetchIteratorMixin):
+    num_threads = 1
+
+
+class TestPrefetchIteratorThreads3(unittest.TestCase, PrefetchIteratorMixin):
+    num_threads = 3
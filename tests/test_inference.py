@@ -24,12 +24,17 @@ import random
 import string
 import json
 import math
+import re
+import time
 
 import numpy as np
 import msprime
 
+import _tsinfer
 import tsinfer
+import tsinfer.algorithm as algorithm
 import tsinfer.eval_util as eval_util
+import tsinfer.inference as inference
 
 
 def get_random_data_example(num_samples, num_sites, seed=42):
@@ -501,6 +506,10 @@ class TestAncestorGeneratorsEquivalant(unittest.TestCase):
             sample_data, engine=tsinfer.C_ENGINE, num_threads=num_threads)
         adp = tsinfer.generate_ancestors(
             sample_data, engine=tsinfer.PY_ENGINE, num_threads=num_threads)
+        adc_packed = tsinfer.generate_ancestors(
+            sample_data, engine=tsinfer.C_ENGINE, num_threads=num_threads,
+            bitpack_genotypes=True)
+        self.assertTrue(adc_packed.data_equal(adc))
 
         # # TODO clean this up when we're finished mucking around with the
         # # ancestor generator.
@@ -574,6 +583,42 @@ class TestAncestorGeneratorsEquivalant(unittest.TestCase):
         assert ts.num_sites > 100
         self.verify_ancestor_generator(ts.genotype_matrix(), num_threads=3)
 
+    def test_many_samples(self):
+        # More than one 64 bit word is needed for the bitpacked genotypes.
+        ts = msprime.simulate(
+            150, length=5, recombination_rate=1, mutation_rate=1, random_seed=2)
+        assert ts.num_sites > 20
+        self.verify_ancestor_generator(ts.genotype_matrix())
+
+    def test_random_data_many_samples(self):
+        G, _ = get_random_data_example(130, 40, seed=1234)
+        self.verify_ancestor_generator(G)
+
+    def test_rare_variants(self):
+        # Low frequency sites are stored as sparse carrier lists, so make
+        # sure we have plenty of these mixed in with common sites.
+        ts = msprime.simulate(
+            200, length=10, recombination_rate=1, mutation_rate=2, random_seed=5)
+        G = ts.genotype_matrix()
+        frequency = np.sum(G, axis=1)
+        max_sparse_frequency = G.shape[1] // 64
+        assert np.sum((frequency > 1) & (frequency <= max_sparse_frequency)) > 20
+        assert np.sum(frequency > max_sparse_frequency) > 20
+        self.verify_ancestor_generator(G)
+
+    def test_high_frequency_sites_far_apart(self):
+        # Ancestors skip over runs of sites with lower frequency than the
+        # focal site, so make sure we have some long runs.
+        ts = msprime.simulate(
+            50, length=10, recombination_rate=1, mutation_rate=20, random_seed=23)
+        G = ts.genotype_matrix()
+        frequency = np.sum(G, axis=1)
+        common = np.where(frequency > 10)[0][::20]
+        keep = frequency <= 3
+        keep[common] = True
+        assert np.sum(frequency[keep] <= 3) > 20 * len(common)
+        self.verify_ancestor_generator(G[keep])
+
 
 class TestGeneratedAncestors(unittest.TestCase):
     """
@@ -958,6 +1003,16 @@ class AlgorithmsExactlyEqualMixin(object):
             ts = tsinfer.insert_perfect_mutations(ts, delta=1/8192)
             self.verify(ts)
 
+    def test_many_trees(self):
+        # Enough edges that the C matcher seeks using tree position checkpoints.
+        for seed in range(2):
+            ts = msprime.simulate(
+                12, recombination_rate=1, random_seed=seed + 1, length=5,
+                model="smc_prime")
+            self.assertGreater(ts.num_trees, 10)
+            ts = tsinfer.insert_perfect_mutations(ts, delta=1/8192)
+            self.verify(ts)
+
 
 class TestAlgorithmsExactlyEqualNoPathCompression(
         unittest.TestCase, AlgorithmsExactlyEqualMixin):
@@ -969,6 +1024,625 @@ class TestAlgorithmsExactlyEqualPathCompression(
     path_compression_enabled = True
 
 
+class TestFreezeIndexesLogging(unittest.TestCase):
+    """
+    Tests for the edge counts logged when the indexes are frozen at the start
+    of each epoch.
+    """
+    def get_counts(self, sample_data, ancestor_data, engine):
+        with self.assertLogs("tsinfer.inference", level="DEBUG") as logs:
+            tsinfer.match_ancestors(sample_data, ancestor_data, engine=engine)
+        counts = []
+        for record in logs.records:
+            match = re.match(
+                r"Froze indexes for (\d+) edges in [0-9.]+s: merged (\d+) added and "
+                r"(\d+) removed edges into (\d+) previously frozen edges",
+                record.getMessage())
+            if match is not None:
+                counts.append(tuple(int(x) for x in match.groups()))
+        return counts
+
+    def test_counts(self):
+        ts = msprime.simulate(
+            15, mutation_rate=5, recombination_rate=2, random_seed=5)
+        sample_data = tsinfer.SampleData.from_tree_sequence(ts)
+        ancestor_data = tsinfer.generate_ancestors(sample_data)
+        counts = self.get_counts(sample_data, ancestor_data, tsinfer.C_ENGINE)
+        self.assertEqual(
+            counts, self.get_counts(sample_data, ancestor_data, tsinfer.PY_ENGINE))
+        self.assertGreater(len(counts), 2)
+        num_frozen = 0
+        for num_edges, num_added, num_removed, num_previous in counts:
+            self.assertEqual(num_previous, num_frozen)
+            self.assertEqual(num_edges, num_previous + num_added - num_removed)
+            num_frozen = num_edges
+        # Most of the edges are frozen once and then reused in later epochs.
+        self.assertLess(counts[-1][1], counts[-1][3])
+
+
+class TestMutationFreeSiteRuns(unittest.TestCase):
+    """
+    Tests that the C matcher, which processes runs of sites without mutations
+    as a single step, finds the same paths as the Python matcher.
+    """
+    num_sites = 30
+    # The edges change at site 12, and there are mutations at sites 2, 20 and 21
+    # only, so that there are long runs of sites without mutations on either
+    # side of the tree boundary.
+    nodes = [5, 4, 3, 3, 2, 2, 1]
+    edges = [
+        (0, 30, 0, 1),
+        (0, 30, 1, 2),
+        (0, 30, 1, 3),
+        (0, 12, 2, 4), (12, 30, 3, 4),
+        (0, 12, 3, 5), (12, 30, 2, 5),
+        (0, 12, 4, 6), (12, 30, 5, 6)]
+    mutations = [(2, 4), (20, 5), (21, 6)]
+
+    def get_matcher(self, engine):
+        if engine == tsinfer.C_ENGINE:
+            tsb = _tsinfer.TreeSequenceBuilder(
+                num_sites=self.num_sites, max_nodes=16, max_edges=16)
+        else:
+            tsb = algorithm.TreeSequenceBuilder(
+                num_sites=self.num_sites, max_nodes=16, max_edges=16)
+        for time in self.nodes:
+            tsb.add_node(time)
+        left, right, parent, child = (
+            np.array(column, dtype=np.int32) for column in zip(*self.edges))
+        tsb.restore_edges(left, right, parent, child)
+        site, node = (
+            np.array(column, dtype=np.int32) for column in zip(*self.mutations))
+        tsb.restore_mutations(
+            site, node, np.ones_like(site, dtype=np.int8),
+            np.zeros_like(site) - 1)
+        if engine == tsinfer.C_ENGINE:
+            return _tsinfer.AncestorMatcher(tsb, extended_checks=True)
+        return algorithm.AncestorMatcher(tsb, extended_checks=True)
+
+    def setUp(self):
+        # The matchers are reused, so that the state left behind by one match
+        # can affect the next, as in inference.
+        self.matchers = [
+            self.get_matcher(engine) for engine in [tsinfer.C_ENGINE, tsinfer.PY_ENGINE]]
+
+    def verify(self, h, start, end):
+        results = []
+        for matcher in self.matchers:
+            match = np.zeros(self.num_sites, dtype=np.uint8)
+            left, right, parent = matcher.find_path(h, start, end, match)
+            results.append((left, right, parent, match[start: end]))
+        for a, b in zip(*results):
+            self.assertTrue(np.array_equal(a, b))
+
+    def get_haplotypes(self):
+        H = np.zeros((5, self.num_sites), dtype=np.uint8)
+        H[1, 2] = 1
+        H[2, [20, 21]] = 1
+        H[3, [2, 21]] = 1
+        H[4, [2, 20]] = 1
+        return H
+
+    def test_full_window(self):
+        for h in self.get_haplotypes():
+            self.verify(h, 0, self.num_sites)
+
+    def test_run_ends_at_tree_boundary(self):
+        # The runs after site 2 end at the tree boundary at site 12.
+        for h in self.get_haplotypes():
+            for end in [12, 13, 20]:
+                self.verify(h, 0, end)
+
+    def test_partial_window(self):
+        # Windows that start and end inside the runs of sites without mutations.
+        for h in self.get_haplotypes():
+            for start, end in [(1, 30), (5, 30), (5, 10), (7, 18), (13, 25), (22, 29)]:
+                self.verify(h, start, end)
+
+
+class TestTracebackBlockSize(unittest.TestCase):
+    """
+    Tests that the size of the blocks used to store the matcher traceback
+    does not affect the output.
+    """
+    def infer(self, sample_data, traceback_block_size):
+        ancestor_data = tsinfer.generate_ancestors(sample_data)
+        matcher = inference.AncestorMatcher(
+            sample_data, ancestor_data, extended_checks=True,
+            traceback_block_size=traceback_block_size)
+        ancestors_ts = matcher.match_ancestors()
+        for ancestor_matcher in matcher.matcher:
+            self.assertGreater(ancestor_matcher.total_memory, 0)
+        matcher = inference.SampleMatcher(
+            sample_data, ancestors_ts, extended_checks=True,
+            traceback_block_size=traceback_block_size)
+        matcher.match_samples()
+        return matcher.finalise(simplify=True, stabilise_node_ordering=False)
+
+    def test_small_blocks(self):
+        ts = msprime.simulate(
+            15, mutation_rate=5, recombination_rate=2, random_seed=5)
+        sample_data = tsinfer.SampleData.from_tree_sequence(ts)
+        ts1 = self.infer(sample_data, 64 * 1024 * 1024)
+        # A block size this small forces lists into their own allocations.
+        for block_size in [1, 16, 1024]:
+            ts2 = self.infer(sample_data, block_size)
+            self.assertEqual(ts1.tables.nodes, ts2.tables.nodes)
+            self.assertEqual(ts1.tables.edges, ts2.tables.edges)
+            self.assertEqual(ts1.tables.mutations, ts2.tables.mutations)
+
+
+class TestResultBuffer(unittest.TestCase):
+    """
+    Tests for the ResultBuffer used to collect the results of matching.
+    """
+    def test_empty(self):
+        buff = inference.ResultBuffer()
+        node_ids, offset, left, right, parent = buff.get_paths()
+        self.assertEqual(node_ids.shape, (0,))
+        self.assertEqual(list(offset), [0])
+        self.assertEqual(left.shape, (0,))
+        self.assertEqual(buff.total_edges, 0)
+        node_ids, offset, site, derived_state = buff.get_mutations()
+        self.assertEqual(node_ids.shape, (0,))
+        self.assertEqual(site.shape, (0,))
+
+    def test_paths_ordered_by_node(self):
+        buff = inference.ResultBuffer(num_threads=2)
+        buff.set_path(5, [0, 1], [1, 2], [0, 1], thread_index=1)
+        buff.set_paths(
+            [3, 4], [0, 1, 4], [0, 0, 1, 2], [3, 1, 2, 3], [1, 2, 3, 4],
+            thread_index=0)
+        buff.set_path(2, [0], [3], [1], thread_index=1)
+        self.assertEqual(buff.total_edges, 7)
+        node_ids, offset, left, right, parent = buff.get_paths()
+        self.assertEqual(list(node_ids), [2, 3, 4, 5])
+        self.assertEqual(list(offset), [0, 1, 2, 5, 7])
+        self.assertEqual(list(left), [0, 0, 0, 1, 2, 0, 1])
+        self.assertEqual(list(right), [3, 3, 1, 2, 3, 1, 2])
+        self.assertEqual(list(parent), [1, 1, 2, 3, 4, 0, 1])
+        buff.clear()
+        self.assertEqual(buff.total_edges, 0)
+        self.assertEqual(buff.get_paths()[0].shape, (0,))
+
+    def test_mutations_ordered_by_node(self):
+        buff = inference.ResultBuffer(num_threads=2)
+        buff.set_mutations(7, np.array([1, 2], dtype=np.int32), thread_index=1)
+        buff.set_mutations_bulk(
+            [1, 6], [0, 0, 1], np.array([4], dtype=np.int32), np.array([0]),
+            thread_index=0)
+        node_ids, offset, site, derived_state = buff.get_mutations()
+        self.assertEqual(list(node_ids), [1, 6, 7])
+        self.assertEqual(list(offset), [0, 0, 1, 3])
+        self.assertEqual(list(site), [4, 1, 2])
+        self.assertEqual(list(derived_state), [0, 1, 1])
+
+    def test_take(self):
+        buff = inference.ResultBuffer(num_threads=2)
+        buff.set_path(5, [0, 1], [1, 2], [0, 1], thread_index=1)
+        buff.set_mutations(5, np.array([1], dtype=np.int32), thread_index=1)
+        other = buff.take()
+        self.assertEqual(buff.total_edges, 0)
+        self.assertEqual(buff.total_paths, 0)
+        self.assertEqual(buff.get_paths()[0].shape, (0,))
+        self.assertEqual(buff.get_mutations()[0].shape, (0,))
+        self.assertEqual(other.total_edges, 2)
+        self.assertEqual(other.total_paths, 1)
+        self.assertEqual(list(other.get_paths()[0]), [5])
+        self.assertEqual(list(other.get_mutations()[2]), [1])
+        buff.set_path(3, [0], [2], [1], thread_index=0)
+        self.assertEqual(list(buff.get_paths()[0]), [3])
+        self.assertEqual(list(other.get_paths()[0]), [5])
+
+    def test_take_limit(self):
+        buff = inference.ResultBuffer(num_threads=2)
+        buff.set_paths(
+            [3, 6], [0, 1, 3], [0, 0, 1], [3, 1, 2], [1, 2, 3], thread_index=0)
+        buff.set_path(4, [0], [3], [1], thread_index=1)
+        buff.set_path(7, [0], [3], [2], thread_index=1)
+        buff.set_mutations_bulk(
+            [3, 6], [0, 1, 2], np.array([4, 5], dtype=np.int32), np.array([1, 1]),
+            thread_index=0)
+        buff.set_mutations(7, np.array([2], dtype=np.int32), thread_index=1)
+        other = buff.take(6)
+        self.assertEqual(other.total_paths, 2)
+        self.assertEqual(other.total_edges, 2)
+        node_ids, offset, left, right, parent = other.get_paths()
+        self.assertEqual(list(node_ids), [3, 4])
+        self.assertEqual(list(offset), [0, 1, 2])
+        self.assertEqual(list(parent), [1, 1])
+        node_ids, offset, site, derived_state = other.get_mutations()
+        self.assertEqual(list(node_ids), [3])
+        self.assertEqual(list(site), [4])
+        self.assertEqual(buff.total_paths, 2)
+        self.assertEqual(buff.total_edges, 3)
+        node_ids, offset, left, right, parent = buff.get_paths()
+        self.assertEqual(list(node_ids), [6, 7])
+        self.assertEqual(list(offset), [0, 2, 3])
+        self.assertEqual(list(left), [0, 1, 0])
+        self.assertEqual(list(parent), [2, 3, 2])
+        node_ids, offset, site, derived_state = buff.get_mutations()
+        self.assertEqual(list(node_ids), [6, 7])
+        self.assertEqual(list(site), [5, 2])
+        self.assertEqual(buff.take(0).total_paths, 0)
+        self.assertEqual(buff.take(100).total_paths, 2)
+        self.assertEqual(buff.total_paths, 0)
+
+
+class RecordingTreeSequenceBuilder(object):
+    """
+    Wraps a tree sequence builder, recording the node IDs of the paths added.
+    """
+    def __init__(self, tree_sequence_builder):
+        self.tree_sequence_builder = tree_sequence_builder
+        self.inserted = []
+
+    def __getattr__(self, name):
+        return getattr(self.tree_sequence_builder, name)
+
+    def add_paths(self, node_ids, *args, **kwargs):
+        self.inserted.append(list(node_ids))
+        return self.tree_sequence_builder.add_paths(node_ids, *args, **kwargs)
+
+
+class SampleMatchingTestCase(TsinferTestCase):
+    """
+    Superclass for tests checking that an option to the sample matching
+    does not affect the output.
+    """
+    num_samples = 12
+    match_batch_size = 64
+
+    def get_sample_data(self, seed):
+        ts = msprime.simulate(
+            self.num_samples, mutation_rate=5, recombination_rate=2, random_seed=seed)
+        return tsinfer.SampleData.from_tree_sequence(ts)
+
+    def get_ancestors_ts(self, sample_data, **kwargs):
+        ancestor_data = tsinfer.generate_ancestors(sample_data)
+        matcher = inference.AncestorMatcher(sample_data, ancestor_data, **kwargs)
+        return matcher.match_ancestors()
+
+    def get_data(self, seed, **kwargs):
+        sample_data = self.get_sample_data(seed)
+        return sample_data, self.get_ancestors_ts(sample_data, **kwargs)
+
+    def match_samples(self, sample_data, ancestors_ts, **kwargs):
+        kwargs.setdefault("match_batch_size", self.match_batch_size)
+        matcher = inference.SampleMatcher(sample_data, ancestors_ts, **kwargs)
+        matcher.match_samples()
+        return matcher
+
+    def infer(self, sample_data, ancestors_ts, **kwargs):
+        matcher = self.match_samples(sample_data, ancestors_ts, **kwargs)
+        return matcher.finalise(simplify=True, stabilise_node_ordering=False)
+
+    def match_samples_in_order(self, matcher):
+        """
+        Matches the samples with the specified SampleMatcher, checking that
+        their paths are inserted in node ID order, and returns the number of
+        non-empty insertions.
+        """
+        builder = RecordingTreeSequenceBuilder(matcher.tree_sequence_builder)
+        matcher.tree_sequence_builder = builder
+        matcher.match_samples()
+        inserted = sum(builder.inserted, [])
+        self.assertEqual(inserted, sorted(inserted))
+        self.assertEqual(len(inserted), matcher.num_samples)
+        return sum(len(node_ids) > 0 for node_ids in builder.inserted)
+
+    def verify(self, ts1, ts2):
+        self.assertTreeSequencesEqual(ts1, ts2)
+
+
+class TestMaxBufferedSamples(SampleMatchingTestCase):
+    """
+    Tests that inserting the sample paths while matching does not affect
+    the output.
+    """
+    match_batch_size = 2
+
+    def test_bad_value(self):
+        sample_data, ancestors_ts = self.get_data(1)
+        for bad_value in [0, -1]:
+            self.assertRaises(
+                ValueError, inference.SampleMatcher, sample_data, ancestors_ts,
+                max_buffered_samples=bad_value)
+
+    def test_buffer_sizes(self):
+        sample_data, ancestors_ts = self.get_data(2)
+        ts1 = self.infer(sample_data, ancestors_ts)
+        for max_buffered_samples in [1, 3, 5, 100]:
+            self.verify(ts1, self.infer(
+                sample_data, ancestors_ts, max_buffered_samples=max_buffered_samples))
+
+    def test_py_engine(self):
+        sample_data, ancestors_ts = self.get_data(3)
+        ts1 = self.infer(sample_data, ancestors_ts, max_buffered_samples=3)
+        self.verify(ts1, self.infer(
+            sample_data, ancestors_ts, max_buffered_samples=3,
+            engine=tsinfer.PY_ENGINE))
+
+    def test_threads(self):
+        sample_data, ancestors_ts = self.get_data(4)
+        ts1 = self.infer(sample_data, ancestors_ts)
+        for num_threads in [1, 3]:
+            for max_buffered_samples in [1, 3]:
+                self.verify(ts1, self.infer(
+                    sample_data, ancestors_ts, max_buffered_samples=max_buffered_samples,
+                    num_threads=num_threads))
+
+    def test_threads_out_of_order(self):
+
+        class DelayedSampleMatcher(inference.SampleMatcher):
+            # Delay the first sample, so that the later samples are matched first.
+            def _find_paths(self, child_ids, *args, **kwargs):
+                if child_ids[0] == np.min(self.sample_ids):
+                    time.sleep(0.5)
+                return super()._find_paths(child_ids, *args, **kwargs)
+
+        sample_data, ancestors_ts = self.get_data(6)
+        ts1 = self.infer(sample_data, ancestors_ts)
+        matcher = DelayedSampleMatcher(
+            sample_data, ancestors_ts, match_batch_size=1, num_threads=3,
+            max_buffered_samples=1)
+        self.match_samples_in_order(matcher)
+        self.verify(ts1, matcher.finalise(simplify=True, stabilise_node_ordering=False))
+
+    def test_unmutated_site(self):
+        sample_data, ancestors_ts = self.get_data(5)
+        # Remove the ancestral mutations at a site, so that the sample mutations
+        # there must be deferred until all samples have been matched.
+        tables = ancestors_ts.dump_tables()
+        mutations = tables.mutations.copy()
+        tables.mutations.clear()
+        site = mutations.site[0]
+        for j in np.where(mutations.site != site)[0]:
+            tables.mutations.add_row(
+                site=mutations.site[j], node=mutations.node[j], derived_state="1")
+        ancestors_ts = tables.tree_sequence()
+        ts1 = self.infer(sample_data, ancestors_ts)
+        for max_buffered_samples in [1, 4]:
+            self.verify(ts1, self.infer(
+                sample_data, ancestors_ts, max_buffered_samples=max_buffered_samples))
+
+
+class TestMatchSamplesProcesses(SampleMatchingTestCase):
+    """
+    Tests that matching the samples in worker processes does not affect
+    the output.
+    """
+    num_samples = 14
+    match_batch_size = 3
+
+    def test_num_processes(self):
+        sample_data, ancestors_ts = self.get_data(1)
+        ts1 = self.infer(sample_data, ancestors_ts)
+        for num_processes in [1, 2, 5]:
+            self.verify(ts1, self.infer(
+                sample_data, ancestors_ts, num_processes=num_processes))
+
+    def test_max_buffered_samples(self):
+        sample_data, ancestors_ts = self.get_data(2)
+        ts1 = self.infer(sample_data, ancestors_ts, max_buffered_samples=4)
+        self.verify(ts1, self.infer(
+            sample_data, ancestors_ts, num_processes=2, max_buffered_samples=4))
+
+    def test_py_engine(self):
+        sample_data, ancestors_ts = self.get_data(3, engine=tsinfer.PY_ENGINE)
+        ts1 = self.infer(sample_data, ancestors_ts, engine=tsinfer.PY_ENGINE)
+        self.verify(ts1, self.infer(
+            sample_data, ancestors_ts, num_processes=2, engine=tsinfer.PY_ENGINE))
+
+    def test_match_samples(self):
+        sample_data, ancestors_ts = self.get_data(4)
+        ts1 = tsinfer.match_samples(sample_data, ancestors_ts)
+        ts2 = tsinfer.match_samples(sample_data, ancestors_ts, num_processes=2)
+        self.verify(ts1, ts2)
+
+
+class TestDeduplicateHaplotypes(SampleMatchingTestCase):
+    """
+    Tests that matching identical haplotypes once does not affect the output.
+    """
+    num_samples = 6
+    num_copies = 3
+    match_batch_size = 4
+
+    def get_sample_data(self, seed):
+        ts = msprime.simulate(
+            self.num_samples, mutation_rate=5, recombination_rate=2, random_seed=seed)
+        sample_data = tsinfer.SampleData(sequence_length=ts.sequence_length)
+        for variant in ts.variants():
+            sample_data.add_site(
+                variant.site.position, np.tile(variant.genotypes, self.num_copies))
+        sample_data.finalise()
+        return sample_data
+
+    def infer_saved_matches(self, sample_data, ancestors_ts, **kwargs):
+        matcher = self.match_samples(sample_data, ancestors_ts, **kwargs)
+        ts = matcher.finalise(simplify=True, stabilise_node_ordering=False)
+        return ts, matcher.num_saved_matches
+
+    def num_distinct_haplotypes(self, sample_data):
+        H = np.array([h for _, h in sample_data.haplotypes(inference_sites=True)])
+        return np.unique(H, axis=0).shape[0]
+
+    def verify_samples(self, sample_data, ancestors_ts, **kwargs):
+        ts1, saved = self.infer_saved_matches(
+            sample_data, ancestors_ts, deduplicate_haplotypes=False, **kwargs)
+        self.assertEqual(saved, 0)
+        ts2, saved = self.infer_saved_matches(sample_data, ancestors_ts, **kwargs)
+        self.assertEqual(
+            saved, sample_data.num_samples - self.num_distinct_haplotypes(sample_data))
+        self.assertGreaterEqual(saved, 2 * sample_data.num_samples // 3)
+        self.verify(ts1, ts2)
+        self.assertTrue(np.array_equal(
+            ts2.genotype_matrix(), sample_data.sites_genotypes[:]))
+
+    def test_samples(self):
+        self.verify_samples(*self.get_data(1))
+
+    def test_samples_threads(self):
+        self.verify_samples(*self.get_data(2), num_threads=2)
+
+    def test_samples_processes(self):
+        self.verify_samples(*self.get_data(3), num_processes=2)
+
+    def test_samples_max_buffered_samples(self):
+        sample_data, ancestors_ts = self.get_data(4)
+        ts1 = self.infer(sample_data, ancestors_ts, deduplicate_haplotypes=False)
+        for max_buffered_samples in [1, 3, 5]:
+            for kwargs in [{"num_threads": 0}, {"num_threads": 2}, {"num_processes": 2}]:
+                matcher = inference.SampleMatcher(
+                    sample_data, ancestors_ts, match_batch_size=self.match_batch_size,
+                    max_buffered_samples=max_buffered_samples, **kwargs)
+                # The duplicates must not be inserted ahead of the samples with
+                # lower node IDs.
+                self.match_samples_in_order(matcher)
+                self.verify(ts1, matcher.finalise(
+                    simplify=True, stabilise_node_ordering=False))
+        # Matching in the main thread, the first batch of samples and their
+        # duplicates are inserted before the second batch is matched.
+        matcher = inference.SampleMatcher(
+            sample_data, ancestors_ts, match_batch_size=self.match_batch_size,
+            max_buffered_samples=1, num_threads=0)
+        self.assertEqual(self.match_samples_in_order(matcher), 2)
+
+    def test_samples_py_engine(self):
+        sample_data, ancestors_ts = self.get_data(5)
+        ts1 = self.infer(sample_data, ancestors_ts)
+        ts2 = self.infer(sample_data, ancestors_ts, engine=tsinfer.PY_ENGINE)
+        self.verify(ts1, ts2)
+
+    def test_samples_subset(self):
+        sample_data, ancestors_ts = self.get_data(6)
+        # Every third sample, which includes copies of the same haplotypes.
+        indexes = np.arange(0, sample_data.num_samples, 3)
+        ts1 = tsinfer.augment_ancestors(
+            sample_data, ancestors_ts, indexes, deduplicate_haplotypes=False)
+        ts2 = tsinfer.augment_ancestors(sample_data, ancestors_ts, indexes)
+        self.verify(ts1, ts2)
+        matcher = inference.SampleMatcher(sample_data, ancestors_ts)
+        matcher.match_samples(indexes)
+        num_distinct = len(np.unique(indexes % self.num_samples))
+        self.assertEqual(matcher.num_saved_matches, len(indexes) - num_distinct)
+
+    def test_match_samples(self):
+        sample_data, ancestors_ts = self.get_data(7)
+        ts1 = tsinfer.match_samples(
+            sample_data, ancestors_ts, deduplicate_haplotypes=False)
+        ts2 = tsinfer.match_samples(sample_data, ancestors_ts)
+        self.verify(ts1, ts2)
+
+    def match_ancestors(self, sample_data, ancestor_data, **kwargs):
+        matcher = inference.AncestorMatcher(sample_data, ancestor_data, **kwargs)
+        ts = matcher.match_ancestors()
+        return ts, matcher.num_saved_matches
+
+    def test_ancestors(self):
+        sample_data = tsinfer.SampleData()
+        for j in range(6):
+            sample_data.add_site(j, [0, 1, 1])
+        sample_data.finalise()
+        ancestor_data = tsinfer.AncestorData(sample_data)
+        ancestor_data.add_ancestor(
+            start=0, end=6, focal_sites=[], time=5, haplotype=[0, 0, 0, 0, 0, 0])
+        ancestor_data.add_ancestor(
+            start=0, end=6, focal_sites=[], time=4, haplotype=[0, 0, 0, 0, 0, 0])
+        # These ancestors have the same haplotype once their focal sites are
+        # removed.
+        ancestor_data.add_ancestor(
+            start=0, end=3, focal_sites=[2], time=3, haplotype=[0, 0, 1])
+        ancestor_data.add_ancestor(
+            start=0, end=3, focal_sites=[1], time=3, haplotype=[0, 1, 0])
+        ancestor_data.add_ancestor(
+            start=3, end=6, focal_sites=[4], time=3, haplotype=[0, 1, 0])
+        ancestor_data.add_ancestor(
+            start=0, end=6, focal_sites=[0, 3, 5], time=1,
+            haplotype=[1, 0, 1, 1, 0, 1])
+        ancestor_data.finalise()
+        for engine in [tsinfer.C_ENGINE, tsinfer.PY_ENGINE]:
+            for num_threads in [0, 2]:
+                ts1, saved = self.match_ancestors(
+                    sample_data, ancestor_data, engine=engine, num_threads=num_threads,
+                    deduplicate_haplotypes=False)
+                self.assertEqual(saved, 0)
+                ts2, saved = self.match_ancestors(
+                    sample_data, ancestor_data, engine=engine, num_threads=num_threads)
+                self.assertEqual(saved, 1)
+                self.verify(ts1, ts2)
+
+    def test_simulated_ancestors(self):
+        sample_data, _ = self.get_data(8)
+        ancestor_data = tsinfer.generate_ancestors(sample_data)
+        ts1 = tsinfer.match_ancestors(
+            sample_data, ancestor_data, deduplicate_haplotypes=False)
+        ts2 = tsinfer.match_ancestors(sample_data, ancestor_data)
+        self.verify(ts1, ts2)
+
+
+class TestMatchBatchSize(SampleMatchingTestCase):
+    """
+    Tests that the number of samples matched in each call to the matcher
+    does not affect the output.
+    """
+    num_samples = 15
+
+    def test_batch_sizes(self):
+        sample_data, ancestors_ts = self.get_data(6)
+        ts1 = self.infer(sample_data, ancestors_ts, match_batch_size=1)
+        for batch_size in [2, 7, 15, 100]:
+            self.verify(ts1, self.infer(
+                sample_data, ancestors_ts, match_batch_size=batch_size))
+
+    def test_threads(self):
+        sample_data, ancestors_ts = self.get_data(7)
+        ts1 = self.infer(sample_data, ancestors_ts, match_batch_size=1)
+        for num_threads in [1, 3]:
+            self.verify(ts1, self.infer(
+                sample_data, ancestors_ts, match_batch_size=4,
+                num_threads=num_threads))
+
+    def test_py_engine(self):
+        sample_data, ancestors_ts = self.get_data(8)
+        ts1 = self.infer(sample_data, ancestors_ts, match_batch_size=3)
+        self.verify(ts1, self.infer(
+            sample_data, ancestors_ts, match_batch_size=3, engine=tsinfer.PY_ENGINE))
+
+
+class TestIntervalLabels(SampleMatchingTestCase):
+    """
+    Tests that using interval labels for descendant tests in the matcher
+    does not affect the output.
+    """
+    num_samples = 15
+
+    def infer_interval_labels(self, sample_data, interval_labels, engine):
+        ancestors_ts = self.get_ancestors_ts(
+            sample_data, extended_checks=True, engine=engine,
+            interval_labels=interval_labels)
+        return self.infer(
+            sample_data, ancestors_ts, extended_checks=True, engine=engine,
+            interval_labels=interval_labels)
+
+    def verify_interval_labels(self, sample_data):
+        ts1 = self.infer_interval_labels(sample_data, False, tsinfer.PY_ENGINE)
+        ts2 = self.infer_interval_labels(sample_data, True, tsinfer.C_ENGINE)
+        self.verify(ts1, ts2)
+
+    def test_simple_example(self):
+        self.verify_interval_labels(self.get_sample_data(5))
+
+    def test_random_data(self):
+        G, positions = get_random_data_example(20, 50, seed=12)
+        sample_data = tsinfer.SampleData(sequence_length=positions[-1] + 1)
+        for j in range(G.shape[0]):
+            sample_data.add_site(positions[j], G[j])
+        sample_data.finalise()
+        self.verify_interval_labels(sample_data)
+
+
 class TestPartialAncestorMatching(unittest.TestCase):
     """
     Tests for copying process behaviour when we have partially
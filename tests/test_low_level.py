@@ -21,6 +21,8 @@ Integrity tests for the low-level module.
 """
 import unittest
 
+import numpy as np
+
 import _tsinfer
 
 
@@ -37,3 +39,452 @@ class TestOutOfMemory(unittest.TestCase):
         self.assertRaises(
             MemoryError, _tsinfer.TreeSequenceBuilder, num_sites=1, max_nodes=1,
             max_edges=big)
+
+
+class TestAncestorMatcher(unittest.TestCase):
+    """
+    Tests for the AncestorMatcher constructor.
+    """
+    def test_traceback_block_size(self):
+        tsb = _tsinfer.TreeSequenceBuilder(num_sites=1, max_nodes=1, max_edges=1)
+        self.assertRaises(
+            ValueError, _tsinfer.AncestorMatcher, tsb, 0, traceback_block_size=0)
+        self.assertRaises(
+            TypeError, _tsinfer.AncestorMatcher, tsb, 0, traceback_block_size="1")
+        for block_size in [1, 1024, 2**30]:
+            matcher = _tsinfer.AncestorMatcher(tsb, 0, traceback_block_size=block_size)
+            self.assertGreater(matcher.total_memory, 0)
+
+    def test_interval_labels(self):
+        tsb = _tsinfer.TreeSequenceBuilder(num_sites=1, max_nodes=1, max_edges=1)
+        for interval_labels in [True, False]:
+            matcher = _tsinfer.AncestorMatcher(tsb, 0, interval_labels=interval_labels)
+            self.assertGreater(matcher.total_memory, 0)
+        self.assertRaises(
+            TypeError, _tsinfer.AncestorMatcher, tsb, 0, interval_labels="x")
+
+
+class TestAncestorMatcherFindPaths(unittest.TestCase):
+    """
+    Tests for matching batches of haplotypes with find_paths.
+    """
+    num_sites = 4
+
+    def get_matcher(self):
+        tsb = _tsinfer.TreeSequenceBuilder(
+            num_sites=self.num_sites, max_nodes=16, max_edges=16)
+        tsb.add_node(4)
+        tsb.add_node(3)
+        tsb.add_node(2)
+        tsb.add_node(2)
+        tsb.add_path(1, [0], [self.num_sites], [0])
+        tsb.freeze_indexes()
+        tsb.add_path(2, [0], [self.num_sites], [1])
+        tsb.add_path(3, [0], [self.num_sites], [1])
+        tsb.add_mutations(2, [0, 1], [1, 1])
+        tsb.add_mutations(3, [2, 3], [1, 1])
+        tsb.freeze_indexes()
+        return _tsinfer.AncestorMatcher(tsb, 0)
+
+    def test_bad_arguments(self):
+        matcher = self.get_matcher()
+        H = np.zeros((2, self.num_sites), dtype=np.uint8)
+        starts = np.zeros(2, dtype=np.int32)
+        ends = np.zeros(2, dtype=np.int32) + self.num_sites
+        self.assertRaises(TypeError, matcher.find_paths)
+        self.assertRaises(ValueError, matcher.find_paths, H[0], starts, ends)
+        self.assertRaises(ValueError, matcher.find_paths, H[:, 1:], starts, ends)
+        self.assertRaises(ValueError, matcher.find_paths, H, starts[:1], ends)
+        self.assertRaises(ValueError, matcher.find_paths, H, starts, ends[:1])
+        self.assertRaises(ValueError, matcher.find_paths, H, starts, ends + 1)
+        self.assertRaises(ValueError, matcher.find_paths, H, starts - 1, ends)
+        self.assertRaises(ValueError, matcher.find_paths, H, ends, ends)
+
+    def test_empty(self):
+        matcher = self.get_matcher()
+        H = np.zeros((0, self.num_sites), dtype=np.uint8)
+        left, right, parent, offset, match = matcher.find_paths(H, [], [])
+        self.assertEqual(left.shape, (0,))
+        self.assertEqual(right.shape, (0,))
+        self.assertEqual(parent.shape, (0,))
+        self.assertEqual(list(offset), [0])
+        self.assertEqual(match.shape, (0, self.num_sites))
+
+    def test_equal_to_find_path(self):
+        matcher = self.get_matcher()
+        H = np.array([
+            [1, 1, 0, 0],
+            [0, 0, 1, 1],
+            [1, 1, 1, 1],
+            [0, 1, 1, 0],
+            [1, 0, 0, 1]], dtype=np.uint8)
+        starts = np.array([0, 0, 0, 1, 2], dtype=np.int32)
+        ends = np.array([4, 4, 4, 3, 4], dtype=np.int32)
+        left, right, parent, offset, match = matcher.find_paths(H, starts, ends)
+        self.assertEqual(offset.shape, (H.shape[0] + 1,))
+        self.assertEqual(match.shape, H.shape)
+        self.assertEqual(offset[-1], left.shape[0])
+        for j in range(H.shape[0]):
+            row_match = np.zeros(self.num_sites, dtype=np.uint8)
+            l, r, p = matcher.find_path(H[j], starts[j], ends[j], row_match)
+            start, end = offset[j: j + 2]
+            self.assertTrue(np.array_equal(l, left[start: end]))
+            self.assertTrue(np.array_equal(r, right[start: end]))
+            self.assertTrue(np.array_equal(p, parent[start: end]))
+            self.assertTrue(np.array_equal(
+                row_match[starts[j]: ends[j]], match[j, starts[j]: ends[j]]))
+
+
+class TestTreeSequenceBuilderAddPaths(unittest.TestCase):
+    """
+    Tests for adding many paths to the TreeSequenceBuilder in one call.
+    """
+    num_sites = 4
+
+    def get_builder(self):
+        tsb = _tsinfer.TreeSequenceBuilder(
+            num_sites=self.num_sites, max_nodes=16, max_edges=16)
+        tsb.add_node(4)
+        tsb.add_node(3)
+        tsb.add_node(2)
+        tsb.add_node(2)
+        tsb.add_path(1, [0], [self.num_sites], [0])
+        return tsb
+
+    def test_bad_arguments(self):
+        tsb = self.get_builder()
+        child_ids = np.array([2, 3], dtype=np.int32)
+        offset = np.array([0, 1, 2], dtype=np.uint64)
+        left = np.zeros(2, dtype=np.uint32)
+        right = np.zeros(2, dtype=np.uint32) + self.num_sites
+        parent = np.ones(2, dtype=np.int32)
+        self.assertRaises(TypeError, tsb.add_paths)
+        self.assertRaises(
+            ValueError, tsb.add_paths, child_ids[:1], offset, left, right, parent)
+        self.assertRaises(
+            ValueError, tsb.add_paths, child_ids, offset, left, right[:1], parent)
+        self.assertRaises(
+            ValueError, tsb.add_paths, child_ids, offset, left, right, parent[:1])
+        self.assertRaises(
+            ValueError, tsb.add_paths, child_ids, offset + 1, left, right, parent)
+        self.assertRaises(
+            ValueError, tsb.add_paths, child_ids, [0, 2, 1], left, right, parent)
+        self.assertRaises(
+            ValueError, tsb.add_paths, child_ids, offset, [[0], [0]], right, parent)
+
+    def test_library_error(self):
+        tsb = self.get_builder()
+        # The parent is younger than the child.
+        self.assertRaises(
+            _tsinfer.LibraryError, tsb.add_paths, [1], [0, 1], [0],
+            [self.num_sites], [2])
+
+    def test_equal_to_add_path(self):
+        tsb1 = self.get_builder()
+        tsb2 = self.get_builder()
+        paths = [
+            (2, [2, 0], [4, 2], [0, 1]),
+            (3, [0], [4], [1])]
+        for child, left, right, parent in paths:
+            tsb1.add_path(child, left, right, parent)
+        tsb2.add_paths(
+            [2, 3], [0, 2, 3], [2, 0, 0], [4, 2, 4], [0, 1, 1])
+        for a, b in zip(tsb1.dump_edges(), tsb2.dump_edges()):
+            self.assertTrue(np.array_equal(a, b))
+
+
+class TestTreeSequenceBuilderPathIndex(unittest.TestCase):
+    """
+    Tests that the hash table and sorted run path indexes give the same
+    path compression.
+    """
+    num_sites = 4
+
+    def get_builder(self, sorted_run_path_index, num_children):
+        tsb = _tsinfer.TreeSequenceBuilder(
+            num_sites=self.num_sites, max_nodes=16, max_edges=16,
+            sorted_run_path_index=sorted_run_path_index)
+        tsb.add_node(4)
+        tsb.add_node(3)
+        for _ in range(num_children):
+            tsb.add_node(2)
+        tsb.add_path(1, [0], [self.num_sites], [0])
+        return tsb
+
+    def test_bad_argument(self):
+        self.assertRaises(
+            TypeError, _tsinfer.TreeSequenceBuilder, num_sites=1, max_nodes=1,
+            max_edges=1, sorted_run_path_index="x")
+
+    def test_find_match_smallest_child(self):
+        for sorted_run_path_index in [False, True]:
+            tsb = self.get_builder(sorted_run_path_index, 3)
+            # Children 3 and 2 have the same path, inserted without compression.
+            tsb.add_paths(
+                [3, 2], [0, 2, 4], [2, 0, 2, 0], [4, 2, 4, 2], [1, 0, 1, 0],
+                compress=False, extended_checks=True)
+            # The new path is compressed against child 2, which has the smallest ID.
+            tsb.add_paths([4], [0, 2], [2, 0], [4, 2], [1, 0], extended_checks=True)
+            pc_node = 5
+            self.assertEqual(tsb.num_nodes, pc_node + 1)
+            left, right, parent, child = tsb.dump_edges()
+            self.assertEqual(set(zip(left, right, parent, child)), {
+                (0, 4, 0, 1), (0, 2, 0, 3), (2, 4, 1, 3),
+                (0, 4, pc_node, 2), (0, 4, pc_node, 4),
+                (0, 2, 0, pc_node), (2, 4, 1, pc_node)})
+
+    def test_pending_edges(self):
+        for sorted_run_path_index in [False, True]:
+            tsb = self.get_builder(sorted_run_path_index, 3)
+            self.assertEqual(tsb.num_pending_added_edges, 1)
+            self.assertEqual(tsb.num_pending_removed_edges, 0)
+            tsb.freeze_indexes()
+            self.assertEqual(tsb.num_pending_added_edges, 0)
+            tsb.add_paths(
+                [3, 2], [0, 2, 4], [2, 0, 2, 0], [4, 2, 4, 2], [1, 0, 1, 0],
+                compress=False)
+            self.assertEqual(tsb.num_pending_added_edges, 4)
+            self.assertEqual(tsb.num_pending_removed_edges, 0)
+            tsb.freeze_indexes()
+            num_edges = tsb.num_edges
+            # Path compression replaces the edges of child 2.
+            tsb.add_paths([4], [0, 2], [2, 0], [4, 2], [1, 0])
+            self.assertGreater(tsb.num_pending_removed_edges, 0)
+            self.assertEqual(
+                tsb.num_edges,
+                num_edges + tsb.num_pending_added_edges - tsb.num_pending_removed_edges)
+            tsb.freeze_indexes()
+            self.assertEqual(tsb.num_pending_added_edges, 0)
+            self.assertEqual(tsb.num_pending_removed_edges, 0)
+
+    def test_random_paths(self):
+        num_sites = 50
+        num_nodes = 400
+        rng = np.random.RandomState(5)
+        builders = [
+            _tsinfer.TreeSequenceBuilder(
+                num_sites=num_sites, max_nodes=16, max_edges=16,
+                sorted_run_path_index=sorted_run_path_index)
+            for sorted_run_path_index in [False, True]]
+        for tsb in builders:
+            self.assertEqual(tsb.add_node(num_nodes + 1), 0)
+        children = [0]
+        for j in range(1, num_nodes):
+            # Copy from a few recent nodes over a coarse grid of breakpoints,
+            # so that many edges are shared and get compressed.
+            breaks = np.unique(rng.choice([10, 20, 30, 40], size=2))
+            left = np.hstack([[0], breaks])[::-1]
+            right = np.hstack([breaks, [num_sites]])[::-1]
+            parent = rng.choice(children[-3:], size=len(left))
+            offset = [0, len(left)]
+            child = [tsb.add_node(num_nodes + 1 - j) for tsb in builders]
+            self.assertEqual(child[0], child[1])
+            children.append(child[0])
+            for tsb in builders:
+                tsb.add_paths(
+                    [child[0]], offset, left.astype(np.uint32),
+                    right.astype(np.uint32), parent.astype(np.int32),
+                    extended_checks=True)
+        self.assertGreater(builders[0].num_nodes, num_nodes)
+        self.assertEqual(builders[0].num_nodes, builders[1].num_nodes)
+        for a, b in zip(builders[0].dump_edges(), builders[1].dump_edges()):
+            self.assertTrue(np.array_equal(a, b))
+        for a, b in zip(builders[0].dump_nodes(), builders[1].dump_nodes()):
+            self.assertTrue(np.array_equal(a, b))
+
+
+class TestTreeSequenceBuilderAddMutationsBulk(unittest.TestCase):
+    """
+    Tests for adding the mutations for many nodes in one call.
+    """
+    num_sites = 4
+
+    def get_builder(self):
+        tsb = _tsinfer.TreeSequenceBuilder(
+            num_sites=self.num_sites, max_nodes=16, max_edges=16)
+        tsb.add_node(2)
+        tsb.add_node(1)
+        tsb.add_node(1)
+        tsb.add_path(1, [0], [self.num_sites], [0])
+        tsb.add_path(2, [0], [self.num_sites], [0])
+        return tsb
+
+    def test_bad_arguments(self):
+        tsb = self.get_builder()
+        nodes = np.array([1, 2], dtype=np.int32)
+        offset = np.array([0, 1, 2], dtype=np.uint64)
+        site = np.array([0, 1], dtype=np.int32)
+        derived_state = np.ones(2, dtype=np.uint8)
+        self.assertRaises(TypeError, tsb.add_mutations_bulk)
+        self.assertRaises(
+            ValueError, tsb.add_mutations_bulk, nodes[:1], offset, site, derived_state)
+        self.assertRaises(
+            ValueError, tsb.add_mutations_bulk, nodes, offset, site,
+            derived_state[:1])
+        self.assertRaises(
+            ValueError, tsb.add_mutations_bulk, nodes, offset + 1, site, derived_state)
+        self.assertRaises(
+            ValueError, tsb.add_mutations_bulk, nodes, [0, 2, 1], site, derived_state)
+        self.assertRaises(
+            ValueError, tsb.add_mutations_bulk, [1, 3], offset, site, derived_state)
+        self.assertRaises(
+            ValueError, tsb.add_mutations_bulk, [-1, 2], offset, site, derived_state)
+        self.assertRaises(
+            ValueError, tsb.add_mutations_bulk, nodes, offset, [0, self.num_sites],
+            derived_state)
+        self.assertRaises(
+            ValueError, tsb.add_mutations_bulk, nodes, offset, site, [1, 2])
+        self.assertRaises(
+            ValueError, tsb.add_mutations_bulk, nodes, offset, [[0], [1]],
+            derived_state)
+
+    def test_equal_to_add_mutations(self):
+        tsb1 = self.get_builder()
+        tsb2 = self.get_builder()
+        tsb1.add_mutations(1, [0, 2], [1, 1])
+        tsb1.add_mutations(2, [1, 2, 3], [1, 0, 1])
+        tsb2.add_mutations_bulk(
+            [1, 2], [0, 2, 5], [0, 2, 1, 2, 3], [1, 1, 1, 0, 1])
+        self.assertEqual(tsb1.num_mutations, tsb2.num_mutations)
+        for a, b in zip(tsb1.dump_mutations(), tsb2.dump_mutations()):
+            self.assertTrue(np.array_equal(a, b))
+
+    def test_empty(self):
+        tsb = self.get_builder()
+        tsb.add_mutations_bulk([], [0], [], [])
+        tsb.add_mutations_bulk([1, 2], [0, 0, 0], [], [])
+        self.assertEqual(tsb.num_mutations, 0)
+
+
+class TestAncestorBuilderWorkspace(unittest.TestCase):
+    """
+    Tests for the scratch space used when making ancestors.
+    """
+    def get_builder(self, num_samples=4, num_sites=3):
+        builder = _tsinfer.AncestorBuilder(num_samples=num_samples, num_sites=num_sites)
+        genotypes = np.zeros(num_samples, dtype=np.uint8)
+        genotypes[:2] = 1
+        for j in range(num_sites):
+            builder.add_site(j, 2, genotypes)
+        return builder
+
+    def test_init(self):
+        self.assertRaises(TypeError, _tsinfer.AncestorBuilderWorkspace)
+        self.assertRaises(TypeError, _tsinfer.AncestorBuilderWorkspace, None)
+        builder = self.get_builder(num_samples=5)
+        workspace = _tsinfer.AncestorBuilderWorkspace(builder)
+        self.assertEqual(workspace.num_samples, 5)
+
+    def test_bad_workspace(self):
+        builder = self.get_builder()
+        a = np.zeros(builder.num_sites, dtype=np.uint8)
+        for bad_workspace in [1, "x", builder]:
+            self.assertRaises(
+                TypeError, builder.make_ancestor, [0], a, bad_workspace)
+        other = _tsinfer.AncestorBuilderWorkspace(self.get_builder())
+        self.assertRaises(ValueError, builder.make_ancestor, [0], a, other)
+
+    def test_same_result(self):
+        builder = self.get_builder()
+        workspace = _tsinfer.AncestorBuilderWorkspace(builder)
+        a1 = np.zeros(builder.num_sites, dtype=np.uint8)
+        a2 = np.zeros(builder.num_sites, dtype=np.uint8)
+        _, offset, focal_sites = builder.ancestor_descriptors()
+        for j in range(builder.num_ancestors):
+            sites = focal_sites[offset[j]: offset[j + 1]]
+            r1 = builder.make_ancestor(sites, a1)
+            r2 = builder.make_ancestor(sites, a2, workspace=workspace)
+            self.assertEqual(r1, r2)
+            self.assertTrue(np.array_equal(a1, a2))
+
+
+class TestAncestorBuilderFinalise(unittest.TestCase):
+    """
+    Tests for building the sorted pattern index when the ancestor builder
+    is finalised.
+    """
+    def test_descriptors_twice(self):
+        num_samples = 10
+        num_sites = 20
+        rng = np.random.RandomState(6)
+        G = (rng.random_sample((num_sites, num_samples)) < 0.5).astype(np.uint8)
+        G[:, :2] = 1
+        builder = _tsinfer.AncestorBuilder(num_samples=num_samples, num_sites=num_sites)
+        for j in range(num_sites):
+            builder.add_site(j, int(np.sum(G[j])), G[j])
+        d1 = builder.ancestor_descriptors()
+        d2 = builder.ancestor_descriptors()
+        self.assertEqual(len(d1), 3)
+        for a1, a2 in zip(d1, d2):
+            self.assertTrue(np.array_equal(a1, a2))
+
+
+class TestAncestorBuilderAddSites(unittest.TestCase):
+    """
+    Tests for adding a batch of sites to the ancestor builder.
+    """
+    def test_bad_input(self):
+        builder = _tsinfer.AncestorBuilder(num_samples=4, num_sites=3)
+        G = np.zeros((3, 4), dtype=np.uint8)
+        self.assertRaises(TypeError, builder.add_sites)
+        self.assertRaises(TypeError, builder.add_sites, [0, 1, 2])
+        self.assertRaises(ValueError, builder.add_sites, [[0, 1, 2]], G)
+        self.assertRaises(ValueError, builder.add_sites, [0, 1, 2], G[0])
+        self.assertRaises(ValueError, builder.add_sites, [0, 1], G)
+        self.assertRaises(ValueError, builder.add_sites, [0, 1, 2], G[:, :3])
+        for bad_site in [-1, 3, 10**6]:
+            self.assertRaises(ValueError, builder.add_sites, [0, 1, bad_site], G)
+
+    def test_same_as_add_site(self):
+        num_samples = 10
+        num_sites = 20
+        rng = np.random.RandomState(5)
+        G = (rng.random_sample((num_sites, num_samples)) < 0.5).astype(np.uint8)
+        G[:, 0] = 1
+        G[:, 1] = 1
+        b1 = _tsinfer.AncestorBuilder(num_samples=num_samples, num_sites=num_sites)
+        b2 = _tsinfer.AncestorBuilder(num_samples=num_samples, num_sites=num_sites)
+        for j in range(num_sites):
+            b1.add_site(j, int(np.sum(G[j])), G[j])
+        b2.add_sites(np.arange(10, dtype=np.int32), G[:10])
+        b2.add_sites(np.arange(10, num_sites, dtype=np.int32), G[10:])
+        d1 = b1.ancestor_descriptors()
+        d2 = b2.ancestor_descriptors()
+        self.assertEqual(len(d1), 3)
+        for a1, a2 in zip(d1, d2):
+            self.assertTrue(np.array_equal(a1, a2))
+
+
+class TestAncestorBuilderDescriptors(unittest.TestCase):
+    """
+    Tests for the columnar ancestor descriptors returned by the builder.
+    """
+    def test_empty(self):
+        builder = _tsinfer.AncestorBuilder(num_samples=4, num_sites=0)
+        frequency, offset, focal_sites = builder.ancestor_descriptors()
+        self.assertEqual(frequency.shape, (0,))
+        self.assertEqual(list(offset), [0])
+        self.assertEqual(focal_sites.shape, (0,))
+
+    def test_format(self):
+        num_samples = 10
+        num_sites = 30
+        rng = np.random.RandomState(7)
+        G = (rng.random_sample((num_sites, num_samples)) < 0.5).astype(np.uint8)
+        G[:, :2] = 1
+        builder = _tsinfer.AncestorBuilder(num_samples=num_samples, num_sites=num_sites)
+        builder.add_sites(np.arange(num_sites, dtype=np.int32), G)
+        frequency, offset, focal_sites = builder.ancestor_descriptors()
+        self.assertEqual(frequency.dtype, np.uint32)
+        self.assertEqual(offset.dtype, np.uint64)
+        self.assertEqual(focal_sites.dtype, np.int32)
+        self.assertEqual(frequency.shape, (builder.num_ancestors,))
+        self.assertEqual(offset.shape, (builder.num_ancestors + 1,))
+        self.assertEqual(offset[0], 0)
+        self.assertEqual(offset[-1], num_sites)
+        self.assertTrue(np.all(np.diff(offset.astype(np.int64)) > 0))
+        self.assertTrue(np.all(np.diff(frequency.astype(np.int64)) <= 0))
+        self.assertEqual(sorted(focal_sites), list(range(num_sites)))
+        for j in range(builder.num_ancestors):
+            sites = focal_sites[offset[j]: offset[j + 1]]
+            self.assertTrue(np.all(np.sum(G[sites], axis=1) == frequency[j]))
@@ -56,6 +56,17 @@ class Site(object):
         self.genotypes = genotypes
 
 
+class AncestorBuilderWorkspace(object):
+    """
+    Scratch space used by a single thread when making ancestors. The Python
+    implementation does not need any preallocated memory, so this is only
+    here to mirror the C interface.
+    """
+    def __init__(self, ancestor_builder):
+        self.ancestor_builder = ancestor_builder
+        self.num_samples = ancestor_builder.num_samples
+
+
 class AncestorBuilder(object):
     """
     Builds inferred ancestors.
@@ -64,9 +75,12 @@ class AncestorBuilder(object):
     # sites per ancestor, but the final generation algorithm assumes a single
     # focal site. Once this is finalise should refactor to remove the complexity
     # needed for matching up ancestors with identical focal sites.
-    def __init__(self, num_samples, num_sites):
+    def __init__(self, num_samples, num_sites, bitpack_genotypes=False):
         self.num_samples = num_samples
         self.num_sites = num_sites
+        # The genotype encoding only affects memory usage and performance in
+        # the C implementation, so we ignore it here.
+        self.bitpack_genotypes = bitpack_genotypes
         self.sites = [None for _ in range(self.num_sites)]
         self.frequency_map = [{} for _ in range(self.num_samples + 1)]
 
@@ -83,6 +97,14 @@ class AncestorBuilder(object):
             pattern_map[key] = []
         pattern_map[key].append(site_id)
 
+    def add_sites(self, site_ids, genotypes):
+        """
+        Adds the sites with the specified IDs to the builder, where row j of
+        the genotypes matrix holds the allele pattern for site_ids[j].
+        """
+        for site_id, g in zip(site_ids, genotypes):
+            self.add_site(site_id, int(np.sum(g == 1)), g)
+
     def print_state(self):
         print("Ancestor builder")
         print("Sites = ")
@@ -113,28 +135,35 @@ class AncestorBuilder(object):
 
     def ancestor_descriptors(self):
         """
-        Returns a list of (frequency, focal_sites) tuples describing the
-        ancestors in reverse order of frequency.
+        Returns the (frequency, focal_sites_offset, focal_sites) arrays describing
+        the ancestors in reverse order of frequency. The focal sites for ancestor
+        j are focal_sites[focal_sites_offset[j]: focal_sites_offset[j + 1]].
         """
         # self.print_state()
-        ret = []
-        for frequency in reversed(range(self.num_samples + 1)):
+        frequency = []
+        focal_sites_offset = [0]
+        ancestor_focal_sites = []
+        for f in reversed(range(self.num_samples + 1)):
             # Need to make the order in which these are returned deterministic,
             # or ancestor IDs are not replicable between runs. In the C implementation
             # We sort by the genotype patterns
-            keys = sorted(self.frequency_map[frequency].keys())
+            keys = sorted(self.frequency_map[f].keys())
             for key in keys:
-                focal_sites = np.array(
-                    self.frequency_map[frequency][key], dtype=np.int32)
+                focal_sites = np.array(self.frequency_map[f][key], dtype=np.int32)
                 samples = np.frombuffer(key, dtype=np.uint8)
                 # print("focal_sites = ", key, samples, focal_sites)
                 start = 0
-                for j in range(len(focal_sites) - 1):
-                    if self.break_ancestor(focal_sites[j], focal_sites[j + 1], samples):
-                        ret.append((frequency, focal_sites[start: j + 1]))
+                for j in range(len(focal_sites)):
+                    if j == len(focal_sites) - 1 or self.break_ancestor(
+                            focal_sites[j], focal_sites[j + 1], samples):
+                        frequency.append(f)
+                        ancestor_focal_sites.extend(focal_sites[start: j + 1])
+                        focal_sites_offset.append(len(ancestor_focal_sites))
                         start = j + 1
-                ret.append((frequency, focal_sites[start:]))
-        return ret
+        return (
+            np.array(frequency, dtype=np.uint32),
+            np.array(focal_sites_offset, dtype=np.uint64),
+            np.array(ancestor_focal_sites, dtype=np.int32))
 
     def compute_ancestral_states(self, a, focal_site, sites):
         focal_frequency = self.sites[focal_site].frequency
@@ -170,7 +199,8 @@ class AncestorBuilder(object):
                 a[l] = consensus
         return last_site
 
-    def make_ancestor(self, focal_sites, a):
+    def make_ancestor(self, focal_sites, a, workspace=None):
+        assert workspace is None or workspace.ancestor_builder is self
         a[:] = constants.UNKNOWN_ALLELE
         for focal_site in focal_sites:
             a[focal_site] = 1
@@ -228,10 +258,28 @@ class TreeSequenceBuilder(object):
         self.right_index = sortedcontainers.SortedDict()
         self.path_index = sortedcontainers.SortedDict()
         self.path = []
+        # The matcher only sees the edges as they were when the indexes were
+        # last frozen, as in the C implementation.
+        self.frozen_left_index = sortedcontainers.SortedDict()
+        self.frozen_right_index = sortedcontainers.SortedDict()
+        self.num_frozen_nodes = 0
+        # The number of edges indexed and unindexed since the indexes were
+        # last frozen.
+        self.num_pending_added_edges = 0
+        self.num_pending_removed_edges = 0
 
     def freeze_indexes(self):
-        # This is a no-op in this implementation.
-        pass
+        # Edges may be modified in place by path compression, so we take copies.
+        copies = {
+            edge: Edge(edge.left, edge.right, edge.parent, edge.child)
+            for edge in self.left_index.values()}
+        self.frozen_left_index = sortedcontainers.SortedDict(
+            (key, copies[edge]) for key, edge in self.left_index.items())
+        self.frozen_right_index = sortedcontainers.SortedDict(
+            (key, copies[edge]) for key, edge in self.right_index.items())
+        self.num_frozen_nodes = self.num_nodes
+        self.num_pending_added_edges = 0
+        self.num_pending_removed_edges = 0
 
     def restore_nodes(self, time, flags):
         for t, flag in zip(time, flags):
@@ -252,6 +300,7 @@ class TreeSequenceBuilder(object):
         # We need to find edges with identical (left, right, parent) values for
         # path compression.
         self.path_index[(edge.left, edge.right, edge.parent, edge.child)] = edge
+        self.num_pending_added_edges += 1
 
     def index_edges(self, node_id):
         """
@@ -269,6 +318,7 @@ class TreeSequenceBuilder(object):
         # We need to find edges with identical (left, right, parent) values for
         # path compression.
         del self.path_index[(edge.left, edge.right, edge.parent, edge.child)]
+        self.num_pending_removed_edges += 1
 
     def squash_edges(self, head):
         """
@@ -333,6 +383,7 @@ class TreeSequenceBuilder(object):
                 self.path[edge.child] = edge
             self.index_edge(edge)
             prev = edge
+        self.freeze_indexes()
 
         self.check_state()
 
@@ -358,6 +409,15 @@ class TreeSequenceBuilder(object):
         if extended_checks:
             self.check_state()
 
+    def add_paths(
+            self, child_ids, offset, left, right, parent, compress=True,
+            extended_checks=False):
+        for j, child in enumerate(child_ids):
+            start, end = offset[j], offset[j + 1]
+            self.add_path(
+                child, left[start: end], right[start: end], parent[start: end],
+                compress=compress, extended_checks=extended_checks)
+
     def update_node_time(self, child_id, pc_parent_id):
         """
         Updates the node time for the specified pc parent node ID.
@@ -487,6 +547,11 @@ class TreeSequenceBuilder(object):
         for s, d in zip(site, derived_state):
             self.mutations[s].append((node, d))
 
+    def add_mutations_bulk(self, nodes, offset, site, derived_state):
+        for j, node in enumerate(nodes):
+            start, end = offset[j], offset[j + 1]
+            self.add_mutations(node, site[start: end], derived_state[start: end])
+
     @property
     def num_edges(self):
         return len(self.left_index)
@@ -605,9 +670,13 @@ MISSING = -2
 
 class AncestorMatcher(object):
 
-    def __init__(self, tree_sequence_builder, extended_checks=False):
+    def __init__(
+            self, tree_sequence_builder, extended_checks=False,
+            traceback_block_size=64 * 1024 * 1024, interval_labels=False):
         self.tree_sequence_builder = tree_sequence_builder
         self.extended_checks = extended_checks
+        self.traceback_block_size = traceback_block_size
+        self.interval_labels = interval_labels
         self.num_sites = tree_sequence_builder.num_sites
         self.parent = None
         self.left_child = None
@@ -639,7 +708,7 @@ class AncestorMatcher(object):
                 assert v == -2
 
     def update_site(self, site, state):
-        n = self.tree_sequence_builder.num_nodes
+        n = self.tree_sequence_builder.num_frozen_nodes
 
         mutation_node = msprime.NULL_NODE
         if site in self.tree_sequence_builder.mutations:
@@ -776,10 +845,10 @@ class AncestorMatcher(object):
         return u != 0 and self.parent[u] == -1 and self.left_child[u] == -1
 
     def find_path(self, h, start, end, match):
-        Il = self.tree_sequence_builder.left_index
-        Ir = self.tree_sequence_builder.right_index
+        Il = self.tree_sequence_builder.frozen_left_index
+        Ir = self.tree_sequence_builder.frozen_right_index
         M = len(Il)
-        n = self.tree_sequence_builder.num_nodes
+        n = self.tree_sequence_builder.num_frozen_nodes
         m = self.tree_sequence_builder.num_sites
         self.parent = np.zeros(n, dtype=int) - 1
         self.left_child = np.zeros(n, dtype=int) - 1
@@ -908,17 +977,39 @@ class AncestorMatcher(object):
 
         return self.run_traceback(start, end, match)
 
+    def find_paths(self, haplotypes, starts, ends):
+        """
+        Matches each row of the specified haplotypes matrix and returns the
+        paths in CSR form, along with the matrix of matched haplotypes.
+        """
+        num_haplotypes = haplotypes.shape[0]
+        offset = np.zeros(num_haplotypes + 1, dtype=np.uint64)
+        match = np.zeros(haplotypes.shape, dtype=np.uint8)
+        left, right, parent = [], [], []
+        for j in range(num_haplotypes):
+            row = np.zeros(self.num_sites, dtype=np.uint8)
+            l, r, p = self.find_path(haplotypes[j], starts[j], ends[j], row)
+            match[j, starts[j]: ends[j]] = row[starts[j]: ends[j]]
+            left.append(l)
+            right.append(r)
+            parent.append(p)
+            offset[j + 1] = offset[j] + len(l)
+        return (
+            np.hstack(left + [[]]).astype(np.uint32),
+            np.hstack(right + [[]]).astype(np.uint32),
+            np.hstack(parent + [[]]).astype(np.int32), offset, match)
+
     def run_traceback(self, start, end, match):
         # print("traceback", start, end)
         # self.print_state()
-        Il = self.tree_sequence_builder.left_index
-        Ir = self.tree_sequence_builder.right_index
+        Il = self.tree_sequence_builder.frozen_left_index
+        Ir = self.tree_sequence_builder.frozen_right_index
         M = len(Il)
         u = self.max_likelihood_node[end - 1]
         output_edge = Edge(right=end, parent=u)
         output_edges = [output_edge]
         recombination_required = np.zeros(
-            self.tree_sequence_builder.num_nodes, dtype=int) - 1
+            self.tree_sequence_builder.num_frozen_nodes, dtype=int) - 1
 
         # Now go back through the trees.
         j = M - 1
@@ -158,7 +158,8 @@ def run_list(args):
     except msprime.FileFormatError:
         pass
     if ts is None:
-        tsinfer_file = tsinfer.load(args.path)
+        tsinfer_file = tsinfer.load(
+            args.path, num_decode_threads=args.num_decode_threads)
         if args.storage:
             print(tsinfer_file.info)
         else:
@@ -172,7 +173,8 @@ def run_infer(args):
     progress_monitor = ProgressMonitor(
         enabled=args.progress, generate_ancestors=True, match_ancestors=True,
         match_samples=True)
-    sample_data = tsinfer.SampleData.load(args.samples)
+    sample_data = tsinfer.SampleData.load(
+        args.samples, num_decode_threads=args.num_decode_threads)
     ts = tsinfer.infer(
         sample_data, progress_monitor=progress_monitor, num_threads=args.num_threads)
     output_trees = get_output_trees_path(args.output_trees, args.samples)
@@ -185,7 +187,8 @@ def run_generate_ancestors(args):
     setup_logging(args)
     ancestors_path = get_ancestors_path(args.ancestors, args.samples)
     progress_monitor = ProgressMonitor(enabled=args.progress, generate_ancestors=True)
-    sample_data = tsinfer.SampleData.load(args.samples)
+    sample_data = tsinfer.SampleData.load(
+        args.samples, num_decode_threads=args.num_decode_threads)
     tsinfer.generate_ancestors(
         sample_data, progress_monitor=progress_monitor, path=ancestors_path,
         num_flush_threads=args.num_flush_threads, num_threads=args.num_threads)
@@ -197,8 +200,10 @@ def run_match_ancestors(args):
     ancestors_path = get_ancestors_path(args.ancestors, args.samples)
     logger.info("Loading ancestral haplotypes from {}".format(ancestors_path))
     ancestors_trees = get_ancestors_trees_path(args.ancestors_trees, args.samples)
-    sample_data = tsinfer.SampleData.load(args.samples)
-    ancestor_data = tsinfer.AncestorData.load(ancestors_path)
+    sample_data = tsinfer.SampleData.load(
+        args.samples, num_decode_threads=args.num_decode_threads)
+    ancestor_data = tsinfer.AncestorData.load(
+        ancestors_path, num_decode_threads=args.num_decode_threads)
     progress_monitor = ProgressMonitor(enabled=args.progress, match_ancestors=True)
     ts = tsinfer.match_ancestors(
         sample_data, ancestor_data,
@@ -212,7 +217,8 @@ def run_match_ancestors(args):
 def run_augment_ancestors(args):
     setup_logging(args)
 
-    sample_data = tsinfer.SampleData.load(args.samples)
+    sample_data = tsinfer.SampleData.load(
+        args.samples, num_decode_threads=args.num_decode_threads)
     ancestors_trees = get_ancestors_trees_path(args.ancestors_trees, args.samples)
     output_path = args.augmented_ancestors
     logger.info("Loading ancestral genealogies from {}".format(ancestors_trees))
@@ -237,7 +243,8 @@ def run_augment_ancestors(args):
 def run_match_samples(args):
     setup_logging(args)
 
-    sample_data = tsinfer.SampleData.load(args.samples)
+    sample_data = tsinfer.SampleData.load(
+        args.samples, num_decode_threads=args.num_decode_threads)
     ancestors_trees = get_ancestors_trees_path(args.ancestors_trees, args.samples)
     output_trees = get_output_trees_path(args.output_trees, args.samples)
     logger.info("Loading ancestral genealogies from {}".format(ancestors_trees))
@@ -245,6 +252,7 @@ def run_match_samples(args):
     progress_monitor = ProgressMonitor(enabled=args.progress, match_samples=True)
     ts = tsinfer.match_samples(
         sample_data, ancestors_trees, num_threads=args.num_threads,
+        num_processes=args.num_processes,
         path_compression=not args.no_path_compression,
         simplify=not args.no_simplify,
         progress_monitor=progress_monitor)
@@ -255,7 +263,8 @@ def run_match_samples(args):
 
 def run_verify(args):
     setup_logging(args)
-    samples = tsinfer.SampleData.load(args.samples)
+    samples = tsinfer.SampleData.load(
+        args.samples, num_decode_threads=args.num_decode_threads)
     ts = msprime.load(args.tree_sequence)
     progress_monitor = ProgressMonitor(enabled=args.progress, verify=True)
     tsinfer.verify(samples, ts, progress_monitor=progress_monitor)
@@ -340,6 +349,14 @@ def add_num_threads_argument(parser):
             "algorithm (default)."))
 
 
+def add_num_processes_argument(parser):
+    parser.add_argument(
+        "--num-processes", "-P", type=int, default=0,
+        help=(
+            "The number of worker processes to use. If >= 1, this is used "
+            "instead of the number of threads (default=0)."))
+
+
 def add_num_flush_threads_argument(parser):
     parser.add_argument(
         "--num-flush-threads", "-F", type=int, default=2,
@@ -348,6 +365,15 @@ def add_num_flush_threads_argument(parser):
             "synchronously in the main thread (default=2)"))
 
 
+def add_num_decode_threads_argument(parser):
+    parser.add_argument(
+        "--num-decode-threads", "-D", type=int, default=0,
+        help=(
+            "The number of threads used to decompress data ahead of when it is "
+            "needed. If < 1, all data is decompressed synchronously in the main "
+            "thread (default)."))
+
+
 def get_cli_parser():
     top_parser = argparse.ArgumentParser(
         description="Command line interface for tsinfer.")
@@ -370,6 +396,7 @@ def get_cli_parser():
     add_num_flush_threads_argument(parser)
     add_progress_argument(parser)
     add_logging_arguments(parser)
+    add_num_decode_threads_argument(parser)
     parser.set_defaults(runner=run_generate_ancestors)
 
     parser = subparsers.add_parser(
@@ -386,6 +413,7 @@ def get_cli_parser():
     add_num_threads_argument(parser)
     add_progress_argument(parser)
     add_path_compression_argument(parser)
+    add_num_decode_threads_argument(parser)
     parser.set_defaults(runner=run_match_ancestors)
 
     parser = subparsers.add_parser(
@@ -404,6 +432,7 @@ def get_cli_parser():
     add_path_compression_argument(parser)
     add_num_threads_argument(parser)
     add_progress_argument(parser)
+    add_num_decode_threads_argument(parser)
     parser.set_defaults(runner=run_augment_ancestors)
 
     parser = subparsers.add_parser(
@@ -419,7 +448,9 @@ def get_cli_parser():
     add_simplify_argument(parser)
     add_output_trees_argument(parser)
     add_num_threads_argument(parser)
+    add_num_processes_argument(parser)
     add_progress_argument(parser)
+    add_num_decode_threads_argument(parser)
     parser.set_defaults(runner=run_match_samples)
 
     parser = subparsers.add_parser(
@@ -433,6 +464,7 @@ def get_cli_parser():
     add_output_trees_argument(parser)
     add_num_threads_argument(parser)
     add_progress_argument(parser)
+    add_num_decode_threads_argument(parser)
     parser.set_defaults(runner=run_infer)
 
     parser = subparsers.add_parser(
@@ -446,6 +478,7 @@ def get_cli_parser():
     parser.add_argument(
         "--storage", "-s", action="store_true",
         help="Show detailed information about data storage.")
+    add_num_decode_threads_argument(parser)
     parser.set_defaults(runner=run_list)
 
     parser = subparsers.add_parser(
@@ -458,6 +491,7 @@ def get_cli_parser():
     parser.add_argument(
         "tree_sequence", help="The tree sequence to compare with in .trees format.")
     add_progress_argument(parser)
+    add_num_decode_threads_argument(parser)
     parser.set_defaults(runner=run_verify)
 
     return top_parser
@@ -216,16 +216,62 @@ def zarr_summary(array):
     return ret
 
 
-def chunk_iterator(array):
+def prefetch_iterator(fetch, num_items, num_threads=0, queue_depth=2):
+    """
+    Returns an iterator over fetch(0), fetch(1), ..., fetch(num_items - 1). If
+    num_threads > 0, the items are fetched ahead of the consumer by a pool of
+    background threads, each of which holds at most queue_depth items that
+    have not yet been consumed.
+    """
+    if num_threads <= 0:
+        for j in range(num_items):
+            yield fetch(j)
+        return
+
+    stop = threading.Event()
+    # Item j is fetched by thread j % num_threads, so we get the items back in
+    # order by reading from the threads' queues in turn.
+    fetch_queues = [queue.Queue(queue_depth) for _ in range(num_threads)]
+
+    def fetch_worker(thread_index):
+        for j in range(thread_index, num_items, num_threads):
+            if stop.is_set():
+                break
+            fetch_queues[thread_index].put(fetch(j))
+
+    fetch_threads = [
+        threads.queue_producer_thread(
+            fetch_worker, fetch_queues[j], name="fetch-worker-{}".format(j), index=j)
+        for j in range(num_threads)]
+    try:
+        for j in range(num_items):
+            yield fetch_queues[j % num_threads].get()
+    finally:
+        # The consumer may stop early, so make sure that none of the threads
+        # are left blocked on a full queue.
+        stop.set()
+        for fetch_queue, thread in zip(fetch_queues, fetch_threads):
+            while True:
+                try:
+                    fetch_queue.get_nowait()
+                except queue.Empty:
+                    break
+            thread.join()
+
+
+def chunk_iterator(array, num_threads=0):
     """
     Utility to iterate over the rows in the specified array efficiently
-    by accessing one chunk at a time.
+    by accessing one chunk at a time. If num_threads > 0, the chunks are
+    decoded ahead of the consumer using this many background threads.
     """
     chunk_size = array.chunks[0]
-    for j in range(array.shape[0]):
-        if j % chunk_size == 0:
-            chunk = array[j: j + chunk_size][:]
-        yield chunk[j % chunk_size]
+    num_chunks = -(-array.shape[0] // chunk_size)
+    chunks = prefetch_iterator(
+        lambda j: array[j * chunk_size: (j + 1) * chunk_size][:], num_chunks,
+        num_threads)
+    for chunk in chunks:
+        yield from chunk
 
 
 class DataContainer(object):
@@ -242,11 +288,13 @@ class DataContainer(object):
     FORMAT_VERSION = None
 
     def __init__(
-            self, path=None, num_flush_threads=0, compressor=None, chunk_size=1024):
+            self, path=None, num_flush_threads=0, compressor=None, chunk_size=1024,
+            num_decode_threads=0):
         self._mode = self.BUILD_MODE
         if path is not None and compressor is None:
             compressor = DEFAULT_COMPRESSOR
         self._num_flush_threads = num_flush_threads
+        self._num_decode_threads = num_decode_threads
         self._chunk_size = max(1, chunk_size)
         self._metadata_codec = numcodecs.JSON()
         self._compressor = compressor
@@ -314,7 +362,7 @@ class DataContainer(object):
         return zarr.LMDBStore(self.path, subdir=False)
 
     @classmethod
-    def load(cls, path):
+    def load(cls, path, num_decode_threads=0):
         # Try to read the file. This should raise the correct error if we have a
         # directory, missing file, permissions, etc.
         with open(path, "r"):
@@ -322,6 +370,7 @@ class DataContainer(object):
         self = cls.__new__(cls)
         self.mode = self.READ_MODE
         self.path = path
+        self._num_decode_threads = num_decode_threads
         self._open_readonly()
         logger.info("Loaded {}".format(self.summary()))
         return self
@@ -353,6 +402,7 @@ class DataContainer(object):
         cls = type(self)
         other = cls.__new__(cls)
         other.path = path
+        other._num_decode_threads = self._num_decode_threads
         if path is None:
             # Have to work around a fairly weird bug in zarr where if we
             # try to use copy_store on an in-memory array we end up
@@ -605,7 +655,7 @@ class Individual(object):
 class SampleData(DataContainer):
     """
     SampleData(sequence_length=0, path=None, num_flush_threads=0, \
-    compressor=None, chunk_size=1024)
+    compressor=None, chunk_size=1024, num_decode_threads=0, index_haplotypes=False)
 
     Class representing input sample data used for inference.
     See sample data file format :ref:`specifications <sec_file_formats_samples>`
@@ -690,6 +740,13 @@ class SampleData(DataContainer):
     :param int chunk_size: The chunk size used for
         `zarr arrays <http://zarr.readthedocs.io/>`_. This affects
         compression level and algorithm performance. Default=1024.
+    :param int num_decode_threads: The number of background threads to use
+        for decompressing chunks ahead of the consumer when reading data. If
+        <= 0, chunks are decompressed synchronously. Default=0.
+    :param bool index_haplotypes: If True, also store a sample-major copy of
+        the genotypes at inference sites when the data is finalised. This
+        makes iterating over the sample haplotypes (as done when matching
+        samples) much faster, at the cost of extra storage. Default=False.
     """
     FORMAT_NAME = "tsinfer-sample-data"
     FORMAT_VERSION = (1, 0)
@@ -699,10 +756,11 @@ class SampleData(DataContainer):
     ADDING_SAMPLES = 1
     ADDING_SITES = 2
 
-    def __init__(self, sequence_length=0, **kwargs):
+    def __init__(self, sequence_length=0, index_haplotypes=False, **kwargs):
 
         super().__init__(**kwargs)
         self.data.attrs["sequence_length"] = float(sequence_length)
+        self._index_haplotypes = index_haplotypes
         chunks = self._chunk_size,
         populations_group = self.data.create_group("population")
         metadata = populations_group.create_dataset(
@@ -820,6 +878,18 @@ class SampleData(DataContainer):
     def samples_metadata(self):
         return self.data["samples/metadata"]
 
+    @property
+    def samples_inference_haplotypes(self):
+        return self.data["samples/inference_haplotypes"]
+
+    @property
+    def has_haplotype_index(self):
+        """
+        True if this SampleData stores a sample-major copy of the genotypes
+        at inference sites.
+        """
+        return "samples/inference_haplotypes" in self.data
+
     @property
     def sites_genotypes(self):
         return self.data["sites/genotypes"]
@@ -867,6 +937,10 @@ class SampleData(DataContainer):
             ("sites/inference", zarr_summary(self.sites_inference)),
             ("sites/genotypes", zarr_summary(self.sites_genotypes)),
             ("sites/metadata", zarr_summary(self.sites_metadata))]
+        if self.has_haplotype_index:
+            values.append((
+                "samples/inference_haplotypes",
+                zarr_summary(self.samples_inference_haplotypes)))
         return super(SampleData, self).__str__() + self._format_str(values)
 
     def data_equal(self, other):
@@ -1142,9 +1216,48 @@ class SampleData(DataContainer):
             if self.sequence_length == 0:
                 # Need to be careful that sequence_length is JSON serialisable here.
                 self.data.attrs["sequence_length"] = float(self._last_position) + 1
+        self._check_write_modes()
+        # In edit mode the inference sites may have changed, so any existing
+        # index must be rebuilt.
+        if self.has_haplotype_index:
+            del self.data["samples/inference_haplotypes"]
+        if self._index_haplotypes:
+            self._write_haplotype_index()
 
         super(SampleData, self).finalise()
 
+    def copy(self, path=None, index_haplotypes=None):
+        """
+        Returns a copy of this SampleData opened in 'edit' mode. If path
+        is specified, this must not be equal to the path of the current
+        data container. The new container will have a different UUID to the
+        current.
+
+        :param str path: The path of the file to store the copy in.
+        :param bool index_haplotypes: Whether the copy stores a sample-major
+            copy of the genotypes at inference sites when finalised. If None
+            (the default) the copy has an index if this SampleData does.
+        """
+        other = super(SampleData, self).copy(path=path)
+        if index_haplotypes is None:
+            index_haplotypes = self.has_haplotype_index
+        other._index_haplotypes = index_haplotypes
+        return other
+
+    def _write_haplotype_index(self):
+        """
+        Writes the genotypes at inference sites in sample-major order, so that
+        the haplotypes can be read without transposing the genotypes array.
+        """
+        genotypes = self.sites_genotypes
+        selection = self.sites_inference[:] == 1
+        haplotypes = self.data["samples"].create_dataset(
+            "inference_haplotypes", shape=(self.num_samples, int(np.sum(selection))),
+            chunks=genotypes.chunks, compressor=genotypes.compressor, dtype=np.uint8)
+        chunk_size = genotypes.chunks[1]
+        for j in range(0, self.num_samples, chunk_size):
+            haplotypes[j: j + chunk_size] = genotypes[:, j: j + chunk_size][selection].T
+
     ####################################
     # Read mode
     ####################################
@@ -1161,7 +1274,8 @@ class SampleData(DataContainer):
             for.
         """
         inference = self.sites_inference[:]
-        for j, a in enumerate(chunk_iterator(self.sites_genotypes)):
+        genotypes = chunk_iterator(self.sites_genotypes, self._num_decode_threads)
+        for j, a in enumerate(genotypes):
             if inference_sites is None or inference[j] == inference_sites:
                 yield j, a
 
@@ -1192,19 +1306,30 @@ class SampleData(DataContainer):
                 yield variant
 
     def __all_haplotypes(self, inference_sites=None):
+        selection = slice(None)
         if inference_sites is not None:
             selection = self.sites_inference[:] == int(inference_sites)
         # We iterate over chunks vertically here, and it's not worth complicating
         # the chunk iterator to handle this.
         chunk_size = self.sites_genotypes.chunks[1]
-        for j in range(self.num_samples):
-            if j % chunk_size == 0:
-                chunk = self.sites_genotypes[:, j: j + chunk_size].T
-            a = chunk[j % chunk_size]
-            if inference_sites is None:
+        num_chunks = -(-self.num_samples // chunk_size)
+
+        def fetch(k):
+            return self.sites_genotypes[:, k * chunk_size: (k + 1) * chunk_size][
+                selection].T
+
+        chunks = prefetch_iterator(fetch, num_chunks, self._num_decode_threads)
+        j = 0
+        for chunk in chunks:
+            for a in chunk:
                 yield j, a
-            else:
-                yield j, a[selection]
+                j += 1
+
+    def __indexed_haplotypes(self):
+        haplotypes = chunk_iterator(
+            self.samples_inference_haplotypes, self._num_decode_threads)
+        for j, a in enumerate(haplotypes):
+            yield j, a
 
     def haplotypes(self, samples=None, inference_sites=None):
         if samples is None:
@@ -1215,8 +1340,12 @@ class SampleData(DataContainer):
                 raise ValueError("sample indexes must be in increasing order.")
             if samples.shape[0] > 0 and samples[-1] >= self.num_samples:
                 raise ValueError("Sample index too large.")
+        if inference_sites is not None and inference_sites and self.has_haplotype_index:
+            iterator = self.__indexed_haplotypes()
+        else:
+            iterator = self.__all_haplotypes(inference_sites)
         j = 0
-        for index, a in self.__all_haplotypes(inference_sites):
+        for index, a in iterator:
             if j == len(samples):
                 break
             if index == samples[j]:
@@ -1247,7 +1376,7 @@ class Ancestor(object):
 class AncestorData(DataContainer):
     """
     AncestorData(sample_data, path=None, num_flush_threads=0, compressor=None, \
-    chunk_size=1024)
+    chunk_size=1024, num_decode_threads=0)
 
     Class representing the stored ancestor data produced by
     :func:`generate_ancestors`. See the samples file format
@@ -1271,6 +1400,9 @@ class AncestorData(DataContainer):
     :param int chunk_size: The chunk size used for
         `zarr arrays <http://zarr.readthedocs.io/>`_. This affects
         compression level and algorithm performance. Default=1024.
+    :param int num_decode_threads: The number of background threads to use
+        for decompressing chunks ahead of the consumer when reading data. If
+        <= 0, chunks are decompressed synchronously. Default=0.
     """
     FORMAT_NAME = "tsinfer-ancestor-data"
     FORMAT_VERSION = (1, 0)
@@ -1461,13 +1593,14 @@ class AncestorData(DataContainer):
         end = self.ancestors_end[:]
         time = self.ancestors_time[:]
         focal_sites = self.ancestors_focal_sites[:]
-        for j, h in enumerate(chunk_iterator(self.ancestors_haplotype)):
+        haplotypes = chunk_iterator(self.ancestors_haplotype, self._num_decode_threads)
+        for j, h in enumerate(haplotypes):
             yield Ancestor(
                 id=j, start=start[j], end=end[j], time=time[j],
                 focal_sites=focal_sites[j], haplotype=h)
 
 
-def load(path):
+def load(path, num_decode_threads=0):
     """
     Loads a tsinfer :class:`.SampleData` or :class:`.AncestorData` file from
     the specified path. The correct class will be determined by the content
@@ -1475,6 +1608,8 @@ def load(path):
     :class:`.FileFormatError` will be thrown.
 
     :param str path: The path of the file we wish to load.
+    :param int num_decode_threads: The number of background threads to use
+        for decompressing chunks when reading data. Default=0.
     :return: The corresponding :class:`.SampleData` or :class:`.AncestorData`
         instance opened in read only mode.
     :rtype: :class:`.AncestorData` or :class:`.SampleData`.
@@ -1486,13 +1621,14 @@ def load(path):
     tsinfer_file = None
     try:
         logger.debug("Trying SampleData file")
-        tsinfer_file = SampleData.load(path)
+        tsinfer_file = SampleData.load(path, num_decode_threads=num_decode_threads)
         logger.debug("Loaded SampleData file")
     except exceptions.FileFormatError as e:
         logger.debug("SampleData load failed: {}".format(e))
     try:
         logger.debug("Trying AncestorData file")
-        tsinfer_file = AncestorData.load(path)
+        tsinfer_file = AncestorData.load(
+            path, num_decode_threads=num_decode_threads)
         logger.debug("Loaded AncestorData file")
     except exceptions.FileFormatError as e:
         logger.debug("AncestorData load failed: {}".format(e))
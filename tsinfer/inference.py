@@ -22,12 +22,13 @@ of the core tasks like ancestor generation and matching are delegated
 to other modules.
 """
 import collections
+import hashlib
+import multiprocessing
 import queue
 import time
 import logging
 import threading
 import json
-import heapq
 
 import numpy as np
 import humanize
@@ -81,7 +82,7 @@ class DummyProgress(object):
     """
     Class that mimics the subset of the tqdm API that we use in this module.
     """
-    def update(self):
+    def update(self, n=1):
         pass
 
     def close(self):
@@ -99,6 +100,64 @@ class DummyProgressMonitor(object):
         pass
 
 
+def _sample_mutations(haplotypes, match):
+    """
+    Returns the (offset, site, derived_state) CSR arrays describing the
+    mutations needed for each of the specified haplotypes given their matched
+    haplotypes.
+    """
+    n = haplotypes.shape[0]
+    # The differences are returned in row-major order, and so are already
+    # grouped by haplotype.
+    rows, diffs = np.nonzero(haplotypes != match)
+    offset = np.zeros(n + 1, dtype=np.uint64)
+    offset[1:] = np.cumsum(np.bincount(rows, minlength=n))
+    return offset, diffs.astype(np.int32), haplotypes[rows, diffs]
+
+
+def _gather_rows(offset, rows, *columns):
+    """
+    Returns the (offset, *columns) CSR arrays for the specified rows of the
+    specified CSR arrays, in the order given by rows.
+    """
+    offset = np.asarray(offset).astype(np.int64)
+    rows = np.asarray(rows, dtype=np.int64)
+    counts = offset[rows + 1] - offset[rows]
+    new_offset = np.zeros(len(rows) + 1, dtype=np.uint64)
+    new_offset[1:] = np.cumsum(counts)
+    index = np.repeat(
+        offset[rows] - new_offset[:-1].astype(np.int64), counts) + np.arange(
+        int(new_offset[-1]), dtype=np.int64)
+    return (new_offset,) + tuple(column[index] for column in columns)
+
+
+def _haplotype_key(haplotype):
+    """
+    Returns a digest identifying the specified haplotype, so that identical
+    haplotypes can be grouped without holding on to them.
+    """
+    return hashlib.sha1(np.ascontiguousarray(haplotype).tobytes()).digest()
+
+
+# The AncestorMatcher used by sample matching worker processes. This is set
+# before the worker pool is forked, so that each worker inherits its own copy
+# of the matcher and of the tree sequence builder that it refers to.
+_process_matcher = None
+
+
+def _match_samples_process_worker(haplotypes):
+    """
+    Matches the specified haplotypes in a worker process, returning the
+    paths and mutations in CSR form.
+    """
+    n, num_sites = haplotypes.shape
+    starts = np.zeros(n, dtype=np.int32)
+    ends = np.full(n, num_sites, dtype=np.int32)
+    left, right, parent, offset, match = _process_matcher.find_paths(
+        haplotypes, starts, ends)
+    return (offset, left, right, parent), _sample_mutations(haplotypes, match)
+
+
 def _get_progress_monitor(progress_monitor):
     if progress_monitor is None:
         progress_monitor = DummyProgressMonitor()
@@ -172,9 +231,10 @@ def infer(
 
 def generate_ancestors(
         sample_data, num_threads=0, progress_monitor=None, engine=constants.C_ENGINE,
-        **kwargs):
+        bitpack_genotypes=False, **kwargs):
     """
-    generate_ancestors(sample_data, num_threads=0, path=None, **kwargs)
+    generate_ancestors(sample_data, num_threads=0, path=None, \
+        bitpack_genotypes=False, **kwargs)
 
     Runs the ancestor generation :ref:`algorithm <sec_inference_generate_ancestors>`
     on the specified :class:`SampleData` instance and returns the resulting
@@ -193,6 +253,10 @@ def generate_ancestors(
         genering putative ancestors from.
     :param int num_threads: The number of worker threads to use. If < 1, use a
         simpler synchronous algorithm.
+    :param bool bitpack_genotypes: If True, store the genotypes for each site
+        using one bit per sample rather than one byte. This reduces memory
+        usage and is faster for large numbers of samples, and does not
+        affect the generated ancestors.
     :rtype: AncestorData
     :returns: The inferred ancestors stored in an :class:`AncestorData` instance.
     """
@@ -200,7 +264,7 @@ def generate_ancestors(
     with formats.AncestorData(sample_data, **kwargs) as ancestor_data:
         generator = AncestorsGenerator(
             sample_data, ancestor_data, progress_monitor, engine=engine,
-            num_threads=num_threads)
+            num_threads=num_threads, bitpack_genotypes=bitpack_genotypes)
         generator.add_sites()
         generator.run()
         ancestor_data.record_provenance("generate-ancestors")
@@ -209,9 +273,11 @@ def generate_ancestors(
 
 def match_ancestors(
         sample_data, ancestor_data, progress_monitor=None, num_threads=0,
-        path_compression=True, extended_checks=False, engine=constants.C_ENGINE):
+        path_compression=True, extended_checks=False, engine=constants.C_ENGINE,
+        deduplicate_haplotypes=True):
     """
-    match_ancestors(sample_data, path_compression, num_threads=0)
+    match_ancestors(sample_data, path_compression, num_threads=0,
+    deduplicate_haplotypes=True)
 
     Runs the ancestor matching :ref:`algorithm <sec_inference_match_ancestors>`
     on the specified :class:`SampleData` and :class:`AncestorData` instances,
@@ -225,6 +291,9 @@ def match_ancestors(
         a history for.
     :param int num_threads: The number of match worker threads to use. If
         this is <= 0 then a simpler sequential algorithm is used (default).
+    :param bool deduplicate_haplotypes: If True (the default), ancestors in
+        the same epoch with identical haplotypes over the same interval are
+        matched once and share the resulting copying path.
     :return: The ancestors tree sequence representing the inferred history
         of the set of ancestors.
     :rtype: msprime.TreeSequence
@@ -232,15 +301,18 @@ def match_ancestors(
     matcher = AncestorMatcher(
         sample_data, ancestor_data, engine=engine,
         progress_monitor=progress_monitor, path_compression=path_compression,
-        num_threads=num_threads, extended_checks=extended_checks)
+        num_threads=num_threads, extended_checks=extended_checks,
+        deduplicate_haplotypes=deduplicate_haplotypes)
     return matcher.match_ancestors()
 
 
 def augment_ancestors(
         sample_data, ancestors_ts, indexes, progress_monitor=None, num_threads=0,
-        path_compression=True, extended_checks=False, engine=constants.C_ENGINE):
+        path_compression=True, extended_checks=False, engine=constants.C_ENGINE,
+        deduplicate_haplotypes=True):
     """
-    augment_ancestors(sample_data, ancestors_ts, indexes, num_threads=0, simplify=True)
+    augment_ancestors(sample_data, ancestors_ts, indexes, num_threads=0, simplify=True,
+    deduplicate_haplotypes=True)
 
     Runs the sample matching :ref:`algorithm <sec_inference_match_samples>`
     on the specified :class:`SampleData` instance and ancestors tree sequence,
@@ -258,6 +330,9 @@ def augment_ancestors(
         tree sequence.
     :param int num_threads: The number of match worker threads to use. If
         this is <= 0 then a simpler sequential algorithm is used (default).
+    :param bool deduplicate_haplotypes: If True (the default), the specified
+        samples are first grouped by haplotype so that each distinct haplotype
+        is matched once, and its copying path is reused for the other samples.
     :return: The specified ancestors tree sequence augmented with copying
         paths for the specified sample.
     :rtype: msprime.TreeSequence
@@ -265,7 +340,7 @@ def augment_ancestors(
     manager = SampleMatcher(
         sample_data, ancestors_ts, path_compression=path_compression,
         engine=engine, progress_monitor=progress_monitor, num_threads=num_threads,
-        extended_checks=extended_checks)
+        extended_checks=extended_checks, deduplicate_haplotypes=deduplicate_haplotypes)
     manager.match_samples(indexes)
     ts = manager.get_augmented_ancestors_tree_sequence(indexes)
     return ts
@@ -274,9 +349,11 @@ def augment_ancestors(
 def match_samples(
         sample_data, ancestors_ts, progress_monitor=None, num_threads=0,
         path_compression=True, simplify=True, extended_checks=False,
-        stabilise_node_ordering=False, engine=constants.C_ENGINE):
+        stabilise_node_ordering=False, engine=constants.C_ENGINE,
+        max_buffered_samples=None, num_processes=0, deduplicate_haplotypes=True):
     """
-    match_samples(sample_data, ancestors_ts, num_threads=0, simplify=True)
+    match_samples(sample_data, ancestors_ts, num_threads=0, simplify=True,
+    max_buffered_samples=None, num_processes=0, deduplicate_haplotypes=True)
 
     Runs the sample matching :ref:`algorithm <sec_inference_match_samples>`
     on the specified :class:`SampleData` instance and ancestors tree sequence,
@@ -292,6 +369,16 @@ def match_samples(
         history among ancestral ancestral haplotypes.
     :param int num_threads: The number of match worker threads to use. If
         this is <= 0 then a simpler sequential algorithm is used (default).
+    :param int max_buffered_samples: The approximate maximum number of matched
+        samples to hold in memory before inserting their paths into the
+        inferred history. If None (the default), all samples are matched
+        before any paths are inserted.
+    :param int num_processes: The number of forked worker processes used to
+        match the samples. If this is > 0, it is used instead of
+        ``num_threads``. Only available on platforms that support ``fork``.
+    :param bool deduplicate_haplotypes: If True (the default), the samples
+        are first grouped by haplotype so that each distinct haplotype is
+        matched once, and its copying path is reused for the other samples.
     :return: The tree sequence representing the inferred history
         of the sample.
     :rtype: msprime.TreeSequence
@@ -299,7 +386,8 @@ def match_samples(
     manager = SampleMatcher(
         sample_data, ancestors_ts, path_compression=path_compression,
         engine=engine, progress_monitor=progress_monitor, num_threads=num_threads,
-        extended_checks=extended_checks)
+        extended_checks=extended_checks, max_buffered_samples=max_buffered_samples,
+        num_processes=num_processes, deduplicate_haplotypes=deduplicate_haplotypes)
     manager.match_samples()
     ts = manager.finalise(
         simplify=simplify, stabilise_node_ordering=stabilise_node_ordering)
@@ -311,7 +399,8 @@ class AncestorsGenerator(object):
     Manages the process of building ancestors.
     """
     def __init__(
-            self, sample_data, ancestor_data, progress_monitor, engine, num_threads=0):
+            self, sample_data, ancestor_data, progress_monitor, engine, num_threads=0,
+            bitpack_genotypes=False):
         self.sample_data = sample_data
         self.ancestor_data = ancestor_data
         self.progress_monitor = progress_monitor
@@ -321,78 +410,92 @@ class AncestorsGenerator(object):
         if engine == constants.C_ENGINE:
             logger.debug("Using C AncestorBuilder implementation")
             self.ancestor_builder = _tsinfer.AncestorBuilder(
-                self.num_samples, self.num_sites)
+                self.num_samples, self.num_sites, bitpack_genotypes=bitpack_genotypes)
+            self.workspace_class = _tsinfer.AncestorBuilderWorkspace
         elif engine == constants.PY_ENGINE:
             logger.debug("Using Python AncestorBuilder implementation")
             self.ancestor_builder = algorithm.AncestorBuilder(
-                self.num_samples, self.num_sites)
+                self.num_samples, self.num_sites, bitpack_genotypes=bitpack_genotypes)
+            self.workspace_class = algorithm.AncestorBuilderWorkspace
         else:
             raise ValueError("Unknown engine:{}".format(engine))
 
     def add_sites(self):
         logger.info("Starting addition of {} sites".format(self.num_sites))
         progress = self.progress_monitor.get("ga_add_sites", self.num_sites)
-        for j, (site_id, genotypes) in enumerate(
-                self.sample_data.genotypes(inference_sites=True)):
-            frequency = np.sum(genotypes)
-            self.ancestor_builder.add_site(j, int(frequency), genotypes)
-            progress.update()
+        # The genotypes are decompressed one chunk at a time, ahead of the
+        # builder if the sample data has decode threads, so that we can add the
+        # sites from one chunk while the next ones are being decoded.
+        sites_genotypes = self.sample_data.sites_genotypes
+        inference = self.sample_data.sites_inference[:] == 1
+        chunk_size = sites_genotypes.chunks[0]
+        num_chunks = -(-sites_genotypes.shape[0] // chunk_size)
+        chunk_start = np.zeros(num_chunks + 1, dtype=np.int32)
+        chunk_start[1:] = np.cumsum(np.add.reduceat(
+            inference.astype(np.int32), np.arange(0, inference.shape[0], chunk_size)))
+
+        def fetch_chunk(j):
+            start = j * chunk_size
+            selection = inference[start: start + chunk_size]
+            genotypes = sites_genotypes[start: start + chunk_size][selection]
+            site_ids = np.arange(chunk_start[j], chunk_start[j + 1], dtype=np.int32)
+            return site_ids, genotypes
+
+        chunks = formats.prefetch_iterator(
+            fetch_chunk, num_chunks, self.sample_data._num_decode_threads)
+        try:
+            for site_ids, genotypes in chunks:
+                self.ancestor_builder.add_sites(site_ids, genotypes)
+                progress.update(site_ids.shape[0])
+        finally:
+            # Stop the decode threads straight away if adding the sites fails.
+            chunks.close()
         progress.close()
         logger.info("Finished adding sites")
 
     def _run_synchronous(self, progress):
         a = np.zeros(self.num_sites, dtype=np.uint8)
-        for freq, focal_sites in self.descriptors:
+        workspace = self.workspace_class(self.ancestor_builder)
+        offset = self.focal_sites_offset
+        for j in range(self.num_ancestors):
+            focal_sites = self.focal_sites[offset[j]: offset[j + 1]]
             before = time.perf_counter()
-            s, e = self.ancestor_builder.make_ancestor(focal_sites, a)
+            s, e = self.ancestor_builder.make_ancestor(focal_sites, a, workspace)
             duration = time.perf_counter() - before
             logger.debug(
                 "Made ancestor with {} focal sites and length={} in {:.2f}s.".format(
                     focal_sites.shape[0], e - s, duration))
             self.ancestor_data.add_ancestor(
-                start=s, end=e, time=self.time_map[freq], focal_sites=focal_sites,
+                start=s, end=e, time=self.ancestor_time[j], focal_sites=focal_sites,
                 haplotype=a[s:e])
             progress.update()
 
     def _run_threaded(self, progress):
-        # This works by pushing the ancestor descriptors onto the build_queue,
-        # which the worker threads pop off and process. We need to add ancestors
-        # in the the ancestor_data object in the correct order, so we maintain
-        # a priority queue (add_queue) which allows us to track the next smallest
-        # index of the generated ancestor. We add build ancestors to this queue
-        # as they are built, and drain it when we can.
-        queue_depth = 8 * self.num_threads  # Seems like a reasonable limit
-        build_queue = queue.Queue(queue_depth)
-        add_lock = threading.Lock()
-        next_add_index = 0
-        add_queue = []
-
-        def drain_add_queue():
-            nonlocal next_add_index
-            num_drained = 0
-            while len(add_queue) > 0 and add_queue[0][0] == next_add_index:
-                _, time, focal_sites, start, end, haplotype = heapq.heappop(add_queue)
-                self.ancestor_data.add_ancestor(
-                    start=start, end=end, time=time, focal_sites=focal_sites,
-                    haplotype=haplotype)
-                progress.update()
-                next_add_index += 1
-                num_drained += 1
-            logger.debug("Drained {} ancestors from add queue".format(num_drained))
+        # The ancestors are built by the worker threads into a ring of
+        # preallocated slots, indexed by ancestor number. Slot j % num_slots
+        # holds ancestor j, and the main thread writes the ancestors to the
+        # ancestor_data object in order as their slots are filled. We only push
+        # ancestor j onto the build_queue once ancestor j - num_slots has been
+        # written, so that a slot is never overwritten before it is consumed.
+        num_slots = 4 * self.num_threads  # Seems like a reasonable limit
+        build_queue = queue.Queue()
+        haplotypes = np.zeros((num_slots, self.num_sites), dtype=np.uint8)
+        intervals = np.zeros((num_slots, 2), dtype=np.int32)
+        slot_filled = [threading.Event() for _ in range(num_slots)]
+        offset = self.focal_sites_offset
 
         def build_worker(thread_index):
-            a = np.zeros(self.num_sites, dtype=np.uint8)
+            # Each worker allocates the scratch space for making ancestors once.
+            workspace = self.workspace_class(self.ancestor_builder)
             while True:
-                work = build_queue.get()
-                if work is None:
+                index = build_queue.get()
+                if index is None:
                     break
-                index, time, focal_sites = work
-                start, end = self.ancestor_builder.make_ancestor(focal_sites, a)
-                with add_lock:
-                    haplotype = a[start: end].copy()
-                    heapq.heappush(
-                        add_queue, (index, time, focal_sites, start, end, haplotype))
-                    drain_add_queue()
+                slot = index % num_slots
+                focal_sites = self.focal_sites[offset[index]: offset[index + 1]]
+                intervals[slot] = self.ancestor_builder.make_ancestor(
+                    focal_sites, haplotypes[slot], workspace)
+                slot_filled[slot].set()
                 build_queue.task_done()
             build_queue.task_done()
 
@@ -403,29 +506,40 @@ class AncestorsGenerator(object):
             for j in range(self.num_threads)]
         logger.debug("Started {} build worker threads".format(self.num_threads))
 
-        for index, (freq, focal_sites) in enumerate(self.descriptors):
-            build_queue.put((index, self.time_map[freq], focal_sites))
+        for index in range(min(num_slots, self.num_ancestors)):
+            build_queue.put(index)
+        for index in range(self.num_ancestors):
+            slot = index % num_slots
+            slot_filled[slot].wait()
+            slot_filled[slot].clear()
+            start, end = intervals[slot]
+            focal_sites = self.focal_sites[offset[index]: offset[index + 1]]
+            self.ancestor_data.add_ancestor(
+                start=start, end=end, time=self.ancestor_time[index],
+                focal_sites=focal_sites, haplotype=haplotypes[slot, start: end])
+            progress.update()
+            if index + num_slots < self.num_ancestors:
+                build_queue.put(index + num_slots)
 
         # Stop the the worker threads.
         for j in range(self.num_threads):
             build_queue.put(None)
         for j in range(self.num_threads):
             build_threads[j].join()
-        drain_add_queue()
 
     def run(self):
-        self.descriptors = self.ancestor_builder.ancestor_descriptors()
-        self.num_ancestors = len(self.descriptors)
-        # Build the map from frequencies to time.
-        self.time_map = {}
-        for freq, _ in reversed(self.descriptors):
-            if freq not in self.time_map:
-                self.time_map[freq] = len(self.time_map) + 1
+        frequency, self.focal_sites_offset, self.focal_sites = \
+            self.ancestor_builder.ancestor_descriptors()
+        self.num_ancestors = frequency.shape[0]
+        # Map the frequencies to times, so that the ancestors with the lowest
+        # frequency have time 1.
+        distinct_frequencies = np.unique(frequency)
+        self.ancestor_time = np.searchsorted(distinct_frequencies, frequency) + 1
         if self.num_ancestors > 0:
             logger.info("Starting build for {} ancestors".format(self.num_ancestors))
             progress = self.progress_monitor.get("ga_generate", self.num_ancestors)
             a = np.zeros(self.num_sites, dtype=np.uint8)
-            root_time = len(self.time_map) + 1
+            root_time = distinct_frequencies.shape[0] + 1
             ultimate_ancestor_time = root_time + 1
             # Add the ultimate ancestor. This is an awkward hack really; we don't
             # ever insert this ancestor. The only reason to add it here is that
@@ -450,7 +564,9 @@ class Matcher(object):
 
     def __init__(
             self, sample_data, num_threads=1, engine=constants.C_ENGINE,
-            path_compression=True, progress_monitor=None, extended_checks=False):
+            path_compression=True, progress_monitor=None, extended_checks=False,
+            traceback_block_size=64 * 1024 * 1024, interval_labels=False,
+            deduplicate_haplotypes=True):
         self.sample_data = sample_data
         self.num_threads = num_threads
         self.path_compression = path_compression
@@ -459,6 +575,17 @@ class Matcher(object):
         self.progress_monitor = _get_progress_monitor(progress_monitor)
         self.match_progress = None  # Allocated by subclass
         self.extended_checks = extended_checks
+        # The traceback memory for each matcher is allocated in blocks of this
+        # many bytes.
+        self.traceback_block_size = traceback_block_size
+        # If True, the matchers label the nodes in each tree with intervals
+        # so that descendant tests take constant time.
+        self.interval_labels = interval_labels
+        # If True, identical haplotypes are only matched once and the copying
+        # path is reused for the duplicates.
+        self.deduplicate_haplotypes = deduplicate_haplotypes
+        # The number of calls to the matcher avoided by deduplication.
+        self.num_saved_matches = 0
 
         if engine == constants.C_ENGINE:
             logger.debug("Using C matcher implementation")
@@ -484,12 +611,14 @@ class Matcher(object):
         # Allocate the matchers and statistics arrays.
         num_threads = max(1, self.num_threads)
         self.match = [np.zeros(self.num_sites, np.uint8) for _ in range(num_threads)]
-        self.results = ResultBuffer()
+        self.results = ResultBuffer(num_threads)
         self.mean_traceback_size = np.zeros(num_threads)
         self.num_matches = np.zeros(num_threads)
         self.matcher = [
             self.ancestor_matcher_class(
-                self.tree_sequence_builder, extended_checks=self.extended_checks)
+                self.tree_sequence_builder, extended_checks=self.extended_checks,
+                traceback_block_size=self.traceback_block_size,
+                interval_labels=self.interval_labels)
             for _ in range(num_threads)]
 
     def _find_path(self, child_id, haplotype, start, end, thread_index=0):
@@ -500,7 +629,7 @@ class Matcher(object):
         matcher = self.matcher[thread_index]
         match = self.match[thread_index]
         left, right, parent = matcher.find_path(haplotype, start, end, match)
-        self.results.set_path(child_id, left, right, parent)
+        self.results.set_path(child_id, left, right, parent, thread_index)
         self.match_progress.update()
         self.mean_traceback_size[thread_index] += matcher.mean_traceback_size
         self.num_matches[thread_index] += 1
@@ -509,6 +638,32 @@ class Matcher(object):
             humanize.naturalsize(matcher.total_memory, binary=True)))
         return left, right, parent
 
+    def _find_paths(self, child_ids, haplotypes, starts, ends, thread_index=0):
+        """
+        Finds the paths of the rows in the specified haplotypes matrix in a
+        single call to the matcher, and updates the results for the specified
+        thread_index. Returns (left, right, parent, offset, match), where
+        the paths are in CSR form and match is the matrix of matched haplotypes.
+        """
+        matcher = self.matcher[thread_index]
+        left, right, parent, offset, match = matcher.find_paths(
+            haplotypes, starts, ends)
+        self.results.set_paths(child_ids, offset, left, right, parent, thread_index)
+        self.match_progress.update(len(child_ids))
+        self.num_matches[thread_index] += len(child_ids)
+        logger.debug("matched {} nodes; num_edges={} match_mem={}".format(
+            len(child_ids), left.shape[0],
+            humanize.naturalsize(matcher.total_memory, binary=True)))
+        return left, right, parent, offset, match
+
+    def _add_mutations(self):
+        """
+        Adds the mutations in the result buffer to the tree sequence builder.
+        """
+        node_ids, offset, site, derived_state = self.results.get_mutations()
+        self.tree_sequence_builder.add_mutations_bulk(
+            node_ids, offset, site, derived_state)
+
     def restore_tree_sequence_builder(self, ancestors_ts):
         tables = ancestors_ts.tables
         # Make sure that the set of positions in the ancestors tree sequence is
@@ -882,6 +1037,10 @@ class AncestorMatcher(Matcher):
             self.epoch_slices = np.vstack([start, end]).T
             self.num_epochs = self.epoch_slices.shape[0]
         self.start_epoch = 1
+        # The first ancestor with each distinct haplotype in the current epoch,
+        # and the (ancestor_id, source_id) pairs for those that duplicate it.
+        self.epoch_haplotypes = {}
+        self.epoch_duplicates = []
 
     def __epoch_info_dict(self, epoch_index):
         start, end = self.epoch_slices[epoch_index]
@@ -895,7 +1054,7 @@ class AncestorMatcher(Matcher):
         focal_sites = ancestor.focal_sites
         start = ancestor.start
         end = ancestor.end
-        self.results.set_mutations(ancestor.id, focal_sites)
+        self.results.set_mutations(ancestor.id, focal_sites, thread_index=thread_index)
         assert ancestor.haplotype.shape[0] == (end - start)
         haplotype[start: end] = ancestor.haplotype
         assert np.all(haplotype[focal_sites] == 1)
@@ -907,6 +1066,26 @@ class AncestorMatcher(Matcher):
                 ancestor.id, haplotype, start, end, thread_index)
         assert np.all(self.match[thread_index][start: end] == haplotype[start: end])
 
+    def __is_duplicate(self, ancestor):
+        """
+        Returns True if an earlier ancestor in the current epoch has the same
+        haplotype to match over the same interval. The path of the earlier
+        ancestor is then reused for this one when the epoch is completed.
+        """
+        if not self.deduplicate_haplotypes:
+            return False
+        haplotype = ancestor.haplotype.copy()
+        haplotype[ancestor.focal_sites - ancestor.start] = 0
+        key = (ancestor.start, ancestor.end, _haplotype_key(haplotype))
+        source_id = self.epoch_haplotypes.setdefault(key, ancestor.id)
+        if source_id == ancestor.id:
+            return False
+        logger.debug("Ancestor {} duplicates ancestor {}".format(ancestor.id, source_id))
+        self.results.set_mutations(ancestor.id, ancestor.focal_sites)
+        self.epoch_duplicates.append((ancestor.id, source_id))
+        self.match_progress.update()
+        return True
+
     def __start_epoch(self, epoch_index):
         start, end = self.epoch_slices[epoch_index]
         info = collections.OrderedDict([
@@ -914,7 +1093,20 @@ class AncestorMatcher(Matcher):
             ("nanc", str(end - start))
         ])
         self.progress_monitor.set_detail(info)
-        self.tree_sequence_builder.freeze_indexes()
+        self.epoch_haplotypes.clear()
+        self.epoch_duplicates = []
+        tsb = self.tree_sequence_builder
+        num_added = tsb.num_pending_added_edges
+        num_removed = tsb.num_pending_removed_edges
+        before = time.perf_counter()
+        tsb.freeze_indexes()
+        # Only the edges added since the last epoch are sorted, and these are
+        # merged into the previously frozen edges without sorting them again.
+        logger.debug(
+            "Froze indexes for {} edges in {:.4f}s: merged {} added and {} removed "
+            "edges into {} previously frozen edges".format(
+                tsb.num_edges, time.perf_counter() - before, num_added, num_removed,
+                tsb.num_edges - num_added + num_removed))
 
     def __complete_epoch(self, epoch_index):
         start, end = map(int, self.epoch_slices[epoch_index])
@@ -922,14 +1114,20 @@ class AncestorMatcher(Matcher):
         current_time = self.epoch[start]
         nodes_before = self.tree_sequence_builder.num_nodes
 
-        for child_id in range(start, end):
-            left, right, parent = self.results.get_path(child_id)
-            self.tree_sequence_builder.add_path(
-                child_id, left, right, parent,
-                compress=self.path_compression,
-                extended_checks=self.extended_checks)
-            site, derived_state = self.results.get_mutations(child_id)
-            self.tree_sequence_builder.add_mutations(child_id, site, derived_state)
+        if len(self.epoch_duplicates) > 0:
+            node_ids, source_ids = np.array(self.epoch_duplicates, dtype=np.int32).T
+            child_ids, offset, left, right, parent = self.results.get_paths()
+            rows = np.searchsorted(child_ids, source_ids)
+            self.results.set_paths(
+                node_ids, *_gather_rows(offset, rows, left, right, parent))
+            self.num_saved_matches += len(node_ids)
+        child_ids, offset, left, right, parent = self.results.get_paths()
+        assert np.array_equal(child_ids, np.arange(start, end))
+        self.tree_sequence_builder.add_paths(
+            child_ids, offset, left, right, parent,
+            compress=self.path_compression,
+            extended_checks=self.extended_checks)
+        self._add_mutations()
 
         extra_nodes = self.tree_sequence_builder.num_nodes - nodes_before
         mean_memory = np.mean([matcher.total_memory for matcher in self.matcher])
@@ -951,7 +1149,8 @@ class AncestorMatcher(Matcher):
             for ancestor_id in range(start, end):
                 a = next(self.ancestors)
                 assert ancestor_id == a.id
-                self.__ancestor_find_path(a)
+                if not self.__is_duplicate(a):
+                    self.__ancestor_find_path(a)
             self.__complete_epoch(j)
 
     def __match_ancestors_multi_threaded(self, start_epoch=1):
@@ -983,7 +1182,8 @@ class AncestorMatcher(Matcher):
             for ancestor_id in range(start, end):
                 a = next(self.ancestors)
                 assert a.id == ancestor_id
-                match_queue.put(a)
+                if not self.__is_duplicate(a):
+                    match_queue.put(a)
             # Block until all matches have completed.
             match_queue.join()
             self.__complete_epoch(j)
@@ -1003,7 +1203,9 @@ class AncestorMatcher(Matcher):
             self.__match_ancestors_multi_threaded()
         ts = self.store_output()
         self.match_progress.close()
-        logger.info("Finished ancestor matching")
+        logger.info(
+            "Finished ancestor matching; {} matches saved by deduplication".format(
+                self.num_saved_matches))
         return ts
 
     def store_output(self):
@@ -1019,23 +1221,175 @@ class AncestorMatcher(Matcher):
 
 class SampleMatcher(Matcher):
 
-    def __init__(self, sample_data, ancestors_ts, **kwargs):
+    def __init__(
+            self, sample_data, ancestors_ts, match_batch_size=64,
+            max_buffered_samples=None, num_processes=0, **kwargs):
         super().__init__(sample_data, **kwargs)
+        # The number of samples matched in each call to the matcher.
+        self.match_batch_size = match_batch_size
+        # If > 0, the samples are matched by this many forked worker processes
+        # rather than by threads.
+        if num_processes > 0 and "fork" not in multiprocessing.get_all_start_methods():
+            raise ValueError("Matching samples in worker processes requires fork")
+        self.num_processes = num_processes
+        # The number of matched samples that we hold in the result buffer before
+        # inserting their paths. If None, all samples are matched first.
+        if max_buffered_samples is not None and max_buffered_samples < 1:
+            raise ValueError("max_buffered_samples must be at least 1")
+        self.max_buffered_samples = max_buffered_samples
         self.restore_tree_sequence_builder(ancestors_ts)
         self.ancestors_ts = ancestors_ts
         self.sample_ids = np.zeros(self.num_samples, dtype=np.int32)
-
-    def __process_sample(self, sample_id, haplotype, thread_index=0):
-        self._find_path(sample_id, haplotype, 0, self.num_sites, thread_index)
-        match = self.match[thread_index]
-        diffs = np.where(haplotype != match)[0]
-        derived_state = haplotype[diffs]
-        self.results.set_mutations(sample_id, diffs.astype(np.int32), derived_state)
-
-    def __match_samples_single_threaded(self, indexes):
+        # The matchers only look at the first mutation at each site, so inserting
+        # sample mutations while matching is safe except at sites that have no
+        # mutations in the ancestors. These are held back until the end.
+        self.unmutated_sites = np.ones(self.num_sites, dtype=bool)
+        self.unmutated_sites[self.mutated_sites] = False
+        self.deferred_results = ResultBuffer()
+        # Maps the node ID of the first sample with each distinct haplotype
+        # to the node IDs of the later samples with the same haplotype.
+        self.duplicates = {}
+        # The sample paths must be inserted in node ID order for the output
+        # not to depend on the buffering, so we record which samples have
+        # their results in the buffer. Samples are numbered from the first
+        # sample node, and the first num_inserted_samples have been inserted.
+        self.first_sample_node = 0
+        self.completed_samples = np.zeros(0, dtype=bool)
+        self.num_inserted_samples = 0
+
+    def __group_duplicates(self, indexes):
+        """
+        Groups the specified samples by the hash of their haplotypes and returns
+        the indexes of the first sample in each group, which are the only
+        samples that need to be matched.
+        """
+        first = {}
+        representatives = []
+        duplicates = collections.defaultdict(list)
+        for j, a in self.sample_data.haplotypes(indexes, inference_sites=True):
+            k = first.setdefault(_haplotype_key(a), j)
+            if k == j:
+                representatives.append(j)
+            else:
+                duplicates[int(self.sample_ids[k])].append(self.sample_ids[j])
+        self.duplicates = {
+            node_id: np.array(node_ids, dtype=np.int32)
+            for node_id, node_ids in duplicates.items()}
+        self.num_saved_matches = len(indexes) - len(representatives)
+        logger.info("Found {} distinct haplotypes among {} samples".format(
+            len(representatives), len(indexes)))
+        return np.array(representatives, dtype=np.int64)
+
+    def __set_duplicate_results(self, sample_ids, paths, mutations, thread_index=0):
+        """
+        Sets the results for the duplicates of the specified matched samples
+        from their (offset, left, right, parent) paths and (offset, site,
+        derived_state) mutations.
+        """
+        rows = []
+        node_ids = []
+        for j, sample_id in enumerate(sample_ids):
+            duplicates = self.duplicates.get(int(sample_id))
+            if duplicates is not None:
+                rows.extend([j] * len(duplicates))
+                node_ids.append(duplicates)
+        if len(rows) > 0:
+            node_ids = np.hstack(node_ids)
+            self.results.set_paths(
+                node_ids, *_gather_rows(paths[0], rows, *paths[1:]),
+                thread_index=thread_index)
+            self.results.set_mutations_bulk(
+                node_ids, *_gather_rows(mutations[0], rows, *mutations[1:]),
+                thread_index=thread_index)
+            self.__set_completed(node_ids)
+            self.match_progress.update(len(node_ids))
+
+    def __set_completed(self, node_ids):
+        """
+        Records that the results for the specified sample nodes are in the
+        result buffer. This must only be called after the results are set.
+        """
+        index = np.asarray(node_ids, dtype=np.int64) - self.first_sample_node
+        self.completed_samples[index] = True
+
+    def __process_samples(self, sample_ids, haplotypes, thread_index=0):
+        n = len(sample_ids)
+        starts = np.zeros(n, dtype=np.int32)
+        ends = np.full(n, self.num_sites, dtype=np.int32)
+        left, right, parent, offset, match = self._find_paths(
+            sample_ids, haplotypes, starts, ends, thread_index)
+        mutations = _sample_mutations(haplotypes, match)
+        self.results.set_mutations_bulk(sample_ids, *mutations, thread_index)
+        self.__set_duplicate_results(
+            sample_ids, (offset, left, right, parent), mutations, thread_index)
+        self.__set_completed(sample_ids)
+
+    def __sample_batches(self, indexes):
+        """
+        Returns an iterator over (sample_ids, haplotypes) batches of at most
+        match_batch_size samples.
+        """
         sample_haplotypes = self.sample_data.haplotypes(indexes, inference_sites=True)
+        haplotypes = np.zeros((self.match_batch_size, self.num_sites), dtype=np.uint8)
+        sample_ids = []
         for j, a in sample_haplotypes:
-            self.__process_sample(self.sample_ids[j], a)
+            haplotypes[len(sample_ids)] = a
+            sample_ids.append(self.sample_ids[j])
+            if len(sample_ids) == self.match_batch_size:
+                yield sample_ids, haplotypes
+                haplotypes = np.zeros_like(haplotypes)
+                sample_ids = []
+        if len(sample_ids) > 0:
+            yield sample_ids, haplotypes[:len(sample_ids)]
+
+    def __insert_samples(self, results, final=False):
+        """
+        Inserts the paths and mutations in the specified result buffer into the
+        tree sequence builder. Unless this is the final insertion, mutations at
+        sites without ancestral mutations are deferred.
+        """
+        sample_ids, offset, left, right, parent = results.get_paths()
+        logger.debug("Inserting paths for {} samples: {} edges".format(
+            len(sample_ids), results.total_edges))
+        self.tree_sequence_builder.add_paths(
+            sample_ids, offset, left, right, parent, compress=self.path_compression)
+        node_ids, offset, site, derived_state = results.get_mutations()
+        if not final:
+            deferred = self.unmutated_sites[site]
+            if np.any(deferred):
+                counts = np.diff(offset).astype(np.int64)
+                rows = np.repeat(np.arange(len(node_ids)), counts)
+                deferred_offset = np.zeros(len(node_ids) + 1, dtype=np.uint64)
+                deferred_offset[1:] = np.cumsum(
+                    np.bincount(rows[deferred], minlength=len(node_ids)))
+                self.deferred_results.set_mutations_bulk(
+                    node_ids, deferred_offset, site[deferred], derived_state[deferred])
+                offset = offset - deferred_offset
+                site = site[~deferred]
+                derived_state = derived_state[~deferred]
+        self.tree_sequence_builder.add_mutations_bulk(
+            node_ids, offset, site, derived_state)
+        self.paths_progress.update(len(sample_ids))
+
+    def __flush_results(self):
+        """
+        Inserts the buffered results if there are at least max_buffered_samples
+        of them that can be inserted in node ID order; that is, for which the
+        results of all samples with lower node IDs have been inserted or are
+        also in the buffer.
+        """
+        if self.max_buffered_samples is not None:
+            pending = self.completed_samples[self.num_inserted_samples:]
+            num_ready = len(pending) if np.all(pending) else int(np.argmin(pending))
+            if num_ready >= self.max_buffered_samples:
+                self.num_inserted_samples += num_ready
+                limit = self.first_sample_node + self.num_inserted_samples
+                self.__insert_samples(self.results.take(limit))
+
+    def __match_samples_single_threaded(self, indexes):
+        for sample_ids, haplotypes in self.__sample_batches(indexes):
+            self.__process_samples(sample_ids, haplotypes)
+            self.__flush_results()
 
     def __match_samples_multi_threaded(self, indexes):
         # Note that this function is not almost identical to the match_ancestors
@@ -1051,8 +1405,8 @@ class SampleMatcher(Matcher):
                 work = match_queue.get()
                 if work is None:
                     break
-                sample_id, a = work
-                self.__process_sample(sample_id, a, thread_index)
+                sample_ids, haplotypes = work
+                self.__process_samples(sample_ids, haplotypes, thread_index)
                 match_queue.task_done()
             match_queue.task_done()
 
@@ -1062,9 +1416,11 @@ class SampleMatcher(Matcher):
             for j in range(self.num_threads)]
         logger.debug("Started {} match worker threads".format(self.num_threads))
 
-        sample_haplotypes = self.sample_data.haplotypes(indexes, inference_sites=True)
-        for j, a in sample_haplotypes:
-            match_queue.put((self.sample_ids[j], a))
+        for work in self.__sample_batches(indexes):
+            match_queue.put(work)
+            # The paths are inserted here while the worker threads go on
+            # matching the queued samples.
+            self.__flush_results()
 
         # Stop the the worker threads.
         for j in range(self.num_threads):
@@ -1072,32 +1428,70 @@ class SampleMatcher(Matcher):
         for j in range(self.num_threads):
             match_threads[j].join()
 
+    def __match_samples_multi_process(self, indexes):
+        global _process_matcher
+        # Keep a bounded number of batches in flight, so that we do not read
+        # all of the haplotypes ahead of the workers.
+        max_pending = 2 * self.num_processes
+        pending = collections.deque()
+
+        def add_results():
+            sample_ids, result = pending.popleft()
+            paths, mutations = result.get()
+            self.results.set_paths(sample_ids, *paths)
+            self.results.set_mutations_bulk(sample_ids, *mutations)
+            self.match_progress.update(len(sample_ids))
+            self.num_matches[0] += len(sample_ids)
+            self.__set_duplicate_results(sample_ids, paths, mutations)
+            self.__set_completed(sample_ids)
+            self.__flush_results()
+
+        _process_matcher = self.matcher[0]
+        context = multiprocessing.get_context("fork")
+        try:
+            with context.Pool(self.num_processes) as pool:
+                logger.debug("Started {} match worker processes".format(
+                    self.num_processes))
+                for sample_ids, haplotypes in self.__sample_batches(indexes):
+                    pending.append((sample_ids, pool.apply_async(
+                        _match_samples_process_worker, (haplotypes,))))
+                    if len(pending) == max_pending:
+                        add_results()
+                while len(pending) > 0:
+                    add_results()
+        finally:
+            _process_matcher = None
+
     def match_samples(self, indexes=None):
         if indexes is None:
             indexes = np.arange(self.num_samples)
         # Add in sample nodes.
         for j in indexes:
             self.sample_ids[j] = self.tree_sequence_builder.add_node(0)
+        if len(indexes) > 0:
+            self.first_sample_node = int(self.sample_ids[indexes[0]])
+        self.completed_samples = np.zeros(len(indexes), dtype=bool)
+        self.num_inserted_samples = 0
         logger.info("Started matching for {} samples".format(len(indexes)))
         if self.sample_data.num_inference_sites > 0:
             self.match_progress = self.progress_monitor.get("ms_match", len(indexes))
-            if self.num_threads <= 0:
+            self.paths_progress = self.progress_monitor.get("ms_paths", len(indexes))
+            if self.deduplicate_haplotypes:
+                indexes = self.__group_duplicates(indexes)
+            if self.num_processes > 0:
+                self.__match_samples_multi_process(indexes)
+            elif self.num_threads <= 0:
                 self.__match_samples_single_threaded(indexes)
             else:
                 self.__match_samples_multi_threaded(indexes)
             self.match_progress.close()
-            logger.info("Inserting sample paths: {} edges in total".format(
+            logger.info("Inserting sample paths: {} edges remaining".format(
                 self.results.total_edges))
-            progress_monitor = self.progress_monitor.get("ms_paths", len(indexes))
-            for j in indexes:
-                sample_id = int(self.sample_ids[j])
-                left, right, parent = self.results.get_path(sample_id)
-                self.tree_sequence_builder.add_path(
-                    sample_id, left, right, parent, compress=self.path_compression)
-                site, derived_state = self.results.get_mutations(sample_id)
-                self.tree_sequence_builder.add_mutations(sample_id, site, derived_state)
-                progress_monitor.update()
-            progress_monitor.close()
+            self.__insert_samples(self.results.take())
+            self.__insert_samples(self.deferred_results.take(), final=True)
+            self.paths_progress.close()
+            logger.info("Finished matching; {} matches saved by deduplication".format(
+                self.num_saved_matches))
 
     def finalise(self, simplify=True, stabilise_node_ordering=False):
         logger.info("Finalising tree sequence")
@@ -1127,39 +1521,165 @@ class SampleMatcher(Matcher):
 
 class ResultBuffer(object):
     """
-    A wrapper for numpy arrays representing the results of a copying operations.
+    A columnar buffer for the results of copying operations. Each thread
+    appends its results to its own list of chunks, and the chunks are merged
+    into CSR form, ordered by node ID, when the results are retrieved. The
+    lock is only needed so that the contents can be taken while other threads
+    are adding results.
     """
-    def __init__(self):
-        self.paths = {}
-        self.mutations = {}
+    def __init__(self, num_threads=1):
+        self.num_threads = num_threads
         self.lock = threading.Lock()
-        self.total_edges = 0
+        self.clear()
 
     def clear(self):
         """
         Clears this result buffer.
         """
-        self.paths.clear()
-        self.mutations.clear()
-        self.total_edges = 0
+        with self.lock:
+            self.path_chunks = [[] for _ in range(self.num_threads)]
+            self.mutation_chunks = [[] for _ in range(self.num_threads)]
+            self.edge_counts = np.zeros(self.num_threads, dtype=np.int64)
+            self.path_counts = np.zeros(self.num_threads, dtype=np.int64)
 
-    def set_path(self, node_id, left, right, parent):
+    def take(self, limit=None):
+        """
+        Returns a new ResultBuffer with the current contents of this buffer,
+        which is then empty. If limit is specified, only the results for nodes
+        with IDs less than limit are taken, and the rest are kept.
+        """
+        other = ResultBuffer(self.num_threads)
+        with self.lock:
+            if limit is None:
+                other.path_chunks, self.path_chunks = (
+                    self.path_chunks, other.path_chunks)
+                other.mutation_chunks, self.mutation_chunks = (
+                    self.mutation_chunks, other.mutation_chunks)
+                other.edge_counts, self.edge_counts = (
+                    self.edge_counts, other.edge_counts)
+                other.path_counts, self.path_counts = (
+                    self.path_counts, other.path_counts)
+            else:
+                for j in range(self.num_threads):
+                    other.path_chunks[j], self.path_chunks[j] = self._split(
+                        self.path_chunks[j], limit)
+                    other.mutation_chunks[j], self.mutation_chunks[j] = self._split(
+                        self.mutation_chunks[j], limit)
+                for buff in [self, other]:
+                    buff.edge_counts[:] = [
+                        sum(len(chunk[2]) for chunk in chunks)
+                        for chunks in buff.path_chunks]
+                    buff.path_counts[:] = [
+                        sum(len(chunk[0]) for chunk in chunks)
+                        for chunks in buff.path_chunks]
+        return other
+
+    @staticmethod
+    def _split(chunks, limit):
+        """
+        Splits the specified list of CSR chunks into the chunks for nodes with
+        IDs less than limit and the chunks for the remaining nodes.
+        """
+        below = []
+        above = []
+        for chunk in chunks:
+            node_ids = chunk[0]
+            taken = node_ids < limit
+            if np.all(taken):
+                below.append(chunk)
+            elif not np.any(taken):
+                above.append(chunk)
+            else:
+                columns = [np.asarray(column) for column in chunk[2:]]
+                for rows, dest in [(taken, below), (~taken, above)]:
+                    rows = np.where(rows)[0]
+                    dest.append(
+                        (node_ids[rows],) + _gather_rows(chunk[1], rows, *columns))
+        return below, above
+
+    @property
+    def total_edges(self):
+        return int(np.sum(self.edge_counts))
+
+    @property
+    def total_paths(self):
+        return int(np.sum(self.path_counts))
+
+    def set_path(self, node_id, left, right, parent, thread_index=0):
+        offset = np.array([0, len(left)], dtype=np.uint64)
+        self.set_paths([node_id], offset, left, right, parent, thread_index)
+
+    def set_paths(self, node_ids, offset, left, right, parent, thread_index=0):
+        """
+        Appends the paths for the specified nodes in CSR form, so that the path
+        for node_ids[j] is left/right/parent[offset[j]: offset[j + 1]].
+        """
+        node_ids = np.asarray(node_ids, dtype=np.int32)
         with self.lock:
-            assert node_id not in self.paths
-            self.paths[node_id] = left, right, parent
-            self.total_edges += len(left)
+            self.path_chunks[thread_index].append((
+                node_ids, np.asarray(offset, dtype=np.uint64), left, right, parent))
+            self.edge_counts[thread_index] += len(left)
+            self.path_counts[thread_index] += len(node_ids)
 
-    def set_mutations(self, node_id, site, derived_state=None):
+    def set_mutations(self, node_id, site, derived_state=None, thread_index=0):
         if derived_state is None:
             derived_state = np.ones(site.shape[0], dtype=np.uint8)
+        offset = np.array([0, len(site)], dtype=np.uint64)
+        self.set_mutations_bulk([node_id], offset, site, derived_state, thread_index)
+
+    def set_mutations_bulk(
+            self, node_ids, offset, site, derived_state, thread_index=0):
+        """
+        Appends the mutations for the specified nodes in CSR form, so that
+        the mutations for node_ids[j] are site/derived_state[offset[j]: offset[j + 1]].
+        """
         with self.lock:
-            self.mutations[node_id] = site, derived_state
+            self.mutation_chunks[thread_index].append((
+                np.asarray(node_ids, dtype=np.int32),
+                np.asarray(offset, dtype=np.uint64), site, derived_state))
 
-    def get_path(self, node_id):
-        return self.paths[node_id]
+    @staticmethod
+    def _merge(chunks, dtypes):
+        """
+        Merges the specified list of CSR chunks into a single CSR chunk
+        ordered by node ID, returning (node_ids, offset, *columns).
+        """
+        if len(chunks) == 0:
+            return (
+                np.zeros(0, dtype=np.int32), np.zeros(1, dtype=np.uint64)) + tuple(
+                np.zeros(0, dtype=dtype) for dtype in dtypes)
+        node_ids = np.hstack([chunk[0] for chunk in chunks])
+        counts = np.hstack([np.diff(chunk[1]) for chunk in chunks]).astype(np.int64)
+        columns = [
+            np.hstack([chunk[2 + k] for chunk in chunks]).astype(dtype, copy=False)
+            for k, dtype in enumerate(dtypes)]
+        start = np.hstack([[0], np.cumsum(counts)[:-1]]).astype(np.int64)
+        order = np.argsort(node_ids, kind="stable")
+        counts = counts[order]
+        offset = np.zeros(len(node_ids) + 1, dtype=np.uint64)
+        offset[1:] = np.cumsum(counts)
+        # Gather the segments for each node in the sorted order.
+        index = np.repeat(
+            start[order] - offset[:-1].astype(np.int64), counts) + np.arange(
+            int(offset[-1]), dtype=np.int64)
+        return (node_ids[order], offset) + tuple(column[index] for column in columns)
+
+    def get_paths(self):
+        """
+        Returns (node_ids, offset, left, right, parent) for all paths in the buffer,
+        ordered by node ID.
+        """
+        chunks = [chunk for thread_chunks in self.path_chunks for chunk in thread_chunks]
+        return self._merge(chunks, [np.uint32, np.uint32, np.int32])
 
-    def get_mutations(self, node_id):
-        return self.mutations[node_id]
+    def get_mutations(self):
+        """
+        Returns (node_ids, offset, site, derived_state) for all mutations in the
+        buffer, ordered by node ID.
+        """
+        chunks = [
+            chunk for thread_chunks in self.mutation_chunks for chunk in thread_chunks]
+        return self._merge(chunks, [np.int32, np.uint8])
 
 
 def minimise(ts):